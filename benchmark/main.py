@@ -1,14 +1,15 @@
 from g4l.local import LocalEngine
-import time
 
 def benchmark_chat_completion(model, message, num_iterations=1):
     engine = LocalEngine(
         gpu_layers = -1,  # use all GPU layers
         cores      = 0        # use 8 CPU cores
     )
-    total_tokens = 0
-    total_time = 0
+    completion_tokens = []
+    decode_times = []
     loading_times = []
+    first_token_times = []
+    speeds = []
 
     for i in range(num_iterations):
         response = engine.chat.completions.create(
@@ -17,36 +18,29 @@ def benchmark_chat_completion(model, message, num_iterations=1):
             stream=True
         )
 
-        start = False
-        stream_start = time.time()
-        start_time = 0
-        tokens = 0
-    
-        for token in response:
-            if not start:
-                start_time = time.time()
-                start = True
-            tokens += 1
+        for chunk in response:
+            pass
 
-        elapsed = time.time() - start_time
-        loading_time = start_time - stream_start
+        # The last chunk carries the token counts and timings of the request; timings a
+        # request did not measure (e.g. decode speed of a one-token answer) are None
+        completion_tokens.append(chunk.usage["completion_tokens"])
+        decode_times.append(chunk.timings["decode_time"])
+        loading_times.append(chunk.timings["load_time"])
+        first_token_times.append(chunk.timings["time_to_first_token"])
+        speeds.append(chunk.timings["decode_tokens_per_second"])
 
-        total_tokens += tokens
-        total_time += elapsed
-        loading_times.append(loading_time)
-
-    avg_tokens       = total_tokens / num_iterations
-    avg_time         = total_time / num_iterations
-    avg_loading_time = sum(loading_times) / num_iterations
-    avg_speed        = avg_tokens / avg_time
+    def average(values, unit=""):
+        values = [value for value in values if value is not None]
+        return f"{sum(values) / len(values):.2f}{unit}" if values else "n/a"
 
     print(f"Model                = {model}")
     # print(f"Message              = {message}")
     print(f"Number of iterations = {num_iterations}")
-    print(f"Average loading time = {avg_loading_time:.2f}s")
-    print(f"Average total tokens = {avg_tokens:.2f}")
-    print(f"Average total time   = {avg_time:.2f}s")
-    print(f"Average speed        = {avg_speed:.2f} t/s")
+    print(f"Average loading time = {average(loading_times, 's')}")
+    print(f"Average first token  = {average(first_token_times, 's')}")
+    print(f"Average total tokens = {average(completion_tokens)}")
+    print(f"Average decode time  = {average(decode_times, 's')}")
+    print(f"Average speed        = {average(speeds, ' t/s')}")
 
 # Example usage
 benchmark_chat_completion(model='mistral-7b-instruct', message="hey how are you today", num_iterations=5)
\ No newline at end of file
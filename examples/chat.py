@@ -1,5 +1,4 @@
 from g4l.local import LocalEngine
-import time
 
 engine = LocalEngine(
     gpu_layers = -1,  # use all GPU layers
@@ -12,23 +11,13 @@ response = engine.chat.completions.create(
     stream   = True
 )
 
-start        = False
-stream_start = time.time()
-start_time   = 0
-tokens       = 0
+for chunk in response:
+    print(chunk.choices[0].delta.content or "", end="", flush=True)
 
-for token in response:
-    if start != True:
-        start_time = time.time()
-    
-    start = True
-    
-    print(token.choices[0].delta.content or "")
-    tokens += 1
-
-elapsed = time.time() - start_time
-
-print(f'loading time = {start_time - stream_start}s')
-print(f'total tokens = {tokens}')
-print(f'total time   = {elapsed}s')
-print(f'speed        = {tokens / elapsed}/s ')
\ No newline at end of file
+# The last chunk carries the token counts and timings of the request
+print()
+print(f'loading time = {chunk.timings["load_time"]}s')
+print(f'first token  = {chunk.timings["time_to_first_token"]}s')
+print(f'total tokens = {chunk.usage["completion_tokens"]}')
+print(f'total time   = {chunk.timings["total_time"]}s')
+print(f'speed        = {chunk.timings["decode_tokens_per_second"]}/s ')
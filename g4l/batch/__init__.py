@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import pathlib
+from typing import Any, Callable, Dict, Iterator, Optional, Set, Tuple
+
+from ..typing import Messages
+from ..local import LocalEngine
+
+def read_requests(path: pathlib.Path) -> Iterator[Tuple[str, Messages]]:
+    """
+    Read the conversations of a JSONL batch file.
+
+    Each line holds `{"id": ..., "messages": [...]}`, or an OpenAI batch request
+    `{"custom_id": ..., "body": {"messages": [...]}}`. Lines without an id are identified by
+    their line number.
+    """
+    with open(path, encoding="utf-8") as file:
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            body = request.get("body", request)
+            if "messages" not in body:
+                raise ValueError(f"{path}:{number}: request without messages")
+            yield str(request.get("custom_id", request.get("id", number))), body["messages"]
+
+def load_checkpoint(path: pathlib.Path) -> Set[str]:
+    """
+    Return the ids of the requests already answered in an output file.
+
+    A line cut short by a crash is removed, so that the file can be appended to again.
+    """
+    done: Set[str] = set()
+    if not path.exists():
+        return done
+    valid = 0
+    with open(path, "rb") as file:
+        for line in file:
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                break
+            valid += len(line)
+    if valid < path.stat().st_size:
+        with open(path, "rb+") as file:
+            file.truncate(valid)
+    return done
+
+def run_batch(
+    engine: LocalEngine,
+    model: str,
+    input_path: Any,
+    output_path: Any,
+    concurrency: Optional[int] = None,
+    checkpoint_every: int = 100,
+    progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    **kwargs: Any
+) -> Dict[str, Any]:
+    """
+    Complete every conversation of a JSONL file, appending one result per line to another.
+
+    Results are written as they finish, as `{"id": ..., "response": {...}}` or
+    `{"id": ..., "error": "..."}`, and synced to disk every `checkpoint_every` results. Requests
+    already present in the output file are skipped, so a crashed run resumes where it stopped.
+
+    Args:
+        engine (LocalEngine): The engine generating the completions.
+        model (str): The name of the model.
+        input_path (str | pathlib.Path): The JSONL file of requests.
+        output_path (str | pathlib.Path): The JSONL file of results.
+        concurrency (Optional[int]): Number of conversations generated at the same time.
+        checkpoint_every (int): Number of results between two syncs of the output file.
+        progress (Optional[Callable[[Dict[str, Any]], None]]): Called with the statistics after every checkpoint.
+        **kwargs: Options of `create`, such as `max_tokens` or `temperature`, shared by every request.
+
+    Returns:
+        Dict[str, Any]: Aggregate statistics: completed and failed requests, skipped ones done
+            by an earlier run, token counts and throughput.
+    """
+    input_path, output_path = pathlib.Path(input_path), pathlib.Path(output_path)
+    done = load_checkpoint(output_path)
+    pending = []
+    stats = {
+        "completed": 0,
+        "failed": 0,
+        "skipped": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+    }
+
+    def requests() -> Iterator[Messages]:
+        for request_id, messages in read_requests(input_path):
+            if request_id in done:
+                stats["skipped"] += 1
+                continue
+            pending.append(request_id)
+            yield messages
+
+    def checkpoint(file) -> None:
+        file.flush()
+        os.fsync(file.fileno())
+        elapsed = time.perf_counter() - start
+        stats["elapsed"] = elapsed
+        stats["requests_per_second"] = (stats["completed"] + stats["failed"]) / elapsed if elapsed else 0.0
+        stats["completion_tokens_per_second"] = stats["completion_tokens"] / elapsed if elapsed else 0.0
+        stats["tokens_per_second"] = (stats["prompt_tokens"] + stats["completion_tokens"]) / elapsed if elapsed else 0.0
+        if progress is not None:
+            progress(stats)
+
+    start = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as file:
+        for index, result in engine.chat.completions.iter_batch(requests(), model, concurrency=concurrency, **kwargs):
+            if isinstance(result, Exception):
+                stats["failed"] += 1
+                line = {"id": pending[index], "error": f"{result.__class__.__name__}: {result}"}
+            else:
+                stats["completed"] += 1
+                usage = result.usage or {}
+                stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+                stats["completion_tokens"] += usage.get("completion_tokens", 0)
+                line = {"id": pending[index], "response": result.to_json()}
+            file.write(json.dumps(line, ensure_ascii=False) + "\n")
+            if (stats["completed"] + stats["failed"]) % checkpoint_every == 0:
+                checkpoint(file)
+        checkpoint(file)
+    return stats
+
+__all__ = ['run_batch', 'read_requests', 'load_checkpoint']
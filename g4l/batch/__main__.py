@@ -0,0 +1,46 @@
+import sys
+import json
+import argparse
+
+from ..local import LocalEngine
+from . import run_batch
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Complete a JSONL file of conversations with a local model.")
+    parser.add_argument("input", help="JSONL file with one {\"id\", \"messages\"} request per line.")
+    parser.add_argument("output", help="JSONL file the results are appended to. An interrupted run resumes from it.")
+    parser.add_argument("--model", required=True, help="Model to use (file name without '.gguf').")
+    parser.add_argument("--gpu-layers", type=int, default=0, help="Number of layers to offload to the GPU, -1 for all.")
+    parser.add_argument("--cores", type=int, default=None, help="Number of CPU cores to use.")
+    parser.add_argument("--context-window", type=int, default=4900, help="Context window size.")
+    parser.add_argument("--batch-size", type=int, default=8, help="Number of conversations decoded together.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes, each decoding its own batches.")
+    parser.add_argument("--max-tokens", type=int, default=None, help="Maximum number of tokens per completion.")
+    parser.add_argument("--temperature", type=float, default=None, help="Sampling temperature.")
+    parser.add_argument("--checkpoint-every", type=int, default=100, help="Results between two syncs of the output file.")
+    args = parser.parse_args()
+
+    engine = LocalEngine(
+        gpu_layers=args.gpu_layers,
+        cores=args.cores,
+        context_window=args.context_window,
+        batching=args.workers is not None,
+        batch_size=args.batch_size,
+        workers=args.workers,
+    )
+    try:
+        report = lambda stats: print(
+            f"{stats['completed']} completed, {stats['failed']} failed: {stats['requests_per_second']:.2f} req/s, "
+            f"{stats['completion_tokens_per_second']:.1f} tokens/s", file=sys.stderr
+        )
+        options = {key: value for key, value in (("max_tokens", args.max_tokens), ("temperature", args.temperature)) if value is not None}
+        stats = run_batch(
+            engine, args.model, args.input, args.output,
+            checkpoint_every=args.checkpoint_every, progress=report, **options
+        )
+        print(json.dumps(stats, indent=2))
+    finally:
+        engine.close()
+
+if __name__ == "__main__":
+    main()
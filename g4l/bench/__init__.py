@@ -0,0 +1,408 @@
+import os
+import re
+import sys
+import json
+import time
+import pathlib
+import platform
+import subprocess
+import tempfile
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from ..typing import Messages
+from ..local import LocalEngine, iter_response, iter_raw
+from ..local._context import approximate_tokens
+from ..local._store import VectorStore
+from ..local._ann import IVFIndex, MIN_ROWS
+from ..local._bm25 import BM25Index
+
+# What the stand-in model "generates": counting, so that stop sequences such as " 50 " are met
+COUNTING = " ".join(str(number) for number in range(1, 10001))
+
+# Run in a fresh interpreter: time to import the package, and which heavy dependencies it pulled in
+IMPORT_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import g4l.local
+elapsed = time.perf_counter() - start
+heavy = {name.split('.')[0] for name in sys.modules} & {'llama_cpp', 'llama_index', 'sentence_transformers', 'torch', 'numpy'}
+print(json.dumps([elapsed, sorted(heavy)]))
+"""
+
+class FakeProvider:
+    """
+    A stand-in for `LocalProvider` that generates text without a model, at a controlled rate.
+
+    It waits `load_time` on the first request to a model, evaluates prompts at
+    `prompt_tokens_per_second` and then yields one word per token at `tokens_per_second`,
+    filling the same statistics as the real engine. Benchmarks run against it measure the
+    Python layers of g4l alone, reproducibly and without a model or a GPU.
+
+    Args:
+        tokens_per_second (Optional[float]): Decode speed. Unlimited if None.
+        prompt_tokens_per_second (Optional[float]): Prompt evaluation speed. Unlimited if None.
+        load_time (float): Seconds the first request to a model waits, as if loading it.
+        text (str): The generated text, split into one token per word.
+        parallel (int): Generations at the same time per model, like the generation lock of a pooled model.
+    """
+
+    def __init__(self, tokens_per_second: Optional[float] = 200.0, prompt_tokens_per_second: Optional[float] = 2000.0,
+                 load_time: float = 0.2, text: str = COUNTING, parallel: int = 1) -> None:
+        self.tokens_per_second = tokens_per_second
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.load_time = load_time
+        self.tokens = re.findall(r"\s*\S+", text)
+        self.parallel = parallel
+        self.loaded: Dict[str, threading.Semaphore] = {}
+        self._lock = threading.Lock()
+
+    def load_model(self, model: str, model_pool: Any = None, **kwargs: Any) -> float:
+        """Simulate loading a model, returning the time it took (0 if it was loaded already)."""
+        with self._lock:
+            if model in self.loaded:
+                return 0.0
+            time.sleep(self.load_time)
+            self.loaded[model] = threading.Semaphore(self.parallel)
+            return self.load_time
+
+    def unload(self, model: Optional[str] = None) -> int:
+        with self._lock:
+            models = list(self.loaded) if model is None else [model] if model in self.loaded else []
+            for name in models:
+                del self.loaded[name]
+            return len(models)
+
+    def create_completion(self, model: str, messages: Messages, document_retriever: Any = None,
+                          model_pool: Any = None, stats: Optional[Dict[str, Any]] = None, **kwargs: Any) -> Iterator[str]:
+        stats = {} if stats is None else stats
+        if document_retriever:
+            start = time.perf_counter()
+            stats['context'] = {}
+            messages[-1]['content'] = document_retriever.retrieve_for_llm(
+                messages[-1]['content'], kwargs.get('context_budget'), approximate_tokens, stats['context']
+            )
+            stats['retrieval_time'] = time.perf_counter() - start
+        stats['load_time'] = self.load_model(model)
+        slots = self.loaded[model]
+        with slots:
+            start = time.perf_counter()
+            prompt_tokens = sum(approximate_tokens(message['content'] or '') for message in messages)
+            if self.prompt_tokens_per_second:
+                time.sleep(prompt_tokens / self.prompt_tokens_per_second)
+            max_tokens = kwargs.get('max_tokens', 4900)
+            stats['prompt_tokens'], stats['completion_tokens'] = prompt_tokens, 0
+            first_token_time = None
+            try:
+                for index, token in enumerate(itertools.islice(self.tokens, max_tokens)):
+                    if self.tokens_per_second:
+                        # Pace against the start, so that sleep overshoot does not accumulate
+                        delay = (first_token_time or start) + index / self.tokens_per_second - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                    if first_token_time is None:
+                        first_token_time = time.perf_counter()
+                        stats['prompt_eval_time'] = first_token_time - start
+                    stats['completion_tokens'] += 1
+                    stats['decode_time'] = time.perf_counter() - first_token_time
+                    yield token
+                stats['finish_reason'] = 'length' if max_tokens <= len(self.tokens) else 'stop'
+            finally:
+                stats.setdefault('finish_reason', 'stop')
+
+def summarize(samples: Sequence[float]) -> Dict[str, float]:
+    """
+    Summarize measurements with their percentiles.
+    """
+    values = np.asarray(samples, dtype=np.float64)
+    if not len(values):
+        return {"n": 0}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        "n": len(values),
+        "mean": float(values.mean()),
+        "min": float(values.min()),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "max": float(values.max()),
+    }
+
+def stream_request(engine: LocalEngine, model: str, content: str, **kwargs: Any) -> Dict[str, Any]:
+    """
+    Stream one request, timing the first text and the whole request as seen by the caller.
+    """
+    start = time.perf_counter()
+    first = None
+    for chunk in engine.chat.completions.create([{"role": "user", "content": content}], model, stream=True, **kwargs):
+        if first is None and chunk.choices[0].delta.content:
+            first = time.perf_counter()
+    end = time.perf_counter()
+    return {
+        "time_to_first_token": None if first is None else first - start,
+        "total_time": end - start,
+        "usage": chunk.usage,
+        "timings": chunk.timings,
+        "finish_reason": chunk.choices[0].finish_reason,
+    }
+
+def bench_load(engine: LocalEngine, model: str, repeat: int = 3, **kwargs: Any) -> Dict[str, Any]:
+    """
+    Time to first token of a request that loads the model, and of one that finds it loaded.
+    """
+    cold, warm, load = [], [], []
+    for _ in range(repeat):
+        unload = getattr(engine.provider, "unload", None)
+        if unload is not None:
+            unload(model)
+        else:
+            engine.unload(model)
+        result = stream_request(engine, model, "Hello", max_tokens=1)
+        cold.append(result["time_to_first_token"])
+        load.append(result["timings"]["load_time"] or 0.0)
+        warm.append(stream_request(engine, model, "Hello", max_tokens=1)["time_to_first_token"])
+    return {
+        "cold_time_to_first_token_seconds": summarize(cold),
+        "warm_time_to_first_token_seconds": summarize(warm),
+        "load_time_seconds": summarize(load),
+    }
+
+def bench_ttft(engine: LocalEngine, model: str, requests: int = 20, **kwargs: Any) -> Dict[str, Any]:
+    """
+    Time to first token and total time of short streamed requests to a loaded model.
+    """
+    engine.load(model)
+    results = [stream_request(engine, model, "Write one sentence about the sea.", max_tokens=16) for _ in range(requests)]
+    return {
+        "time_to_first_token_seconds": summarize([result["time_to_first_token"] for result in results]),
+        "total_time_seconds": summarize([result["total_time"] for result in results]),
+    }
+
+def bench_streaming(engine: Optional[LocalEngine] = None, model: Optional[str] = None, chunks: int = 10000,
+                    repeat: int = 5, **kwargs: Any) -> Dict[str, Any]:
+    """
+    Overhead per token of the response stream, against iterating over the same tokens directly:
+    completion objects, serialized server-sent events built from them, and the raw fast path.
+    """
+    tokens = [f" token{index}" for index in range(chunks)]
+    variants = {
+        "stream": lambda: iter_response(iter(tokens), True),
+        "stream_stop": lambda: iter_response(iter(tokens), True, stop=["never-generated"]),
+        "no_stream": lambda: iter_response(iter(tokens), False),
+        "stream_sse": lambda: (
+            f"data: {json.dumps(chunk.to_json())}\n\n".encode() for chunk in iter_response(iter(tokens), True)
+        ),
+        "raw_text": lambda: iter_raw(iter(tokens), "text"),
+        "raw_sse": lambda: iter_raw(iter(tokens), "sse"),
+        "raw_sse_coalesced": lambda: iter_raw(iter(tokens), "sse", chunk_size=32),
+    }
+    results = {name: [] for name in variants}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in iter(tokens):
+            pass
+        baseline = time.perf_counter() - start
+        for name, variant in variants.items():
+            start = time.perf_counter()
+            for _ in variant():
+                pass
+            results[name].append((time.perf_counter() - start - baseline) / chunks * 1e6)
+    return {f"{name}_per_chunk_us": summarize(samples) for name, samples in results.items()}
+
+def bench_retrieval(engine: Optional[LocalEngine] = None, model: Optional[str] = None,
+                    sizes: Sequence[int] = (1000, 5000, 20000), dim: int = 384, queries: int = 50,
+                    top_k: int = 4, seed: int = 0, **kwargs: Any) -> Dict[str, Any]:
+    """
+    Latency of exact, IVF and BM25 search against the number of indexed chunks, on synthetic embeddings.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((64, dim)).astype(np.float32)
+    vocabulary = [f"w{index}" for index in range(5000)]
+    normalize = lambda vectors: vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        store = VectorStore(f"{directory}/vectors")
+        keyword_index = BM25Index(f"{directory}/bm25")
+        for size in sorted(sizes):
+            count = size - len(store)
+            if count > 0:
+                vectors = centroids[rng.integers(0, len(centroids), count)] + 0.5 * rng.standard_normal((count, dim))
+                words = rng.choice(vocabulary, (count, 64))
+                store.add(
+                    [f"chunk-{len(store) + index}" for index in range(count)],
+                    normalize(vectors.astype(np.float32)),
+                    [{"text": " ".join(row)} for row in words],
+                )
+                store.flush()
+                keyword_index.update(store)
+            query_vectors = normalize(
+                centroids[rng.integers(0, len(centroids), queries)] + 0.5 * rng.standard_normal((queries, dim))
+            ).astype(np.float32)
+            query_texts = [" ".join(rng.choice(vocabulary, 4)) for _ in range(queries)]
+            timings = {"exact": [], "bm25": []}
+            for vector, text in zip(query_vectors, query_texts):
+                start = time.perf_counter()
+                store.search(vector[None], top_k)
+                timings["exact"].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                keyword_index.search(store, text, top_k)
+                timings["bm25"].append(time.perf_counter() - start)
+            result = {f"{name}_seconds": summarize(samples) for name, samples in timings.items()}
+            if size >= MIN_ROWS:
+                ann_index = IVFIndex(f"{directory}/ivf-{size}")
+                start = time.perf_counter()
+                ann_index.build(store)
+                result["ivf_build_seconds"] = time.perf_counter() - start
+                samples = []
+                for vector in query_vectors:
+                    start = time.perf_counter()
+                    ann_index.search(store, vector[None], top_k)
+                    samples.append(time.perf_counter() - start)
+                result["ivf_seconds"] = summarize(samples)
+            results[str(size)] = result
+    return results
+
+def bench_concurrency(engine: LocalEngine, model: str, levels: Sequence[int] = (1, 2, 4, 8),
+                      requests: int = 16, max_tokens: int = 32, **kwargs: Any) -> Dict[str, Any]:
+    """
+    Latency and throughput of requests issued by an increasing number of concurrent callers.
+    """
+    engine.load(model)
+    results = {}
+    for level in levels:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(level) as executor:
+            runs = list(executor.map(
+                lambda _: stream_request(engine, model, "Count to one hundred.", max_tokens=max_tokens), range(requests)
+            ))
+        elapsed = time.perf_counter() - start
+        tokens = sum(run["usage"]["completion_tokens"] for run in runs)
+        results[str(level)] = {
+            "latency_seconds": summarize([run["total_time"] for run in runs]),
+            "time_to_first_token_seconds": summarize([run["time_to_first_token"] for run in runs]),
+            "requests_per_second": requests / elapsed,
+            "tokens_per_second": tokens / elapsed,
+        }
+    return results
+
+def bench_stop(engine: LocalEngine, model: str, repeat: int = 5, stop_at: int = 50, **kwargs: Any) -> Dict[str, Any]:
+    """
+    How quickly a long generation ends once a stop sequence appears, and how many tokens it decodes past it.
+    """
+    engine.load(model)
+    latencies, overrun = [], []
+    for _ in range(repeat):
+        result = stream_request(
+            engine, model, f"Count from 1 to 1000, separated by spaces.", max_tokens=4000, stop=[f" {stop_at} "]
+        )
+        latencies.append(result["total_time"])
+        overrun.append(result["usage"]["completion_tokens"] - stop_at)
+    return {
+        "total_time_seconds": summarize(latencies),
+        "overrun_tokens": summarize(overrun),
+    }
+
+def bench_import(engine: Optional[LocalEngine] = None, model: Optional[str] = None, repeat: int = 5,
+                 **kwargs: Any) -> Dict[str, Any]:
+    """
+    Time to import `g4l.local` in a fresh process, as paid by every short-lived CLI run or worker.
+    """
+    root = str(pathlib.Path(__file__).resolve().parents[2])
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, (root, os.environ.get("PYTHONPATH"))))}
+    imports, processes = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_PROBE], env=env, capture_output=True, text=True, check=True
+        ).stdout
+        processes.append(time.perf_counter() - start)
+        elapsed, heavy = json.loads(output.splitlines()[-1])
+        imports.append(elapsed)
+    return {
+        "import_seconds": summarize(imports),
+        "process_seconds": summarize(processes),
+        "heavy_modules": heavy,
+    }
+
+SCENARIOS: Dict[str, Callable[..., Dict[str, Any]]] = {
+    "import": bench_import,
+    "load": bench_load,
+    "ttft": bench_ttft,
+    "streaming": bench_streaming,
+    "retrieval": bench_retrieval,
+    "concurrency": bench_concurrency,
+    "stop": bench_stop,
+}
+
+def run(engine: LocalEngine, model: str, scenarios: Optional[List[str]] = None, **kwargs: Any) -> Dict[str, Any]:
+    """
+    Run benchmark scenarios.
+
+    Args:
+        engine (LocalEngine): The engine to measure, e.g. `LocalEngine(provider=FakeProvider())`.
+        model (str): The model requested from the engine.
+        scenarios (Optional[List[str]]): Names of the scenarios to run, all of `SCENARIOS` if None.
+        **kwargs: Passed on to every scenario.
+
+    Returns:
+        Dict[str, Any]: The environment and, per scenario, its measurements summarized with percentiles.
+    """
+    results = {
+        "meta": {
+            "model": model,
+            "provider": getattr(engine.provider, "__name__", engine.provider.__class__.__name__),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "created": int(time.time()),
+        },
+        "scenarios": {},
+    }
+    for name in scenarios or SCENARIOS:
+        if name not in SCENARIOS:
+            raise ValueError(f"Unknown scenario '{name}', expected one of {', '.join(SCENARIOS)}")
+        start = time.perf_counter()
+        results["scenarios"][name] = SCENARIOS[name](engine, model, **kwargs)
+        results["meta"][f"{name}_seconds"] = time.perf_counter() - start
+    return results
+
+def flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    """
+    Return the comparable metrics of results by path: the median of summaries, and plain numbers.
+    """
+    metrics = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict) and "p50" in value:
+            metrics[path] = value["p50"]
+        elif isinstance(value, dict):
+            metrics.update(flatten(value, f"{path}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[path] = value
+    return metrics
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2) -> List[Dict[str, Any]]:
+    """
+    Find the metrics that got worse than in a baseline by more than `tolerance` (relative).
+    Metrics measured per second are better when higher, all others when lower.
+
+    Returns:
+        List[Dict[str, Any]]: The regressions, with their baseline and current values.
+    """
+    current, previous = flatten(results["scenarios"]), flatten(baseline["scenarios"])
+    regressions = []
+    for path, value in current.items():
+        reference = previous.get(path)
+        if not reference:
+            continue
+        change = (value - reference) / abs(reference)
+        if path.endswith("per_second"):
+            change = -change
+        if change > tolerance:
+            regressions.append({"metric": path, "baseline": reference, "current": value, "change": round(change, 4)})
+    return regressions
+
+__all__ = ['FakeProvider', 'SCENARIOS', 'run', 'compare', 'summarize']
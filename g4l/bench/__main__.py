@@ -0,0 +1,45 @@
+import sys
+import json
+import argparse
+
+from ..local import LocalEngine
+from . import FakeProvider, SCENARIOS, run, compare
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark g4l, against a real model or a deterministic stand-in.")
+    parser.add_argument("--backend", choices=("fake", "llama"), default="fake", help="Stand-in model, or a real model from the models directory.")
+    parser.add_argument("--model", default="fake", help="Model to use (file name without '.gguf') with the llama backend.")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="Scenario to run. Can be repeated, all by default.")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Decode speed of the stand-in model, 0 for unlimited.")
+    parser.add_argument("--load-time", type=float, default=0.2, help="Load time of the stand-in model in seconds.")
+    parser.add_argument("--gpu-layers", type=int, default=0, help="Number of layers to offload to the GPU, -1 for all.")
+    parser.add_argument("--output", default=None, help="File the results are written to, as JSON. Printed if not set.")
+    parser.add_argument("--baseline", default=None, help="Results of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative change of a metric that counts as a regression.")
+    args = parser.parse_args()
+
+    if args.backend == "fake":
+        engine = LocalEngine(provider=FakeProvider(args.tokens_per_second or None, load_time=args.load_time))
+    else:
+        engine = LocalEngine(gpu_layers=args.gpu_layers)
+    results = run(engine, args.model, args.scenario)
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as file:
+            file.write(output)
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(
+                f"Regression in {regression['metric']}: {regression['baseline']:.6g} -> {regression['current']:.6g} "
+                f"({regression['change']:+.1%})", file=sys.stderr
+            )
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,273 @@
-import random, string, time, re
+import json, random, string, time, itertools, threading
+from concurrent.futures import Executor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-from ..typing import Union, Iterator, Messages
-from ..stubs  import ChatCompletion, ChatCompletionChunk
-from ._engine import LocalProvider
-from ._docs   import DocumentRetriever
+from importlib import import_module
+from typing import Callable, Iterable, TYPE_CHECKING
+from ..typing import Union, Iterator, AsyncIterator, List, Dict, Tuple, Messages
+from ..stubs  import ChatCompletion, ChatCompletionChunk, ChunkTemplate
+from ._engine import LocalProvider, get_model_path, get_load_params, get_context_budget
+from ._grammar import get_json_schema
+from ._metrics import MetricsRegistry, get_usage, get_timings
+from ._context import ContextPacker, approximate_tokens
+from ._history import HistoryManager
+from ._pool   import ModelPool, default_pool
+from ._async  import iter_in_executor
+from ._workers import WorkerPool
+from ._scheduler import Scheduler, STOP_REASONS
+
+if TYPE_CHECKING:
+    from ._docs   import DocumentRetriever
+    from ._store  import VectorStore
+    from ._ann    import IVFIndex
+    from ._bm25   import BM25Index
+    from ._responses import ResponseCache
+
+# Retrieval classes and the module they are imported from on first use, which keeps numpy out
+# of `import g4l.local` for engines that do not retrieve documents or cache responses
+LAZY_IMPORTS = {
+    "DocumentRetriever": "._docs",
+    "VectorStore": "._store",
+    "IVFIndex": "._ann",
+    "BM25Index": "._bm25",
+    "ResponseCache": "._responses",
+}
+
+def __getattr__(name: str):
+    if name in LAZY_IMPORTS:
+        value = getattr(import_module(LAZY_IMPORTS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 IterResponse = Iterator[Union[ChatCompletion, ChatCompletionChunk]]
 
-def read_json(text: str) -> dict:
-    match = re.search(r"```(json|)\n(?P<code>[\S\s]+?)\n```", text)
-    if match:
-        return match.group("code")
-    return text
+class StopMatcher():
+    """
+    Incrementally finds stop sequences in streamed text.
+
+    Only a tail window of at most `max(len(stop)) - 1` characters is ever re-scanned, so the
+    cost per chunk is independent of the length of the output. Text that could still turn
+    into a stop sequence is held back until the next chunk decides it.
+    """
+    def __init__(self, stop: list = None):
+        self.stop = [word for word in stop or [] if word]
+        self.window = max((len(word) for word in self.stop), default=0)
+        self.prefixes = {word[:size] for word in self.stop for size in range(1, len(word))}
+        self.initials = {word[0] for word in self.stop}
+        self.pending = ""
+        self.stopped = False
+
+    def feed(self, chunk: str) -> str:
+        """Return the part of `chunk` (plus held back text) that is safe to emit."""
+        if not self.stop:
+            return chunk
+        text = self.pending + chunk
+        first = self._find(text)
+        # Hold back the longest tail that may still grow into a stop sequence
+        hold = 0
+        for index in range(max(len(text) - self.window + 1, 0), len(text)):
+            if text[index] in self.initials and text[index:] in self.prefixes:
+                hold = len(text) - index
+                break
+        if first != -1 and first < len(text) - hold:
+            self.pending = ""
+            self.stopped = True
+            return text[:first]
+        self.pending = text[len(text) - hold:] if hold else ""
+        return text[:len(text) - hold]
+
+    def flush(self) -> str:
+        """Return the held back text once the stream has ended."""
+        text, self.pending = self.pending, ""
+        first = self._find(text)
+        if first != -1:
+            self.stopped = True
+            return text[:first]
+        return text
+
+    def _find(self, text: str) -> int:
+        first = -1
+        for word in self.stop:
+            found = text.find(word)
+            if found != -1 and (first == -1 or found < first):
+                first = found
+        return first
+
+class JsonEndMatcher():
+    """
+    Finds the end of the top-level JSON value in streamed text, so that JSON mode can stop
+    generating as soon as the value is complete instead of running on until the end token.
+    Containers and strings end at their closing character, literals when they are spelled
+    out, and numbers at the first character after them.
+    """
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.closed = False
+        self.scalar = ""
+
+    def feed(self, chunk: str) -> str:
+        """Return the part of `chunk` up to and including the end of the top-level value."""
+        for index, char in enumerate(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 0:
+                        self.closed = True
+                        return chunk[:index + 1]
+            elif self.depth == 0 and self.scalar and not (char.isalnum() or char in "+-."):
+                # A top-level number ends with the first character that cannot continue it
+                self.closed = True
+                return chunk[:index]
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.closed = True
+                    return chunk[:index + 1]
+            elif self.depth == 0 and not char.isspace():
+                self.scalar += char
+                if self.scalar in ("true", "false", "null"):
+                    self.closed = True
+                    return chunk[:index + 1]
+        return chunk
+
+def iter_text(response: Iterator[str], response_format: dict = None, stop: list = None,
+              state: dict = None) -> Iterator[str]:
+    """
+    Yield the generated text up to the first stop sequence, or the end of the JSON value in JSON mode.
+    `state` receives when the first text arrived and whether the text was stopped early.
+    """
+    state = {} if state is None else state
+    matcher = StopMatcher(stop)
+    # The grammar guarantees valid JSON, but allows trailing whitespace before the end token
+    json_end = JsonEndMatcher() if get_json_schema(response_format) is not None else None
+    for chunk in response:
+        if 'first_chunk_time' not in state:
+            state['first_chunk_time'] = time.perf_counter()
+        chunk = str(chunk)
+        if json_end is not None:
+            chunk = json_end.feed(chunk)
+        chunk = matcher.feed(chunk)
+        done = matcher.stopped or (json_end is not None and json_end.closed)
+        if done and not matcher.stopped:
+            chunk += matcher.flush()
+        if chunk:
+            yield chunk
+        if done:
+            state['stopped'] = True
+            # Stop generating right away instead of when the iterator is garbage collected
+            if hasattr(response, "close"):
+                response.close()
+            return
+    chunk = matcher.flush()
+    if chunk:
+        yield chunk
+    if matcher.stopped:
+        state['stopped'] = True
+
+def finish_completion(completion_id: str, created: int, stream: bool, content: str, start: float,
+                      state: dict, stats: dict = None, on_finish: Callable = None) -> Union[ChatCompletion, ChatCompletionChunk]:
+    """
+    Build the last chunk (or the completion) of a response, carrying its finish reason, usage and timings.
+    """
+    stats = {} if stats is None else stats
+    # Unless it stopped on a stop sequence, the engine knows whether it stopped at the end token or the token limit
+    finish_reason = "stop" if state.get('stopped') else stats.get("finish_reason") or "stop"
+    first_chunk_time = state.get('first_chunk_time')
+    extra = (
+        stats.get("cache"),
+        stats.get("speculative"),
+        get_usage(stats),
+        get_timings(stats, None if first_chunk_time is None else first_chunk_time - start, time.perf_counter() - start),
+        stats.get("response_cache")
+    )
+    if stream:
+        final = ChatCompletionChunk(None, finish_reason, completion_id, created, *extra)
+    else:
+        final = ChatCompletion(content, finish_reason, completion_id, created, *extra)
+    if on_finish is not None:
+        on_finish(final)
+    return final
 
 def iter_response(
     response: Iterator[str],
     stream: bool,
     response_format: dict = None,
-    max_tokens: int = None,
-    stop: list = None) -> IterResponse:
+    stop: list = None,
+    stats: dict = None,
+    on_finish: Callable = None) -> IterResponse:
     
-    content = ""
-    finish_reason = None
+    start = time.perf_counter()
+    state = {}
     completion_id = ''.join(random.choices(string.ascii_letters + string.digits, k=28))
-    for idx, chunk in enumerate(response):
-        content += str(chunk)
-        if max_tokens is not None and idx + 1 >= max_tokens:
-            finish_reason = "length"
-        first = -1
-        word = None
-        if stop is not None:
-            for word in list(stop):
-                first = content.find(word)
-                if first != -1:
-                    content = content[:first]
-                    break
-            if stream and first != -1:
-                first = chunk.find(word)
-                if first != -1:
-                    chunk = chunk[:first]
-                else:
-                    first = 0
-        if first != -1:
-            finish_reason = "stop"
+    # Like OpenAI, every chunk of a completion carries the same creation time
+    created = int(time.time())
+    content = []
+    for chunk in iter_text(response, response_format, stop, state):
         if stream:
-            yield ChatCompletionChunk(chunk, None, completion_id, int(time.time()))
-        if finish_reason is not None:
-            break
-    finish_reason = "stop" if finish_reason is None else finish_reason
-    if stream:
-        yield ChatCompletionChunk(None, finish_reason, completion_id, int(time.time()))
-    else:
-        if response_format is not None and "type" in response_format:
-            if response_format["type"] == "json_object":
-                content = read_json(content)
-        yield ChatCompletion(content, finish_reason, completion_id, int(time.time()))
+            yield ChatCompletionChunk(chunk, None, completion_id, created)
+        else:
+            content.append(chunk)
+    yield finish_completion(completion_id, created, stream, "".join(content), start, state, stats, on_finish)
+
+def iter_raw(
+    response: Iterator[str],
+    raw: str,
+    response_format: dict = None,
+    stop: list = None,
+    stats: dict = None,
+    on_finish: Callable = None,
+    model: str = None,
+    chunk_size: int = None,
+    chunk_interval: float = None) -> Iterator[Union[str, bytes]]:
+    """
+    A streaming fast path that skips building a `ChatCompletionChunk` per token.
+
+    With `raw="text"` the generated text is yielded as plain strings. With `raw="sse"` it is
+    yielded as ready-to-send server-sent events encoded from a `ChunkTemplate`, followed by
+    the final chunk (with the finish reason, usage and timings) and `data: [DONE]`.
+
+    After the first token, tokens are coalesced into one chunk until it holds `chunk_size`
+    characters or, when a token arrives, `chunk_interval` seconds passed since the last chunk.
+    Every token is sent on its own if neither is set.
+    """
+    if raw not in ("text", "sse"):
+        raise ValueError(f"Unknown raw streaming mode '{raw}', expected 'text' or 'sse'")
+    start = time.perf_counter()
+    state = {}
+    completion_id = ''.join(random.choices(string.ascii_letters + string.digits, k=28))
+    created = int(time.time())
+    template = ChunkTemplate(completion_id, created, model) if raw == "sse" else None
+    coalesce = chunk_size is not None or chunk_interval is not None
+    buffer, buffered, last_sent = [], 0, None
+    for chunk in iter_text(response, response_format, stop, state):
+        if coalesce:
+            buffer.append(chunk)
+            buffered += len(chunk)
+            now = time.perf_counter()
+            # The first token is sent right away, so coalescing does not delay the time to first token
+            if last_sent is not None and (chunk_size is None or buffered < chunk_size) \
+                    and (chunk_interval is None or now - last_sent < chunk_interval):
+                continue
+            chunk, buffer, buffered, last_sent = "".join(buffer), [], 0, now
+        yield chunk if template is None else template.sse(chunk)
+    if buffer:
+        chunk = "".join(buffer)
+        yield chunk if template is None else template.sse(chunk)
+    final = finish_completion(completion_id, created, True, None, start, state, stats, on_finish)
+    if template is not None:
+        final.model = model
+        yield f"data: {json.dumps(final.to_json())}\n\n".encode()
+        yield b"data: [DONE]\n\n"
 
 def filter_none(**kwargs):
     for key in list(kwargs.keys()):
@@ -71,7 +284,27 @@ class LocalEngine():
         use_mlock: bool = False,
         offload_kqv: bool = True,
         context_window: int = 4900, 
-        document_retriever: DocumentRetriever = None, **kwargs) -> None:
+        document_retriever: "DocumentRetriever" = None,
+        context_budget: int = None,
+        history: HistoryManager = None,
+        response_cache: "ResponseCache" = None,
+        model_pool: ModelPool = None,
+        max_memory: int = None,
+        max_models: int = None,
+        prefix_cache: bool = False,
+        prefix_cache_size: int = 2 << 30,
+        prefix_cache_dir: str = None,
+        batching: bool = False,
+        batch_size: int = 4,
+        workers: int = None,
+        cores_per_worker: int = None,
+        speculative: str = None,
+        draft_model: str = None,
+        draft_tokens: int = 8,
+        metrics: Callable = None,
+        scheduler: Scheduler = None,
+        provider: LocalProvider = LocalProvider,
+        preload: List[str] = None, **kwargs) -> None:
         
         self.gpu_layers = gpu_layers
         self.cores = cores
@@ -79,9 +312,130 @@ class LocalEngine():
         self.use_mlock = use_mlock
         self.offload_kqv = offload_kqv
         self.context_window = context_window
-        self.document_retriever: DocumentRetriever = document_retriever
+        self.document_retriever: "DocumentRetriever" = document_retriever
+        # Maximum number of tokens of retrieved context, on top of fitting the context window
+        self.context_budget = context_budget
+        # Keeps long conversations within the context window, summarizing older turns with the model
+        self.history: HistoryManager = history
+        if history is not None:
+            history.summarizer = self._generate
+        # Answers repeated (or, with a similarity threshold, rephrased) deterministic requests without generating
+        self.response_cache: "ResponseCache" = response_cache
+        if response_cache is not None and response_cache.embed is None and document_retriever is not None:
+            response_cache.embed = document_retriever._embed_query
+        if model_pool is None:
+            # Share the process-wide pool unless this engine asks for its own budget
+            if max_memory is None and max_models is None:
+                model_pool = default_pool
+            else:
+                model_pool = ModelPool(max_memory, max_models)
+        self.pool: ModelPool = model_pool
+        self.prefix_cache = prefix_cache
+        self.prefix_cache_size = prefix_cache_size
+        self.prefix_cache_dir = prefix_cache_dir
+        self.batching = batching
+        self.batch_size = batch_size
+        self.speculative = speculative
+        self.draft_model = draft_model
+        self.draft_tokens = draft_tokens
+        # Called with (model, completion) once a completion finished, e.g. a MetricsRegistry
+        self.metrics = metrics
+        # Orders generations by priority, bounds them per model and stops them at their deadline
+        self.scheduler: Scheduler = Scheduler() if scheduler is None else scheduler
+        # Generates the tokens in this process, replaced by a stand-in model when benchmarking
+        self.provider = provider
+        # Spread requests over processes pinned to their own cores instead of one in-process model
+        self.worker_pool: WorkerPool = WorkerPool(workers, cores_per_worker) if workers else None
         self.chat: Chat = Chat(self)
-        
+        # Models loaded (and paged in) on a background thread, so that the first request finds them resident
+        self.preload_errors: Dict[str, Exception] = {}
+        self.preload_thread: threading.Thread = None
+        if preload:
+            self.preload_thread = threading.Thread(
+                target=self._preload, args=(list(preload),), name="g4l-preload", daemon=True
+            )
+            self.preload_thread.start()
+
+    def _load_params(self) -> dict:
+        return get_load_params(**self._options())
+
+    def load(self, model: str, warm: bool = False) -> None:
+        """
+        Load a model into the pool (or every worker) so that the first request does not pay for it.
+        With `warm`, the model file is also read into the page cache so that its weights are not
+        paged in from disk during the first requests.
+        """
+        options = {**self._options(), 'warm': warm}
+        if self.worker_pool is not None:
+            return self.worker_pool.load(model, **options)
+        self.provider.load_model(model, self.pool, **options)
+
+    def _preload(self, models: List[str]) -> None:
+        for model in models:
+            try:
+                self.load(model, warm=True)
+            except Exception as e:
+                # Surfaced again by the first request to the model
+                self.preload_errors[model] = e
+
+    def wait_preloaded(self, timeout: float = None) -> bool:
+        """Wait until the models passed as `preload` are loaded, returning whether they are."""
+        if self.preload_thread is not None:
+            self.preload_thread.join(timeout)
+            return not self.preload_thread.is_alive()
+        return True
+
+    def _options(self) -> dict:
+        return filter_none(
+            n_gpu_layers=self.gpu_layers,
+            threads=self.cores,
+            use_mmap=self.use_mmap,
+            use_mlock=self.use_mlock,
+            offload_kqv=self.offload_kqv,
+            n_ctx=self.context_window,
+            context_budget=self.context_budget,
+            prefix_cache=self.prefix_cache,
+            prefix_cache_size=self.prefix_cache_size,
+            prefix_cache_dir=self.prefix_cache_dir,
+            batching=self.batching,
+            batch_size=self.batch_size,
+            speculative=self.speculative,
+            draft_model=self.draft_model,
+            draft_tokens=self.draft_tokens
+        )
+
+    def _generate(self, model: str, messages: Messages) -> str:
+        """
+        Generate a deterministic completion, without retrieval or history management.
+
+        It runs outside the scheduler: a background summary must neither take the generation slot
+        of a request nor be preempted by one, and a completion that stopped early raises instead
+        of being returned (and cached) as if it were whole.
+        """
+        options = {**self._options(), 'temperature': 0.0}
+        if self.history is not None:
+            options['max_tokens'] = self.history.summary_words * 2
+        stats = {}
+        if self.worker_pool is not None:
+            text = ''.join(self.worker_pool.create_completion(model, messages, stats, **options))
+        else:
+            text = ''.join(self.provider.create_completion(model, messages, None, self.pool, stats, **options))
+        if stats.get('finish_reason') in STOP_REASONS:
+            raise RuntimeError(f"Generation stopped early: {stats['finish_reason']}")
+        return text
+
+    def close(self) -> None:
+        """Stop the worker processes, if any."""
+        if self.worker_pool is not None:
+            self.worker_pool.close()
+            self.worker_pool = None
+
+    def unload(self, model: str = None) -> int:
+        """Unload a model (or every idle model) from the pool, returning the number unloaded."""
+        if model is None:
+            return self.pool.unload()
+        return self.pool.unload(get_model_path(model), **self._load_params())
+
 class Completions():
     def __init__(self, client: LocalEngine):
         self.client: LocalEngine = client
@@ -96,26 +450,241 @@ class Completions():
         stop: Union[list[str], str] = None,
         **kwargs
     ) -> Union[ChatCompletion, Iterator[ChatCompletionChunk]]:
+        response = self._create(messages, model, stream, response_format, max_tokens, stop, **kwargs)
+        return response if stream else next(response)
+
+    def create_batch(
+        self,
+        messages_list: List[Messages],
+        model: str,
+        response_format: dict = None,
+        max_tokens: int = None,
+        stop: Union[list[str], str] = None,
+        concurrency: int = None,
+        return_exceptions: bool = False,
+        **kwargs
+    ) -> List[Union[ChatCompletion, Exception]]:
+        """
+        Creates completions for many conversations at once, for offline jobs.
+
+        The conversations share the loaded model and are decoded together in continuous batches
+        of `concurrency` sequences (or spread over the worker processes). The longest prompts
+        are started first, so that the batch does not end waiting for one long straggler.
+
+        Args:
+            messages_list (List[Messages]): The conversations to complete.
+            model (str): The name of the model.
+            concurrency (int, optional): Number of conversations generated at the same time.
+                Defaults to `batch_size`, times the number of workers if any.
+                In-process, the model gets a batching context sized for `concurrency` full sequences.
+            return_exceptions (bool): Whether a failed conversation returns its exception in place
+                of a completion, instead of raising it.
+            **kwargs: The other options of `create`.
+
+        Returns:
+            List[Union[ChatCompletion, Exception]]: The completions, in the order of `messages_list`.
+        """
+        order = sorted(
+            range(len(messages_list)),
+            key=lambda index: -sum(len(message['content'] or '') for message in messages_list[index])
+        )
+        results = [None] * len(messages_list)
+        batch = self.iter_batch(
+            (messages_list[index] for index in order), model, response_format, max_tokens, stop, concurrency, **kwargs
+        )
+        for position, result in batch:
+            if isinstance(result, Exception) and not return_exceptions:
+                batch.close()
+                raise result
+            results[order[position]] = result
+        return results
+
+    def iter_batch(
+        self,
+        messages_list: Iterable[Messages],
+        model: str,
+        response_format: dict = None,
+        max_tokens: int = None,
+        stop: Union[list[str], str] = None,
+        concurrency: int = None,
+        **kwargs
+    ) -> Iterator[Tuple[int, Union[ChatCompletion, Exception]]]:
+        """
+        Like `create_batch`, but consumes the conversations lazily and yields every completion
+        as soon as it is done, as `(index, completion)` pairs; failed conversations yield their
+        exception. At most twice `concurrency` conversations are read ahead.
+        """
+        if concurrency is None:
+            concurrency = self.client.batch_size
+            if self.client.worker_pool is not None:
+                concurrency *= len(self.client.worker_pool.in_flight)
+        if self.client.worker_pool is None:
+            # Decode the conversations of the batch together
+            kwargs = {'batching': True, 'batch_size': concurrency, **kwargs}
+        create = lambda messages: self.create(messages, model, False, response_format, max_tokens, stop, **kwargs)
+        conversations = enumerate(messages_list)
+        with ThreadPoolExecutor(concurrency, thread_name_prefix="g4l-batch") as executor:
+            in_flight = {}
+            try:
+                while True:
+                    for index, messages in itertools.islice(conversations, 2 * concurrency - len(in_flight)):
+                        in_flight[executor.submit(create, messages)] = index
+                    if not in_flight:
+                        break
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index = in_flight.pop(future)
+                        error = future.exception()
+                        yield index, future.result() if error is None else error
+            finally:
+                for future in in_flight:
+                    future.cancel()
+
+    def _create(
+        self,
+        messages: Messages,
+        model: str,
+        stream: bool = False,
+        response_format: dict = None,
+        max_tokens: int = None,
+        stop: Union[list[str], str] = None,
+        **kwargs
+    ) -> IterResponse:
         stop = [stop] if isinstance(stop, str) else stop
-        response = LocalProvider.create_completion(
-            model, messages, self.client.document_retriever,
-            **filter_none(
-                max_tokens=max_tokens,
-                stop=stop,
-                n_gpu_layers=self.client.gpu_layers,
-                threads=self.client.cores,
-                use_mmap=self.client.use_mmap,
-                use_mlock=self.client.use_mlock,
-                offload_kqv=self.client.offload_kqv,
-                n_ctx=self.client.context_window
-            ),
+        stats = {}
+        # Streaming fast path, see `iter_raw`
+        raw = {name: kwargs.pop(name) for name in ('raw', 'chunk_size', 'chunk_interval') if name in kwargs}
+        if raw.get('raw') is None:
+            raw = None
+        elif not stream:
+            raise ValueError("raw streaming requires stream=True")
+        # Scheduling, see `Scheduler`
+        priority, cancel = kwargs.pop('priority', 0), kwargs.pop('cancel', None)
+        timeout, deadline = kwargs.pop('timeout', None), kwargs.pop('deadline', None)
+        if deadline is not None:
+            # Given as a `time.time()` timestamp, compared with the monotonic clock
+            deadline = time.monotonic() + deadline - time.time()
+        if timeout is not None:
+            deadline = min(time.monotonic() + timeout, deadline or float('inf'))
+        options = {
+            **self.client._options(),
+            **filter_none(max_tokens=max_tokens, stop=stop, response_format=response_format),
             **kwargs
+        }
+        on_finish = None
+        if self.client.metrics is not None:
+            on_finish = lambda completion: self.client.metrics(model, completion)
+        iterate = lambda response: (
+            iter_response(response, stream, response_format, stop, stats, on_finish) if raw is None else
+            iter_raw(response, response_format=response_format, stop=stop, stats=stats, on_finish=on_finish, model=model, **raw)
         )
-        response = iter_response(response, stream, response_format, max_tokens, stop)
-        return response if stream else next(response)
+        cache, lookup = self.client.response_cache, None
+        if cache is not None and cache.accepts(options):
+            lookup = cache.lookup(model, messages, options, self.client.document_retriever)
+            stats['response_cache'] = lookup.to_json()
+            if lookup.match is not None:
+                stats['finish_reason'] = lookup.finish_reason
+                return iterate(cache.replay(lookup))
+        if self.client.history is not None:
+            messages = self._fit_history(model, messages, options, stats)
+        if self.client.worker_pool is not None:
+            if self.client.document_retriever:
+                # Retrieval stays in this process, only the generation runs in a worker
+                start = time.perf_counter()
+                # The tokenizer lives in the worker, so the budget is estimated from the text length
+                history = [*messages[:-1], {**messages[-1], 'content': ''}]
+                conversation_tokens = sum(approximate_tokens(message['content']) for message in history)
+                budget = get_context_budget(self.client.context_window, conversation_tokens, **options)
+                stats['context'] = {}
+                prompt = self.client.document_retriever.retrieve_for_llm(
+                    messages[-1]['content'], budget, approximate_tokens, stats['context']
+                )
+                # A new last message, the caller's conversation is left as it was
+                messages = [*messages[:-1], {**messages[-1], 'content': prompt}]
+                stats['retrieval_time'] = time.perf_counter() - start
+            generate = lambda: self.client.worker_pool.create_completion(model, messages, stats, **options)
+        else:
+            generate = lambda: self.client.provider.create_completion(
+                model, messages, self.client.document_retriever, self.client.pool, stats, **options
+            )
+        response = iterate(self.client.scheduler.run(model, generate, priority, deadline, cancel, stats))
+        # Raw streams carry no completion objects to record, they are only served from the cache
+        return response if lookup is None or raw is not None else cache.record(lookup, response)
     
+    def _fit_history(self, model: str, messages: Messages, options: dict, stats: dict) -> Messages:
+        # By default the conversation may take half of the context window left by the answer,
+        # the rest is for retrieved documents
+        budget = get_context_budget(self.client.context_window, 0, **options) // 2
+        stats['history'] = {}
+        token_counter = getattr(self.client.provider, 'token_counter', None)
+        if self.client.worker_pool is not None or token_counter is None:
+            # The tokenizer lives in the workers (or the provider has none), estimate from the text length
+            return self.client.history.apply(model, messages, budget, approximate_tokens, stats['history'])
+        with token_counter(model, self.client.pool, stats, **options) as count_tokens:
+            return self.client.history.apply(model, messages, budget, count_tokens, stats['history'])
+
 class Chat():
     completions: Completions
 
     def __init__(self, client: LocalEngine):
-        self.completions = Completions(client)
\ No newline at end of file
+        self.completions = Completions(client)
+
+class AsyncLocalEngine(LocalEngine):
+    """
+    An asyncio variant of `LocalEngine`.
+
+    Inference runs on a dedicated executor and tokens are handed to the event loop through
+    a bounded queue, so a generation never blocks the loop. Cancelling the consuming task
+    stops the generation and frees the model for the next request.
+    """
+    def __init__(
+        self,
+        *args,
+        executor: Executor = None,
+        max_workers: int = None,
+        queue_size: int = 32,
+        **kwargs) -> None:
+
+        super().__init__(*args, **kwargs)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers, thread_name_prefix="g4l")
+        self.executor: Executor = executor
+        self.queue_size = queue_size
+        self.chat: AsyncChat = AsyncChat(self)
+
+class AsyncCompletions():
+    def __init__(self, client: AsyncLocalEngine):
+        self.client: AsyncLocalEngine = client
+        # Runs in the executor, never on the event loop
+        self._completions = Completions(client)
+
+    async def create(
+        self,
+        messages: Messages,
+        model: str,
+        stream: bool = False,
+        response_format: dict = None,
+        max_tokens: int = None,
+        stop: Union[list[str], str] = None,
+        **kwargs
+    ) -> Union[ChatCompletion, AsyncIterator[ChatCompletionChunk]]:
+        # Cancelling the consuming task also stops a request still queued in the scheduler
+        cancel = kwargs.pop('cancel', None) or threading.Event()
+        response = iter_in_executor(
+            lambda: self._completions._create(messages, model, stream, response_format, max_tokens, stop, cancel=cancel, **kwargs),
+            self.client.executor,
+            self.client.queue_size,
+            cancel
+        )
+        if stream:
+            return response
+        completion = None
+        async for completion in response:
+            pass
+        return completion
+
+class AsyncChat():
+    completions: AsyncCompletions
+
+    def __init__(self, client: AsyncLocalEngine):
+        self.completions = AsyncCompletions(client)
@@ -0,0 +1,285 @@
+import json
+import time
+import pathlib
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+from ._store import VectorStore, select_top_k
+
+# Below this many rows an exact search is as fast as probing lists
+MIN_ROWS = 4096
+# Training rows sampled per cluster
+SAMPLES_PER_LIST = 64
+PQ_CENTROIDS = 256
+
+def kmeans(data: np.ndarray, k: int, iterations: int = 20, spherical: bool = True,
+           seed: int = 0, block_rows: int = 1 << 14) -> np.ndarray:
+    """
+    Cluster the rows of `data` into `k` centroids with Lloyd's algorithm.
+
+    With `spherical=True` rows are assigned by dot product and centroids are normalized,
+    which suits normalized embeddings; otherwise rows are assigned by euclidean distance.
+    Empty clusters are reseeded with random rows.
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(data))
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign(data, centroids, spherical, block_rows)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+        counts = np.bincount(assignments, minlength=k)
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+            counts[empty] = 1
+        centroids = sums / counts[:, None]
+        if spherical:
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            centroids /= norms
+    return centroids.astype(np.float32)
+
+def assign(data: np.ndarray, centroids: np.ndarray, spherical: bool = True, block_rows: int = 1 << 14) -> np.ndarray:
+    """
+    Return the index of the nearest centroid of every row of `data`.
+    """
+    # For euclidean distance, argmin |x - c|^2 is argmax x.c - |c|^2 / 2
+    bias = 0 if spherical else (centroids * centroids).sum(axis=1) / 2
+    assignments = np.empty(len(data), dtype=np.int32)
+    for start in range(0, len(data), block_rows):
+        scores = data[start:start + block_rows] @ centroids.T - bias
+        assignments[start:start + block_rows] = scores.argmax(axis=1)
+    return assignments
+
+class IVFIndex:
+    """
+    An inverted file index for approximate nearest neighbour search over a `VectorStore`.
+
+    The stored embeddings are clustered with k-means and every row is listed under its
+    nearest centroid. A query only scores the rows of the `nprobe` lists whose centroids are
+    closest to it, so its cost grows with `nprobe / nlist` of the corpus instead of all of it.
+    With product quantization (`pq_m`), candidates are first scored from 8-bit codes and only
+    the best `rerank * top_k` are scored exactly against the stored embeddings.
+
+    Rows added after the index was trained are assigned to the existing centroids; the index
+    is trained again once the store has doubled in size. Raising `nprobe` (and `rerank`)
+    trades latency for recall, `evaluate` measures both against an exact search.
+
+    Args:
+        path (str | pathlib.Path): Directory of the index files.
+        nlist (Optional[int]): Number of clusters. Defaults to 4 * sqrt(rows) when trained.
+        nprobe (int): Number of lists scanned per query.
+        pq_m (Optional[int]): Number of product quantization subspaces, which must divide the
+            embedding dimension. Disabled if None.
+        rerank (int): With product quantization, candidates rescored exactly per result.
+        seed (int): Seed of the k-means initialization and of the training sample.
+
+    Attributes:
+        count (int): Number of store rows covered by the index; later rows are searched exactly.
+        trained_count (int): Number of store rows when the index was trained.
+    """
+
+    def __init__(self, path: Any, nlist: Optional[int] = None, nprobe: int = 8,
+                 pq_m: Optional[int] = None, rerank: int = 10, seed: int = 0) -> None:
+        self.path = pathlib.Path(path)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.rerank = rerank
+        self.seed = seed
+        self.count = 0
+        self.trained_count = 0
+        self.centroids: Optional[np.ndarray] = None
+        self.codebooks: Optional[np.ndarray] = None
+        self._assignments: Optional[np.ndarray] = None
+        self._codes: Optional[np.ndarray] = None
+        self._list_rows: Optional[np.ndarray] = None
+        self._list_offsets: Optional[np.ndarray] = None
+        meta_path = self.path / "ivf.json"
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text())
+            if meta["pq_m"] == pq_m and (nlist is None or meta["nlist"] == nlist):
+                self.count = meta["count"]
+                self.trained_count = meta["trained_count"]
+                self.centroids = np.load(self.path / "centroids.npy")
+                self._list_rows = np.load(self.path / "list_rows.npy", mmap_mode="r")
+                self._list_offsets = np.load(self.path / "list_offsets.npy")
+                if pq_m:
+                    self.codebooks = np.load(self.path / "codebooks.npy")
+                    self._codes = np.load(self.path / "codes.npy", mmap_mode="r")
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def update(self, store: VectorStore) -> bool:
+        """
+        Bring the index in line with the store: train it once the store is large enough or has
+        doubled since training, otherwise list the rows added since the last update.
+
+        Returns:
+            bool: Whether the index was trained.
+        """
+        if store.count < MIN_ROWS:
+            return False
+        if not self.trained or store.count > 2 * self.trained_count or self.count > store.count:
+            self.build(store)
+            return True
+        if self.count < store.count:
+            vectors = np.asarray(store.vectors[self.count:store.count], dtype=np.float32)
+            assignments = np.concatenate([self._load_assignments(), assign(vectors, self.centroids)])
+            codes = None
+            if self.pq_m:
+                codes = np.concatenate([np.asarray(self._codes), self._encode(vectors)])
+            self._save(assignments, codes, store.count)
+        return False
+
+    def build(self, store: VectorStore) -> None:
+        """
+        Train the centroids (and codebooks) on a sample of the live rows and list every row.
+        """
+        rng = np.random.default_rng(self.seed)
+        live = np.flatnonzero(~store.deleted_mask)
+        nlist = self.nlist or max(1, int(4 * np.sqrt(len(live))))
+        sample = np.sort(rng.choice(live, min(len(live), nlist * SAMPLES_PER_LIST), replace=False))
+        training = np.asarray(store.vectors[sample], dtype=np.float32)
+        self.centroids = kmeans(training, nlist, seed=self.seed)
+        if self.pq_m:
+            if store.dim % self.pq_m:
+                raise ValueError(f"pq_m ({self.pq_m}) must divide the embedding dimension ({store.dim})")
+            subspaces = training.reshape(len(training), self.pq_m, -1)
+            self.codebooks = np.stack([
+                kmeans(subspaces[:, m], PQ_CENTROIDS, spherical=False, seed=self.seed + m) for m in range(self.pq_m)
+            ])
+        assignments, codes = [], []
+        for start in range(0, store.count, 1 << 16):
+            vectors = np.asarray(store.vectors[start:start + (1 << 16)], dtype=np.float32)
+            assignments.append(assign(vectors, self.centroids))
+            if self.pq_m:
+                codes.append(self._encode(vectors))
+        self.trained_count = store.count
+        self._save(np.concatenate(assignments), np.concatenate(codes) if self.pq_m else None, store.count)
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        subspaces = vectors.reshape(len(vectors), self.pq_m, -1)
+        return np.stack([
+            assign(subspaces[:, m], self.codebooks[m], spherical=False) for m in range(self.pq_m)
+        ], axis=1).astype(np.uint8)
+
+    def _load_assignments(self) -> np.ndarray:
+        if self._assignments is None:
+            self._assignments = np.load(self.path / "assignments.npy")
+        return self._assignments
+
+    def _save(self, assignments: np.ndarray, codes: Optional[np.ndarray], count: int) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._assignments = assignments
+        self._list_rows = np.argsort(assignments, kind="stable")
+        self._list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(self.centroids)))])
+        self._codes = codes
+        self.count = count
+        arrays = {
+            "centroids.npy": self.centroids,
+            "assignments.npy": assignments,
+            "list_rows.npy": self._list_rows,
+            "list_offsets.npy": self._list_offsets,
+        }
+        if self.pq_m:
+            arrays.update({"codebooks.npy": self.codebooks, "codes.npy": codes})
+        for name, array in arrays.items():
+            np.save(self.path / name, array)
+        meta = {
+            "nlist": len(self.centroids), "pq_m": self.pq_m,
+            "count": self.count, "trained_count": self.trained_count,
+        }
+        # The header is written last, it decides which rows the index covers
+        temporary = self.path / "ivf.json.tmp"
+        temporary.write_text(json.dumps(meta))
+        temporary.replace(self.path / "ivf.json")
+
+    def search(self, store: VectorStore, queries: npt.ArrayLike, top_k: int,
+               nprobe: Optional[int] = None) -> List[List[Tuple[int, float]]]:
+        """
+        Find approximately the rows most similar to one or more query embeddings.
+
+        Args:
+            store (VectorStore): The store the index was built for.
+            queries (npt.ArrayLike): One query embedding, or a (n_queries, dim) matrix of them.
+            top_k (int): Number of rows returned per query.
+            nprobe (Optional[int]): Lists scanned per query. Defaults to `self.nprobe`.
+
+        Returns:
+            List[List[Tuple[int, float]]]: For every query, its (row, score) pairs, best first.
+        """
+        if not self.trained:
+            return store.search(queries, top_k)
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        queries = queries / norms
+        probes, _ = select_top_k(queries @ self.centroids.T, nprobe or self.nprobe)
+        vectors, deleted = store.vectors, store.deleted_mask
+        # Rows added since the last update are not listed yet
+        tail = np.arange(self.count, store.count)
+        results = []
+        for query, lists in zip(queries, probes):
+            candidates = np.concatenate(
+                [self._list_rows[self._list_offsets[l]:self._list_offsets[l + 1]] for l in lists] + [tail]
+            )
+            candidates = candidates[~deleted[candidates]]
+            if self.pq_m and len(candidates) > self.rerank * top_k:
+                listed = candidates[candidates < self.count]
+                table = np.einsum("md,mcd->mc", query.reshape(self.pq_m, -1), self.codebooks)
+                approximate = table[np.arange(self.pq_m), self._codes[listed]].sum(axis=1)
+                best, _ = select_top_k(approximate[None], self.rerank * top_k)
+                candidates = np.concatenate([listed[best[0]], candidates[candidates >= self.count]])
+            # Sorted rows read the memory map sequentially
+            candidates = np.sort(candidates)
+            scores = np.asarray(vectors[candidates], dtype=np.float32) @ query
+            best, best_scores = select_top_k(scores[None], top_k)
+            order = np.argsort(-best_scores[0], kind="stable")
+            results.append([(int(candidates[best[0][i]]), float(best_scores[0][i])) for i in order])
+        return results
+
+    def evaluate(self, store: VectorStore, top_k: int = 10, queries: int = 100,
+                 nprobe: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Measure recall@k and latency against an exact search, using stored rows as queries.
+
+        Args:
+            store (VectorStore): The store the index was built for.
+            top_k (int): Number of results compared per query.
+            queries (int): Number of sampled queries.
+            nprobe (Optional[int]): Lists scanned per query. Defaults to `self.nprobe`.
+
+        Returns:
+            Dict[str, Any]: The recall@k and the average latencies in milliseconds of both searches.
+        """
+        rng = np.random.default_rng(self.seed)
+        live = np.flatnonzero(~store.deleted_mask)
+        sample = np.asarray(store.vectors[np.sort(rng.choice(live, min(queries, len(live)), replace=False))], dtype=np.float32)
+        start = time.perf_counter()
+        exact = [store.search(query, top_k)[0] for query in sample]
+        exact_time = time.perf_counter() - start
+        start = time.perf_counter()
+        approximate = [self.search(store, query, top_k, nprobe)[0] for query in sample]
+        approximate_time = time.perf_counter() - start
+        recall = np.mean([
+            len({row for row, _ in found} & {row for row, _ in expected}) / max(1, len(expected))
+            for found, expected in zip(approximate, exact)
+        ])
+        return {
+            "top_k": top_k,
+            "queries": len(sample),
+            "nlist": len(self.centroids) if self.trained else None,
+            "nprobe": nprobe or self.nprobe,
+            "pq_m": self.pq_m,
+            "recall_at_k": round(float(recall), 4),
+            "exact_latency_ms": round(1000 * exact_time / max(1, len(sample)), 4),
+            "ann_latency_ms": round(1000 * approximate_time / max(1, len(sample)), 4),
+        }
+
+__all__ = ['IVFIndex', 'kmeans']
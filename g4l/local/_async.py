@@ -0,0 +1,74 @@
+import asyncio
+import threading
+from concurrent.futures import Executor, TimeoutError
+from typing import AsyncIterator, Callable, Iterator, TypeVar
+
+T = TypeVar('T')
+
+_DONE = object()
+
+async def iter_in_executor(factory: Callable[[], Iterator[T]], executor: Executor,
+                           queue_size: int = 32, cancelled: threading.Event = None) -> AsyncIterator[T]:
+    """
+    Runs a blocking iterator on an executor and hands its items to the event loop.
+
+    Items travel through a bounded queue, so a slow consumer blocks the producer thread
+    instead of letting tokens pile up. When the consumer stops early or its task is
+    cancelled, the producer closes the iterator at the next item boundary, which ends the
+    generation and releases the model for the next request.
+
+    Args:
+        factory (Callable[[], Iterator[T]]): Creates the iterator; called on the executor thread.
+        executor (Executor): The executor that runs the blocking iteration.
+        queue_size (int): Maximum number of items buffered between the threads.
+        cancelled (threading.Event, optional): Set when the consumer stops, e.g. to also stop a
+            request that is still waiting to start.
+
+    Yields:
+        T: The items of the iterator.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    cancelled = threading.Event() if cancelled is None else cancelled
+
+    def put(item) -> bool:
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while not cancelled.is_set():
+            try:
+                future.result(timeout=0.1)
+                return True
+            except TimeoutError:
+                continue
+        future.cancel()
+        return False
+
+    def produce() -> None:
+        iterator = None
+        try:
+            iterator = factory()
+            for item in iterator:
+                if not put((item, None)):
+                    break
+        except BaseException as e:
+            put((_DONE, e))
+            return
+        finally:
+            if iterator is not None and hasattr(iterator, 'close'):
+                iterator.close()
+        put((_DONE, None))
+
+    producer = loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                break
+            yield item
+    finally:
+        cancelled.set()
+        if producer.done() and not producer.cancelled():
+            producer.result()
+
+__all__ = ['iter_in_executor']
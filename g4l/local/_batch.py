@@ -0,0 +1,275 @@
+import time
+import codecs
+import random
+import threading
+from queue import Queue
+from collections import deque
+from typing import Iterator, List, Optional, Deque, Dict, Any
+
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp import _internals as internals
+from llama_cpp.llama_grammar import LlamaGrammar
+
+class BatchRequest:
+    """
+    One sequence inside a `BatchedGenerator`.
+
+    Attributes:
+        tokens (List[int]): Prompt tokens that still have to be evaluated.
+        max_tokens (int): Maximum number of tokens to generate.
+        seq_id (Optional[int]): The sequence id in the shared KV cache while active.
+        n_past (int): Number of tokens of this sequence in the KV cache.
+        n_generated (int): Number of tokens sampled so far.
+        finish_reason (Optional[str]): Why the sequence finished ('stop' or 'length').
+        cancelled (bool): Set by the consumer to retire the sequence at the next step.
+        start_time, first_token_time, last_token_time (Optional[float]): `time.perf_counter()` when
+            the sequence got a slot and when its first and last tokens were sampled.
+    """
+
+    def __init__(self, tokens: List[int], max_tokens: int, sampler: internals.LlamaSampler) -> None:
+        self.tokens = list(tokens)
+        self.max_tokens = max_tokens
+        self.sampler = sampler
+        self.seq_id: Optional[int] = None
+        self.n_past = 0
+        self.n_prompt = len(tokens)
+        self.n_generated = 0
+        self.logits_index = -1
+        self.finish_reason: Optional[str] = None
+        self.cancelled = False
+        self.output: Queue = Queue()
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self.start_time: Optional[float] = None
+        self.first_token_time: Optional[float] = None
+        self.last_token_time: Optional[float] = None
+
+class BatchedGenerator:
+    """
+    Continuous batching of several sequences against one model.
+
+    Every active sequence gets its own sequence id in a shared KV cache and all of them are
+    decoded together in one llama.cpp batch per step. New requests are admitted and finished
+    ones retired between steps, so callers keep independent streaming iterators while the
+    model evaluates their tokens together.
+
+    The generator creates its own context on top of the weights of `llm`, so the model is
+    not loaded twice.
+
+    Args:
+        llm (Llama): The loaded model whose weights and tokenizer are used.
+        n_parallel (int): Maximum number of sequences decoded together.
+        n_ctx (Optional[int]): Context size of each sequence. Defaults to the context size of `llm`.
+        n_batch (int): Maximum number of tokens per decode step.
+    """
+
+    def __init__(self, llm: Llama, n_parallel: int = 4, n_ctx: Optional[int] = None, n_batch: int = 512) -> None:
+        self.llm = llm
+        self.n_parallel = n_parallel
+        self.n_ctx = n_ctx or llm.n_ctx()
+        self.n_batch = max(n_batch, n_parallel)
+
+        params = llama_cpp.llama_context_params.from_buffer_copy(llm.context_params)
+        params.n_ctx = self.n_ctx * n_parallel
+        params.n_batch = self.n_batch
+        params.n_ubatch = min(params.n_ubatch, self.n_batch)
+        params.n_seq_max = n_parallel
+        self._ctx = internals.LlamaContext(model=llm._model, params=params, verbose=False)
+        self._batch = internals.LlamaBatch(n_tokens=self.n_batch, embd=0, n_seq_max=1, verbose=False)
+
+        self._pending: Deque[BatchRequest] = deque()
+        self._active: Dict[int, BatchRequest] = {}
+        self._free_ids = list(range(n_parallel))
+        self._condition = threading.Condition()
+        self._closed = False
+        self.steps = 0
+        self.tokens_decoded = 0
+        self._thread = threading.Thread(target=self._run, name="g4l-batch", daemon=True)
+        self._thread.start()
+
+    @property
+    def active(self) -> int:
+        return len(self._active)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def create(self, tokens: List[int], max_tokens: int = 4900, temperature: float = 0.8,
+               top_k: int = 40, top_p: float = 0.95, min_p: float = 0.05,
+               seed: Optional[int] = None, grammar: Optional[LlamaGrammar] = None,
+               stats: Dict[str, Any] = None) -> Iterator[str]:
+        """
+        Queues a sequence and streams its generated text.
+
+        Args:
+            tokens (List[int]): The prompt tokens.
+            max_tokens (int): Maximum number of tokens to generate.
+            temperature (float): Sampling temperature, 0 for greedy decoding.
+            top_k (int), top_p (float), min_p (float): Sampling parameters.
+            seed (Optional[int]): Sampling seed.
+            grammar (Optional[LlamaGrammar]): Grammar the generated text must follow.
+            stats (Dict[str, Any], optional): Filled with the finish reason, token counts and timings.
+
+        Returns:
+            Iterator[str]: An iterator yielding the generated text pieces.
+        """
+        if len(tokens) >= self.n_ctx:
+            raise ValueError(f"Requested tokens ({len(tokens)}) exceed context window of {self.n_ctx}")
+        max_tokens = min(max_tokens if max_tokens and max_tokens > 0 else self.n_ctx, self.n_ctx - len(tokens))
+        request = BatchRequest(tokens, max_tokens, self._make_sampler(temperature, top_k, top_p, min_p, seed, grammar))
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("BatchedGenerator is closed")
+            self._pending.append(request)
+            self._condition.notify()
+        return self._iter_request(request, stats)
+
+    def _iter_request(self, request: BatchRequest, stats: Optional[Dict[str, Any]]) -> Iterator[str]:
+        try:
+            while True:
+                item = request.output.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            request.cancelled = True
+            if stats is not None:
+                stats['finish_reason'] = request.finish_reason
+                stats['prompt_tokens'] = request.n_prompt
+                stats['completion_tokens'] = request.n_generated
+                if request.first_token_time is not None:
+                    stats['prompt_eval_time'] = request.first_token_time - request.start_time
+                    stats['decode_time'] = request.last_token_time - request.first_token_time
+
+    def _make_sampler(self, temperature: float, top_k: int, top_p: float, min_p: float,
+                      seed: Optional[int], grammar: Optional[LlamaGrammar] = None) -> internals.LlamaSampler:
+        sampler = internals.LlamaSampler()
+        if grammar is not None:
+            sampler.add_grammar(self.llm._model, grammar)
+        if temperature <= 0:
+            sampler.add_greedy()
+        else:
+            sampler.add_top_k(top_k)
+            sampler.add_top_p(top_p, 1)
+            sampler.add_min_p(min_p, 1)
+            sampler.add_temp(temperature)
+            sampler.add_dist(random.randint(0, 2**32 - 1) if seed is None else seed)
+        return sampler
+
+    def close(self) -> None:
+        """
+        Stops the decode loop; unfinished sequences end with finish_reason 'stop'.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _admit(self) -> None:
+        while self._pending and self._free_ids:
+            request = self._pending.popleft()
+            if request.cancelled:
+                request.output.put(None)
+                continue
+            request.seq_id = self._free_ids.pop()
+            request.start_time = time.perf_counter()
+            self._active[request.seq_id] = request
+
+    def _retire(self, request: BatchRequest, finish_reason: Optional[str]) -> None:
+        request.finish_reason = finish_reason
+        tail = request.decoder.decode(b'', final=True)
+        if tail:
+            request.output.put(tail)
+        request.output.put(None)
+        llama_cpp.llama_memory_seq_rm(self._ctx.memory, request.seq_id, -1, -1)
+        del self._active[request.seq_id]
+        self._free_ids.append(request.seq_id)
+        request.sampler.close()
+
+    def _fill_batch(self) -> List[BatchRequest]:
+        """
+        Puts one token of every decoding sequence and as many prompt tokens as fit into the batch.
+        Returns the sequences whose logits have to be sampled after the decode, in batch order.
+        """
+        batch = self._batch.batch
+        n = 0
+        sampled: List[BatchRequest] = []
+        # Decoding sequences go first so that long prompts cannot starve them
+        requests = sorted(self._active.values(), key=lambda request: request.n_generated == 0)
+        for request in requests:
+            if n >= self.n_batch:
+                break
+            take = request.tokens[:self.n_batch - n]
+            for i, token in enumerate(take):
+                batch.token[n] = token
+                batch.pos[n] = request.n_past + i
+                batch.n_seq_id[n] = 1
+                batch.seq_id[n][0] = request.seq_id
+                batch.logits[n] = False
+                n += 1
+            request.tokens = request.tokens[len(take):]
+            request.n_past += len(take)
+            if take and not request.tokens:
+                batch.logits[n - 1] = True
+                request.logits_index = n - 1
+                sampled.append(request)
+        batch.n_tokens = n
+        return sampled
+
+    def _step(self) -> None:
+        for request in [request for request in self._active.values() if request.cancelled]:
+            self._retire(request, "stop")
+        if not self._active:
+            return
+        sampled = self._fill_batch()
+        if self._batch.batch.n_tokens == 0:
+            return
+        self._ctx.decode(self._batch)
+        self.steps += 1
+        self.tokens_decoded += self._batch.batch.n_tokens
+        vocab = self.llm._model.vocab
+        for request in sampled:
+            token = request.sampler.sample(self._ctx, request.logits_index)
+            request.last_token_time = time.perf_counter()
+            if request.first_token_time is None:
+                request.first_token_time = request.last_token_time
+            # Like the sequential path, the end-of-generation token counts as a completion token
+            request.n_generated += 1
+            if llama_cpp.llama_vocab_is_eog(vocab, token):
+                self._retire(request, "stop")
+                continue
+            text = request.decoder.decode(self.llm._model.detokenize([token]))
+            if text:
+                request.output.put(text)
+            if request.n_generated >= request.max_tokens or request.n_past + 1 >= self.n_ctx:
+                self._retire(request, "length")
+                continue
+            request.tokens = [token]
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._admit()
+                while not self._active and not self._closed:
+                    self._condition.wait()
+                    self._admit()
+                if self._closed:
+                    for request in list(self._active.values()) + list(self._pending):
+                        if request.seq_id is None:
+                            request.output.put(None)
+                        else:
+                            self._retire(request, "stop")
+                    self._pending.clear()
+                    break
+            try:
+                self._step()
+            except BaseException as e:
+                # A failed decode leaves the KV cache in an unknown state, fail every active sequence
+                for request in list(self._active.values()):
+                    request.output.put(e)
+                    self._retire(request, None)
+
+__all__ = ['BatchedGenerator']
@@ -0,0 +1,234 @@
+import re
+import json
+import math
+import shutil
+import pathlib
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ._store import VectorStore, select_top_k
+
+# Words, and identifiers such as "ERR-1042", "v2.3.1" or "AB/77-X" kept in one piece
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./:#]\w+)*")
+PART_PATTERN = re.compile(r"\w+")
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into lowercase terms. Compound identifiers are kept whole and also split into
+    their parts, so "ERR-1042" is found by "err-1042" as well as by "1042".
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        terms.append(token)
+        parts = PART_PATTERN.findall(token)
+        if len(parts) > 1:
+            terms.extend(parts)
+    return terms
+
+class Segment:
+    """
+    The inverted index of the store rows [start, end): for every term, the rows containing it
+    and how often, stored contiguously and located through term offsets.
+    """
+
+    def __init__(self, start: int, end: int, terms: List[str], offsets: np.ndarray,
+                 rows: np.ndarray, frequencies: np.ndarray, lengths: np.ndarray, name: Optional[str] = None) -> None:
+        # Set once the segment is saved
+        self.name = name
+        self.start = start
+        self.end = end
+        self.terms = terms
+        self.vocabulary = {term: index for index, term in enumerate(terms)}
+        self.offsets = offsets
+        self.rows = rows
+        self.frequencies = frequencies
+        self.lengths = lengths
+
+    def postings(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        index = self.vocabulary.get(term)
+        if index is None:
+            return None
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.rows[start:end], self.frequencies[start:end]
+
+    @classmethod
+    def build(cls, start: int, documents: List[List[str]]) -> "Segment":
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        for row, terms in enumerate(documents, start):
+            for term, frequency in Counter(terms).items():
+                rows, frequencies = postings.setdefault(term, ([], []))
+                rows.append(row)
+                frequencies.append(frequency)
+        terms = sorted(postings)
+        sizes = [len(postings[term][0]) for term in terms]
+        return cls(
+            start, start + len(documents), terms,
+            np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]).astype(np.int64),
+            np.array([row for term in terms for row in postings[term][0]], dtype=np.int64),
+            np.array([frequency for term in terms for frequency in postings[term][1]], dtype=np.int32),
+            np.array([len(terms) for terms in documents], dtype=np.int32),
+        )
+
+    @classmethod
+    def merge(cls, segments: List["Segment"], deleted: np.ndarray) -> "Segment":
+        """
+        Merge consecutive segments into one, dropping the postings of deleted rows.
+        """
+        terms = sorted(set().union(*(segment.vocabulary for segment in segments)))
+        vocabulary = {term: index for index, term in enumerate(terms)}
+        term_ids, rows, frequencies = [], [], []
+        for segment in segments:
+            mapping = np.array([vocabulary[term] for term in segment.terms], dtype=np.int64)
+            term_ids.append(np.repeat(mapping, np.diff(segment.offsets)))
+            rows.append(segment.rows)
+            frequencies.append(segment.frequencies)
+        term_ids, rows, frequencies = np.concatenate(term_ids), np.concatenate(rows), np.concatenate(frequencies)
+        live = ~deleted[rows]
+        term_ids, rows, frequencies = term_ids[live], rows[live], frequencies[live]
+        # Segments are ordered by row, a stable sort by term keeps the postings of each term ordered too
+        order = np.argsort(term_ids, kind="stable")
+        counts = np.bincount(term_ids, minlength=len(terms))
+        keep = counts > 0
+        return cls(
+            segments[0].start, segments[-1].end, [term for term, kept in zip(terms, keep) if kept],
+            np.concatenate([[0], np.cumsum(counts[keep])]).astype(np.int64),
+            rows[order], frequencies[order],
+            np.concatenate([segment.lengths for segment in segments]),
+        )
+
+    def save(self, path: pathlib.Path) -> None:
+        self.name = path.name
+        path.mkdir(parents=True, exist_ok=True)
+        (path / "terms.json").write_text(json.dumps(self.terms, ensure_ascii=False))
+        for name in ("offsets", "rows", "frequencies", "lengths"):
+            np.save(path / f"{name}.npy", getattr(self, name))
+
+    @classmethod
+    def load(cls, path: pathlib.Path, start: int, end: int) -> "Segment":
+        return cls(
+            start, end, json.loads((path / "terms.json").read_text()),
+            *(np.load(path / f"{name}.npy", mmap_mode="r") for name in ("offsets", "rows", "frequencies", "lengths")),
+            name=path.name
+        )
+
+class BM25Index:
+    """
+    Okapi BM25 keyword search over the chunks of a `VectorStore`.
+
+    The inverted index is kept as a few segments, each covering a range of store rows. Rows
+    added to the store become a new segment, and consecutive segments of similar size are
+    merged, so an update costs time proportional to the new rows (amortized logarithmically).
+    Postings of deleted rows are skipped when searching and dropped when merging.
+
+    Args:
+        path (str | pathlib.Path): Directory of the index files.
+        k1 (float): Term frequency saturation.
+        b (float): Document length normalization.
+
+    Attributes:
+        count (int): Number of store rows covered by the index.
+    """
+
+    def __init__(self, path: Any, k1: float = 1.2, b: float = 0.75) -> None:
+        self.path = pathlib.Path(path)
+        self.k1 = k1
+        self.b = b
+        self.segments: List[Segment] = []
+        self.generation = 0
+        meta_path = self.path / "bm25.json"
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text())
+            self.generation = meta["generation"]
+            self.segments = [Segment.load(self.path / name, start, end) for name, start, end in meta["segments"]]
+
+    @property
+    def count(self) -> int:
+        return self.segments[-1].end if self.segments else 0
+
+    def update(self, store: VectorStore) -> None:
+        """
+        Index the rows added to the store since the last update.
+        """
+        if self.count > store.count:
+            # The store was compacted and renumbered its rows
+            self.segments = []
+        if self.count == store.count:
+            return
+        documents = [tokenize(store.record(row)["text"]) for row in range(self.count, store.count)]
+        self.segments.append(Segment.build(self.count, documents))
+        while len(self.segments) > 1 and 2 * (self.segments[-1].end - self.segments[-1].start) >= \
+                self.segments[-2].end - self.segments[-2].start:
+            self.segments[-2:] = [Segment.merge(self.segments[-2:], store.deleted_mask)]
+        self._save()
+
+    def build(self, store: VectorStore) -> None:
+        """
+        Index every row of the store from scratch.
+        """
+        self.segments = []
+        self.update(store)
+
+    def _save(self) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.generation += 1
+        for segment in self.segments:
+            if segment.name is None:
+                segment.save(self.path / f"segment-{self.generation}-{segment.start}-{segment.end}")
+        names = {segment.name for segment in self.segments}
+        # The header is written last, it decides which segments belong to the index
+        temporary = self.path / "bm25.json.tmp"
+        temporary.write_text(json.dumps({
+            "generation": self.generation,
+            "segments": [[segment.name, segment.start, segment.end] for segment in self.segments],
+        }))
+        temporary.replace(self.path / "bm25.json")
+        for path in self.path.iterdir():
+            if path.is_dir() and path.name not in names:
+                shutil.rmtree(path)
+
+    def search(self, store: VectorStore, query: str, top_k: int) -> List[Tuple[int, float]]:
+        """
+        Find the rows that best match the terms of a query.
+
+        Returns:
+            List[Tuple[int, float]]: The (row, score) pairs, best first.
+        """
+        documents = len(store)
+        if not self.segments or not documents:
+            return []
+        average_length = sum(float(segment.lengths.sum()) for segment in self.segments) / self.count
+        rows, scores = [], []
+        for term in set(tokenize(query)):
+            postings = [postings for segment in self.segments if (postings := segment.postings(term)) is not None]
+            if not postings:
+                continue
+            term_rows = np.concatenate([term_rows for term_rows, _ in postings])
+            frequencies = np.concatenate([frequencies for _, frequencies in postings]).astype(np.float32)
+            frequency = len(term_rows)
+            # Postings of deleted rows still count towards the document frequency until they are merged away
+            idf = math.log(1 + (max(documents - frequency, 0) + 0.5) / (frequency + 0.5))
+            lengths = self._lengths(term_rows)
+            norm = self.k1 * (1 - self.b + self.b * lengths / average_length)
+            rows.append(term_rows)
+            scores.append(idf * frequencies * (self.k1 + 1) / (frequencies + norm))
+        if not rows:
+            return []
+        unique, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores)).astype(np.float32)
+        totals[store.deleted_mask[unique]] = -np.inf
+        best, best_scores = select_top_k(totals[None], top_k)
+        order = np.argsort(-best_scores[0], kind="stable")
+        return [
+            (int(unique[best[0][i]]), float(best_scores[0][i])) for i in order if np.isfinite(best_scores[0][i])
+        ]
+
+    def _lengths(self, rows: np.ndarray) -> np.ndarray:
+        lengths = np.empty(len(rows), dtype=np.float32)
+        for segment in self.segments:
+            inside = (rows >= segment.start) & (rows < segment.end)
+            lengths[inside] = segment.lengths[rows[inside] - segment.start]
+        return lengths
+
+__all__ = ['BM25Index', 'tokenize']
@@ -0,0 +1,201 @@
+import os
+import json
+import pathlib
+import threading
+from hashlib import sha1
+from collections import OrderedDict
+from typing import Optional, Sequence, Tuple, Dict, Any
+
+import numpy as np
+from llama_cpp.llama import Llama, LlamaState
+from llama_cpp.llama_cache import BaseLlamaCache
+
+TokenKey = Tuple[int, ...]
+
+def longest_token_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+    return Llama.longest_token_prefix(a, b)
+
+class PrefixCache(BaseLlamaCache):
+    """
+    A prefix cache of evaluated llama states, kept in memory and optionally spilled to disk.
+
+    Lookups return the stored state sharing the longest token prefix with the prompt, so that
+    a follow-up turn or a request with a shared system prompt only evaluates its new tokens.
+    Entries are evicted in least-recently-used order once a tier exceeds its capacity.
+
+    Args:
+        capacity_bytes (int): Memory budget for cached states in bytes.
+        cache_dir (Optional[str]): Directory of the on-disk tier. Disabled if None.
+        disk_capacity_bytes (Optional[int]): Disk budget in bytes. Defaults to 4x `capacity_bytes`.
+
+    Attributes:
+        llm (Optional[Llama]): The model this cache is attached to, used to account for the
+            prefix that is still live in its KV cache.
+        hits (int): Number of lookups that reused at least one token.
+        misses (int): Number of lookups that had to evaluate the whole prompt.
+        reused_tokens (int): Total number of prompt tokens that did not need to be evaluated.
+        last_lookup (Optional[Dict[str, Any]]): Statistics of the most recent lookup.
+    """
+
+    def __init__(self, capacity_bytes: int = (2 << 30), cache_dir: Optional[str] = None,
+                 disk_capacity_bytes: Optional[int] = None) -> None:
+        super().__init__(capacity_bytes)
+        self.llm: Optional[Llama] = None
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.last_lookup: Optional[Dict[str, Any]] = None
+        self._memory: "OrderedDict[TokenKey, LlamaState]" = OrderedDict()
+        self._disk: "OrderedDict[TokenKey, Tuple[str, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_dir = pathlib.Path(cache_dir) if cache_dir else None
+        self.disk_capacity_bytes = 4 * capacity_bytes if disk_capacity_bytes is None else disk_capacity_bytes
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._load_disk_index()
+
+    @property
+    def cache_size(self) -> int:
+        return sum(state.llama_state_size for state in self._memory.values())
+
+    @property
+    def disk_size(self) -> int:
+        return sum(size for _, size in self._disk.values())
+
+    def _find_longest_prefix_key(self, key: TokenKey) -> Optional[TokenKey]:
+        best_len, best_key = 0, None
+        for candidate in list(self._memory.keys()) + list(self._disk.keys()):
+            prefix_len = longest_token_prefix(candidate, key)
+            if prefix_len > best_len:
+                best_len, best_key = prefix_len, candidate
+        return best_key
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        with self._lock:
+            return self._find_longest_prefix_key(tuple(key)) is not None
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        key = tuple(key)
+        with self._lock:
+            best_key = self._find_longest_prefix_key(key)
+            cached_len = longest_token_prefix(best_key, key) if best_key is not None else 0
+            # The model only restores a state if it beats the prefix already in its KV cache
+            live_len = longest_token_prefix(self.llm._input_ids.tolist(), key) if self.llm is not None else 0
+            reused = max(cached_len, live_len)
+            self.last_lookup = {
+                "hit": reused > 0,
+                "reused_tokens": reused,
+                "prompt_tokens": len(key),
+                "source": "memory" if best_key in self._memory and cached_len > live_len
+                          else "disk" if best_key is not None and cached_len > live_len
+                          else "context" if live_len else None,
+            }
+            if reused > 0:
+                self.hits += 1
+                self.reused_tokens += reused
+            else:
+                self.misses += 1
+            if best_key is None:
+                raise KeyError("Key not found")
+            if best_key in self._memory:
+                self._memory.move_to_end(best_key)
+                return self._memory[best_key]
+            state = self._read_disk(best_key)
+            self._put_memory(best_key, state)
+            return state
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState) -> None:
+        # Resuming only needs the logits of the last position, the other rows (one per token
+        # once speculative decoding keeps every logit) are dropped
+        if value.scores.shape[0] > 1:
+            value.scores = value.scores[-1:].copy()
+        with self._lock:
+            self._put_memory(tuple(key), value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            for key in list(self._disk.keys()):
+                self._remove_disk(key)
+            self._save_disk_index()
+
+    def _put_memory(self, key: TokenKey, value: LlamaState) -> None:
+        self._memory.pop(key, None)
+        self._memory[key] = value
+        while self.cache_size > self.capacity_bytes and len(self._memory) > 0:
+            evicted_key, evicted = self._memory.popitem(last=False)
+            if self.cache_dir is not None:
+                self._write_disk(evicted_key, evicted)
+
+    def _state_file(self, key: TokenKey) -> pathlib.Path:
+        return self.cache_dir / (sha1(repr(key).encode()).hexdigest() + '.npz')
+
+    def _read_disk(self, key: TokenKey) -> LlamaState:
+        # Plain arrays only: unpickling files from a shared directory could execute code
+        with np.load(self._state_file(key), allow_pickle=False) as arrays:
+            n_tokens, llama_state_size, seed = (int(value) for value in arrays['header'])
+            fields = dict(
+                input_ids=arrays['input_ids'].copy(),
+                scores=arrays['scores'].copy(),
+                n_tokens=n_tokens,
+                llama_state=arrays['llama_state'].tobytes(),
+                llama_state_size=llama_state_size,
+            )
+        if 'seed' in LlamaState.__init__.__code__.co_varnames:
+            fields['seed'] = seed
+        state = LlamaState(**fields)
+        self._remove_disk(key)
+        self._save_disk_index()
+        return state
+
+    def _write_disk(self, key: TokenKey, value: LlamaState) -> None:
+        if value.llama_state_size > self.disk_capacity_bytes:
+            return
+        path = self._state_file(key)
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                header=np.array([value.n_tokens, value.llama_state_size, getattr(value, 'seed', 0)], dtype=np.int64),
+                input_ids=np.asarray(value.input_ids, dtype=np.intc),
+                scores=np.asarray(value.scores, dtype=np.single),
+                llama_state=np.frombuffer(value.llama_state, dtype=np.uint8),
+            )
+        self._disk.pop(key, None)
+        self._disk[key] = (path.name, value.llama_state_size)
+        while self.disk_size > self.disk_capacity_bytes and len(self._disk) > 0:
+            self._remove_disk(next(iter(self._disk)))
+        self._save_disk_index()
+
+    def _remove_disk(self, key: TokenKey) -> None:
+        name, _ = self._disk.pop(key)
+        try:
+            os.remove(self.cache_dir / name)
+        except FileNotFoundError:
+            pass
+
+    def _load_disk_index(self) -> None:
+        index_file = self.cache_dir / 'index.json'
+        if not index_file.exists():
+            return
+        for key, name, size in json.loads(index_file.read_text()):
+            if (self.cache_dir / name).exists():
+                self._disk[tuple(key)] = (name, size)
+
+    def _save_disk_index(self) -> None:
+        index_file = self.cache_dir / 'index.json'
+        with open(index_file.with_suffix('.tmp'), 'w') as f:
+            json.dump([[list(key), name, size] for key, (name, size) in self._disk.items()], f)
+        os.replace(index_file.with_suffix('.tmp'), index_file)
+
+    def flush(self) -> None:
+        """
+        Write every in-memory state to the disk tier so that it survives a restart.
+        """
+        if self.cache_dir is None:
+            return
+        with self._lock:
+            for key, value in list(self._memory.items()):
+                if key not in self._disk:
+                    self._write_disk(key, value)
+
+__all__ = ['PrefixCache']
@@ -0,0 +1,154 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+TokenCounter = Callable[[str], int]
+
+def approximate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens of a text (about four characters per token in English),
+    for when the tokenizer of the target model is not at hand.
+    """
+    return (len(text) + 3) // 4
+
+class ContextBlock:
+    """
+    A contiguous piece of retrieved text: one chunk, or several overlapping or adjacent chunks
+    of the same document merged together.
+    """
+
+    def __init__(self, text: str, score: float, file_name: Optional[str], page_label: Optional[str],
+                 source: Any, start: Optional[int], end: Optional[int]) -> None:
+        self.text = text
+        self.score = score
+        self.file_name = file_name
+        self.page_label = page_label
+        self.source = source
+        self.start = start
+        self.end = end
+        self.chunks = 1
+
+    def extend(self, other: "ContextBlock") -> None:
+        """Append a block that starts inside or right after this one."""
+        if other.end > self.end:
+            self.text += other.text[self.end - other.start:] if other.start < self.end else other.text
+            self.end = other.end
+        self.score = max(self.score, other.score)
+        self.chunks += other.chunks
+
+    def format(self, text: Optional[str] = None) -> str:
+        header = f"file name: {self.file_name}"
+        if self.page_label is not None:
+            header += f", page_label: {self.page_label}"
+        return f"{header}\n{self.text if text is None else text}\n---"
+
+class ContextPacker:
+    """
+    Packs retrieved chunks into a prompt context that fits a token budget.
+
+    Duplicate chunks are dropped, and overlapping or adjacent chunks of the same document are
+    merged into one block, so shared text and headers are only paid for once. Blocks are then
+    added from the highest to the lowest score until the budget is spent: the block that no
+    longer fits is cut at a sentence or word boundary, and blocks scoring below it are left out.
+
+    Args:
+        count_tokens (Callable[[str], int]): Counts the tokens of a text, ideally with the tokenizer of the target model.
+        min_tokens (int): Smallest part of a block worth keeping when it has to be cut.
+    """
+
+    def __init__(self, count_tokens: TokenCounter = approximate_tokens, min_tokens: int = 32) -> None:
+        self.count_tokens = count_tokens
+        self.min_tokens = min_tokens
+
+    def merge(self, nodes: List[Any]) -> Tuple[List[ContextBlock], int]:
+        """
+        Turn retrieved nodes into blocks, best first, returning them with the number of duplicate chunks dropped.
+        """
+        blocks, seen, duplicates = [], set(), 0
+        for node_with_score in nodes:
+            node = node_with_score.node
+            text = node.get_content()
+            if text in seen:
+                duplicates += 1
+                continue
+            seen.add(text)
+            metadata = node.metadata
+            blocks.append(ContextBlock(
+                text, node_with_score.score or 0.0, metadata.get("file_name"), metadata.get("page_label"),
+                # Character offsets are relative to the document a chunk was split from, e.g. a page of a PDF
+                (metadata.get("file_path", metadata.get("file_name")), metadata.get("page_label")),
+                getattr(node, "start_char_idx", None), getattr(node, "end_char_idx", None),
+            ))
+        merged = []
+        positioned = sorted(
+            (block for block in blocks if block.start is not None and block.end is not None),
+            key=lambda block: (str(block.source), block.start)
+        )
+        for block in positioned:
+            previous = merged[-1] if merged else None
+            if previous is not None and previous.source == block.source and block.start <= previous.end + 1:
+                previous.extend(block)
+            else:
+                merged.append(block)
+        merged += [block for block in blocks if block.start is None or block.end is None]
+        merged.sort(key=lambda block: -block.score)
+        return merged, duplicates
+
+    def pack(self, nodes: List[Any], budget: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+        """
+        Build the context from retrieved nodes.
+
+        Args:
+            nodes (List[NodeWithScore]): The retrieved chunks.
+            budget (Optional[int]): Maximum number of tokens of the context. Unlimited if None.
+
+        Returns:
+            Tuple[str, Dict[str, Any]]: The context, and statistics with the number of tokens it uses.
+        """
+        blocks, duplicates = self.merge(nodes)
+        parts, used, trimmed, dropped = [], 0, False, 0
+        for index, block in enumerate(blocks):
+            text = block.format()
+            tokens = self.count_tokens(text)
+            if budget is not None and used + tokens > budget:
+                text = self._trim(block, budget - used)
+                if text is not None:
+                    parts.append(text)
+                    used += self.count_tokens(text)
+                    trimmed = True
+                dropped = len(blocks) - index - (text is not None)
+                break
+            parts.append(text)
+            used += tokens
+        return "\n".join(parts), {
+            "context_tokens": used,
+            "chunks": len(nodes),
+            "duplicates": duplicates,
+            "blocks": len(parts),
+            "merged": len(nodes) - duplicates - len(blocks),
+            "trimmed": trimmed,
+            "dropped": dropped,
+        }
+
+    def _trim(self, block: ContextBlock, budget: int) -> Optional[str]:
+        """
+        Return the longest prefix of a block, cut at a sentence or word boundary, that fits the budget.
+        """
+        if budget < self.min_tokens or self.count_tokens(block.format("")) >= budget:
+            return None
+        low, high = 0, len(block.text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens(block.format(block.text[:middle])) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        text = block.text[:low]
+        for boundary in (". ", "\n", " "):
+            cut = text.rfind(boundary)
+            if cut > len(text) // 2:
+                text = text[:cut + 1].rstrip()
+                break
+        if self.count_tokens(block.format(text)) < self.min_tokens:
+            return None
+        return block.format(text)
+
+__all__ = ['ContextPacker', 'approximate_tokens']
@@ -1,20 +1,34 @@
+from __future__ import annotations
+
+import os
+import json
 import time
 import pathlib
 import logging
-from hashlib  import md5
-from ..typing import List, Union, Optional, Any
-
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.core.node_parser import SentenceSplitter
-from llama_index.core import (
-    VectorStoreIndex,
-    SimpleDirectoryReader,
-    StorageContext,
-    load_index_from_storage,
-    Settings
-)
-
-Settings.chunk_size = 1024
+import shutil
+import unicodedata
+import itertools
+import threading
+import multiprocessing
+from hashlib  import md5, sha1, sha256
+from typing   import Callable, TYPE_CHECKING
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from ..typing import List, Dict, Tuple, Iterator, Union, Optional, Any
+
+import numpy as np
+
+from ._store import VectorStore
+from ._ann   import IVFIndex, MIN_ROWS
+from ._lru   import LRUCache
+from ._bm25  import BM25Index
+from ._context import ContextPacker, approximate_tokens
+
+# llama-index is imported on first use, as it dominates the import time of the package
+if TYPE_CHECKING:
+    from llama_index.core.schema import BaseNode, TextNode, NodeWithScore
+
+CHUNK_SIZE = 512
+MANIFEST_VERSION = 2
 current_file_path = pathlib.Path(__file__).parent.resolve()
 BASE_ADDR = current_file_path / "../.."
 modes = {
@@ -23,80 +37,554 @@ modes = {
     "aggressive": 5,
     "very-aggressive": 10
 }
-logging.basicConfig(level=logging.CRITICAL)
 logger = logging.getLogger(__name__)
 
+def file_digest(path: pathlib.Path) -> str:
+    """
+    Return the sha256 hex digest of a file's content.
+    """
+    digest = sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def chunk_digest(node: BaseNode) -> str:
+    """
+    Return the sha1 hex digest of the text a chunk is embedded from.
+    """
+    from llama_index.core.schema import MetadataMode
+    return sha1(node.get_content(metadata_mode=MetadataMode.EMBED).encode("utf-8")).hexdigest()
+
+def parse_file(path: str, key: str) -> List[Tuple[BaseNode, str]]:
+    """
+    Load a file and split it into chunks, returning each chunk with its digest.
+    Runs in the ingestion worker processes.
+
+    Chunk ids are derived from the file, the chunk position and the chunk digest, so
+    parsing the same file again yields the same ids.
+    """
+    from llama_index.core import SimpleDirectoryReader
+    from llama_index.core.node_parser import SentenceSplitter
+    documents = SimpleDirectoryReader(input_files=[path]).load_data()
+    chunks = []
+    for node in SentenceSplitter(chunk_size=CHUNK_SIZE).get_nodes_from_documents(documents):
+        digest = chunk_digest(node)
+        node.id_ = sha1(f"{key}\0{len(chunks)}\0{digest}".encode()).hexdigest()
+        chunks.append((node, digest))
+    return chunks
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize the unicode form and whitespace of a query, so near-identical queries share cache entries.
+    """
+    return " ".join(unicodedata.normalize("NFKC", query).split())
+
+def reciprocal_rank_fusion(rankings: List[List[Tuple[int, float]]], k: int = 60) -> List[Tuple[int, float]]:
+    """
+    Fuse rankings of (row, score) pairs by summing 1 / (k + rank) over the rankings of every row.
+    The scores of the rankings are ignored, so rankings with incomparable scores can be fused.
+    """
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, (row, _) in enumerate(ranking, 1):
+            fused[row] = fused.get(row, 0.0) + 1 / (k + rank)
+    return sorted(fused.items(), key=lambda item: -item[1])
+
+def maximal_marginal_relevance(query: np.ndarray, vectors: np.ndarray, top_k: int,
+                               diversity: float = 0.3) -> List[int]:
+    """
+    Pick `top_k` of the candidate `vectors` that are relevant to the query but not redundant with
+    each other, returning their indices in the order they were picked.
+    """
+    relevance = vectors @ query
+    similarity = vectors @ vectors.T
+    picked: List[int] = []
+    redundancy = np.full(len(vectors), -np.inf, dtype=np.float32)
+    while len(picked) < min(top_k, len(vectors)):
+        scores = (1 - diversity) * relevance - diversity * np.maximum(redundancy, 0)
+        scores[picked] = -np.inf
+        index = int(scores.argmax())
+        picked.append(index)
+        redundancy = np.maximum(redundancy, similarity[index])
+    return picked
+
+def node_record(node: BaseNode) -> Dict[str, Any]:
+    """
+    Return what the vector store keeps of a chunk to rebuild it at query time.
+    """
+    from llama_index.core.schema import MetadataMode
+    return {
+        "text": node.get_content(metadata_mode=MetadataMode.NONE),
+        "metadata": node.metadata,
+        "excluded_embed_metadata_keys": node.excluded_embed_metadata_keys,
+        "excluded_llm_metadata_keys": node.excluded_llm_metadata_keys,
+        "start_char_idx": getattr(node, "start_char_idx", None),
+        "end_char_idx": getattr(node, "end_char_idx", None),
+    }
+
+def record_node(record: Dict[str, Any]) -> TextNode:
+    """
+    Rebuild a chunk from its record in the vector store.
+    """
+    from llama_index.core.schema import TextNode
+    return TextNode(id_=record.pop("id"), **record)
+
 class DocumentRetriever:
     """
     A class for retrieving and indexing documents using the llama-index library.
 
+    The index is kept up to date incrementally: a manifest stored next to it records the
+    content hash of every indexed file and of each of its chunks. On startup only new or
+    changed files are parsed, only chunks whose text changed are embedded again, and the
+    chunks of deleted files are removed.
+
+    Changed files are ingested as a stream: they are parsed and split in a process pool,
+    embedded in batches and written to the index in bounded batches, after each of which the
+    manifest is checkpointed, so an interrupted run picks up where it stopped.
+
+    Embeddings are kept in a memory-mapped `VectorStore`, so loading the index does not
+    depend on the size of the corpus and worker processes share one copy of it. Searches are
+    exact unless `ann` selects an approximate `IVFIndex` for very large corpora. Query
+    embeddings and retrieval results are cached; cached results are keyed by the index
+    version, so they are invalidated as soon as the indexed documents change.
+
+    With `retrieval="hybrid"`, a BM25 keyword index over the same chunks finds exact terms
+    such as part numbers and error codes that embeddings miss, and its ranking is fused with
+    the vector ranking by reciprocal rank fusion. A `reranker` then picks the final chunks
+    from the fused candidates.
+
     Args:
-        files (List[str]): List of file paths to index.
+        files (List[str]): List of file paths to index, relative to the 'files' directory. Indexes every file in it if empty.
         verbose (bool): Whether to enable verbose logging.
         mode (str): Retrieval mode. Can be one of "subtle", "default", "aggressive", or "very-aggressive".
         embed_model (Optional[str]): Name of the embedding model to use. If not provided, the default model will be used.
         reset_storage (bool): Whether to reset the storage and re-index the documents.
+        workers (Optional[int]): Number of processes parsing files. Defaults to the number of cores, 1 parses in-process.
+        embed_batch_size (int): Number of chunks passed to the embedding model at once.
+        write_batch_size (int): Number of chunks written to the index between two checkpoints.
+        progress (Optional[Callable[[Dict[str, Any]], None]]): Called with the ingestion statistics after every checkpoint.
+        dtype (str): Type of the stored embeddings, "float32" or "float16" to halve the size of the index.
+        ann (Optional[str]): Approximate search backend, "ivf" or "ivf-pq" (with product quantization). Exact if None.
+        nlist (Optional[int]): Number of IVF clusters. Defaults to 4 * sqrt(chunks).
+        nprobe (int): Number of IVF clusters scanned per query; higher is slower but more accurate.
+        pq_m (int): Number of product quantization subspaces with "ivf-pq"; must divide the embedding dimension.
+        rerank (int): With "ivf-pq", candidates rescored exactly per retrieved document.
+        cache_size (int): Maximum number of cached query embeddings and of cached retrieval results. Disabled if 0.
+        cache_ttl (Optional[float]): Seconds after which cached embeddings and results expire. Never if None.
+        retrieval (str): "vector" for embedding similarity, "keyword" for BM25, or "hybrid" to fuse both.
+        reranker (Optional[str]): "mmr" to pick diverse chunks among the candidates, or the name of a
+            sentence-transformers cross-encoder (e.g. "cross-encoder/ms-marco-MiniLM-L-6-v2") to score them. Disabled if None.
+        candidates (int): Candidates retrieved per requested document for fusion and reranking.
+        diversity (float): Weight of diversity against relevance with the "mmr" reranker, between 0 and 1.
 
     Attributes:
         similarity_index (int): The similarity index based on the retrieval mode.
         verbose (bool): Whether verbose logging is enabled.
         init_time (float): The timestamp when the instance was initialized.
         persist_dir (pathlib.Path): The directory where the index storage is persisted.
-        index (VectorStoreIndex): The vector store index for document retrieval.
+        store (VectorStore): The vector store holding the embedded chunks.
+        manifest (Dict[str, Any]): The indexed files with their content hashes and chunks.
+        ingest_stats (Optional[Dict[str, Any]]): Progress and throughput of the last ingestion, if anything changed.
+        ann_index (Optional[IVFIndex]): The approximate search index, if enabled.
+        ann_report (Optional[Dict[str, Any]]): Recall@k and latencies against an exact search, measured when the
+            approximate index was last trained.
+        embedding_cache (LRUCache): Query embeddings by normalized query.
+        result_cache (LRUCache): Retrieved documents by normalized query, number of documents and index version.
+        keyword_index (Optional[BM25Index]): The keyword index, unless retrieval is "vector".
     """
 
     def __init__(self, files: List[str] = [], verbose: bool = False, mode: str = "default",
-                 embed_model: Optional[str] = None, reset_storage: bool = False) -> None:
+                 embed_model: Optional[str] = None, reset_storage: bool = False, workers: Optional[int] = None,
+                 embed_batch_size: int = 64, write_batch_size: int = 1024,
+                 progress: Optional[Callable[[Dict[str, Any]], None]] = None, dtype: str = "float32",
+                 ann: Optional[str] = None, nlist: Optional[int] = None, nprobe: int = 8, pq_m: int = 8,
+                 rerank: int = 10, cache_size: int = 1024, cache_ttl: Optional[float] = None,
+                 retrieval: str = "vector", reranker: Optional[str] = None, candidates: int = 4,
+                 diversity: float = 0.3) -> None:
+        if ann not in (None, "ivf", "ivf-pq"):
+            raise ValueError(f"Unknown approximate search backend '{ann}', expected 'ivf' or 'ivf-pq'")
+        if retrieval not in ("vector", "keyword", "hybrid"):
+            raise ValueError(f"Unknown retrieval '{retrieval}', expected 'vector', 'keyword' or 'hybrid'")
         self.similarity_index = modes[mode]
         self.verbose = verbose
         self.init_time = time.time()
+        self.workers = workers
+        self.embed_batch_size = embed_batch_size
+        self.write_batch_size = write_batch_size
+        self.progress = progress
+        self.dtype = dtype
+        self.ingest_stats: Optional[Dict[str, Any]] = None
+        self.ann_report: Optional[Dict[str, Any]] = None
+        self.embedding_cache = LRUCache(cache_size, cache_ttl)
+        self.result_cache = LRUCache(cache_size, cache_ttl)
+        self.retrieval = retrieval
+        self.reranker = reranker
+        self.candidates = candidates
+        self.diversity = diversity
+        self.cross_encoder = None
+        if reranker is not None and reranker != "mmr":
+            try:
+                from sentence_transformers import CrossEncoder
+            except ImportError as e:
+                raise ImportError('Cross-encoder reranking requires sentence-transformers, install it with "pip install sentence-transformers"') from e
+            self.cross_encoder = CrossEncoder(reranker)
 
-        if embed_model:
-            Settings.embed_model = HuggingFaceEmbedding(model_name=embed_model)
+        # Loaded on first use, and kept per retriever instead of in the global llama-index settings
+        self.embed_model_name = embed_model
+        self._embed_model = None
+        self._embed_model_lock = threading.Lock()
 
         storage_id_token = f'!{embed_model}!' if embed_model else "!notset!"
 
-        storage_id = md5(":".join(files + [storage_id_token]).encode()).hexdigest()
+        # The storage only depends on how chunks are embedded, the indexed files are tracked by the manifest
+        storage_id = md5(f"{storage_id_token}:{CHUNK_SIZE}".encode()).hexdigest()
         self.persist_dir = BASE_ADDR / f"files/storage/storage.{storage_id}"
-        if not self.persist_dir.exists() or reset_storage:
-            self._index_documents(files)
+        self.manifest_path = self.persist_dir / "manifest.json"
+        manifest = json.loads(self.manifest_path.read_text()) if self.manifest_path.exists() else {}
+        # Storage written in an older format is indexed again from scratch
+        if reset_storage or manifest.get("version") != MANIFEST_VERSION:
+            self._create_index()
         else:
             self._load_index()
+        self.keyword_index = BM25Index(self.persist_dir / "bm25") if retrieval != "vector" else None
+        self.ann_index: Optional[IVFIndex] = None
+        if ann is not None:
+            self.ann_index = IVFIndex(
+                self.persist_dir / ann, nlist, nprobe, pq_m if ann == "ivf-pq" else None, rerank
+            )
+        self._index_documents(files)
+        # Also builds indexes that do not exist yet for an unchanged corpus
+        self._update_indexes()
+
+    def _resolve_files(self, files: List[str]) -> Dict[str, pathlib.Path]:
+        """
+        Map the manifest key of every file to index to its path.
+        """
+        files_dir = (BASE_ADDR / "files").resolve()
+        if not files:
+            paths = [path for path in files_dir.iterdir() if path.is_file() and not path.name.startswith(".")]
+        else:
+            paths = [files_dir / file for file in files]
+            missing = [file for file, path in zip(files, paths) if not path.is_file()]
+            if missing:
+                # Raised before the index is touched, so a typo does not drop the file from it
+                raise FileNotFoundError(f"Files to index not found in {files_dir}: {', '.join(map(str, missing))}")
+        resolved = {}
+        for path in paths:
+            path = path.resolve()
+            try:
+                key = path.relative_to(files_dir).as_posix()
+            except ValueError:
+                key = str(path)
+            resolved[key] = path
+        return resolved
+
+    def _create_index(self) -> None:
+        """
+        Start from an empty index and manifest.
+        """
+        if self.persist_dir.exists():
+            shutil.rmtree(self.persist_dir)
+        self.store = VectorStore(self.persist_dir / "vectors", self.dtype)
+        self.manifest = {"version": MANIFEST_VERSION, "files": {}}
 
     def _index_documents(self, files: List[str]) -> None:
         """
-        Index the documents using the llama-index library.
+        Bring the index in line with the given files, only parsing and embedding what changed.
+
+        Changed files are parsed and split in a process pool while the main process embeds the
+        chunks that are ready, so parsing, embedding and writing overlap. The index is written
+        and the manifest checkpointed every `write_batch_size` chunks, so an interrupted run
+        resumes with the files that were not written yet.
 
         Args:
             files (List[str]): List of file paths to index.
         """
+        start_time = time.time()
+        indexed = self.manifest["files"]
+        paths = self._resolve_files(files)
+
+        changed = {}
+        for key, path in paths.items():
+            stat = path.stat()
+            entry = indexed.get(key)
+            if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+                continue
+            digest = file_digest(path)
+            if entry is not None and entry["sha256"] == digest:
+                # Touched but not modified
+                entry["mtime"] = stat.st_mtime_ns
+                continue
+            changed[key] = {"sha256": digest, "size": stat.st_size, "mtime": stat.st_mtime_ns, "chunks": {}}
+        removed = [key for key in indexed if key not in paths]
+        if not changed and not removed:
+            if self.verbose:
+                logger.info(f"Index up to date: {time.time() - start_time:.4f}s")
+            return
+
+        # Keep the embeddings of outdated chunks, so that unchanged (or moved) text is not embedded again
+        outdated, embeddings = [], {}
+        for key in list(changed) + removed:
+            for node_id, digest in indexed.get(key, {}).get("chunks", {}).items():
+                outdated.append(node_id)
+                try:
+                    embeddings[digest] = self.store.get(node_id)
+                except KeyError:
+                    pass
+        self.store.delete(outdated)
+        # Changed files only get their entry back once their chunks are written
+        for key in list(changed) + removed:
+            indexed.pop(key, None)
+
+        self.ingest_stats = stats = {
+            "documents": 0, "total_documents": len(changed), "chunks": 0, "embedded": 0, "reused": 0,
+            "elapsed": 0.0, "documents_per_second": 0.0, "chunks_per_second": 0.0,
+        }
+        nodes, written = [], []
+
+        def write() -> None:
+            self._write_nodes(nodes)
+            for key in written:
+                indexed[key] = changed[key]
+            self._persist()
+            stats["embedded"] = stats["chunks"] - stats["reused"]
+            stats["elapsed"] = elapsed = time.time() - start_time
+            stats["documents_per_second"] = stats["documents"] / elapsed if elapsed else 0.0
+            stats["chunks_per_second"] = stats["chunks"] / elapsed if elapsed else 0.0
+            if self.progress is not None:
+                self.progress(dict(stats))
+            if self.verbose:
+                logger.info(
+                    f"Indexed {stats['documents']}/{stats['total_documents']} documents, {stats['chunks']} chunks: "
+                    f"{stats['documents_per_second']:.2f} docs/s, {stats['chunks_per_second']:.2f} chunks/s"
+                )
+            nodes.clear()
+            written.clear()
+
+        for key, chunks in self._iter_parsed([(key, paths[key]) for key in changed]):
+            for node, digest in chunks:
+                node.embedding = embeddings.get(digest)
+                stats["reused"] += node.embedding is not None
+                changed[key]["chunks"][node.id_] = digest
+                nodes.append(node)
+            stats["documents"] += 1
+            stats["chunks"] += len(chunks)
+            written.append(key)
+            if len(nodes) >= self.write_batch_size:
+                write()
+        write()
         if self.verbose:
-            start_time = time.time()
-        documents = SimpleDirectoryReader(str(BASE_ADDR / "files")).load_data()
-        if self.verbose:
-            read_documents_time = time.time() - start_time
-            logger.info(f"Read documents: {read_documents_time:.4f}s")
-        self.index = VectorStoreIndex.from_documents(
-            documents, transformations=[SentenceSplitter(chunk_size=512)]
-        )
+            logger.info(
+                f"Indexed {len(changed)} changed and removed {len(removed)} documents, "
+                f"embedded {stats['embedded']} chunks and reused {stats['reused']}: {time.time() - start_time:.4f}s"
+            )
+
+    def _iter_parsed(self, files: List[Tuple[str, pathlib.Path]]) -> Iterator[Tuple[str, List[Tuple[BaseNode, str]]]]:
+        """
+        Parse and split files in a process pool, yielding the chunks of each file as soon as it is done.
+        """
+        workers = min(self.workers or os.cpu_count() or 1, len(files))
+        if workers <= 1:
+            for key, path in files:
+                yield key, parse_file(str(path), key)
+            return
+        pending = iter(files)
+        futures = {}
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            # At most two files per worker are in flight, so parsed documents cannot pile up in memory
+            for key, path in itertools.islice(pending, 2 * workers):
+                futures[executor.submit(parse_file, str(path), key)] = key
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = futures.pop(future)
+                    for next_key, path in itertools.islice(pending, 1):
+                        futures[executor.submit(parse_file, str(path), next_key)] = next_key
+                    yield key, future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _write_nodes(self, nodes: List[BaseNode]) -> None:
+        """
+        Embed the chunks that have no embedding yet in batches of `embed_batch_size` and add them to the store.
+        """
+        from llama_index.core.schema import MetadataMode
+        missing = [node for node in nodes if node.embedding is None]
+        for start in range(0, len(missing), self.embed_batch_size):
+            batch = missing[start:start + self.embed_batch_size]
+            embeddings = self.embed_model.get_text_embedding_batch(
+                [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+            )
+            for node, embedding in zip(batch, embeddings):
+                node.embedding = embedding
+        self.store.add([node.id_ for node in nodes], [node.embedding for node in nodes], [node_record(node) for node in nodes])
+
+    def _persist(self) -> None:
+        compacted = self.store.deleted > len(self.store)
+        if compacted:
+            self.store.compact()
+        self.store.flush()
+        self._update_indexes(compacted)
+        # The manifest is written last, so after an interrupted run the files are compared with the previous one
+        temporary = self.manifest_path.with_suffix(".tmp")
+        temporary.write_text(json.dumps(self.manifest))
+        temporary.replace(self.manifest_path)
+
+    def _update_indexes(self, rebuild: bool = False) -> None:
+        """
+        Add new chunks to the keyword and approximate indexes, or build them again if `rebuild`,
+        since compacting the store renumbers its rows. Training the approximate index is followed
+        by measuring its recall against an exact search.
+        """
+        if self.keyword_index is not None:
+            if rebuild:
+                self.keyword_index.build(self.store)
+            else:
+                self.keyword_index.update(self.store)
+        if self.ann_index is None or len(self.store) < MIN_ROWS:
+            return
+        start_time = time.time()
+        if rebuild:
+            self.ann_index.build(self.store)
+        elif not self.ann_index.update(self.store):
+            return
+        self.ann_report = {**self.ann_index.evaluate(self.store, self.similarity_index), "build_time": time.time() - start_time}
         if self.verbose:
-            index_documents_time = time.time() - read_documents_time
-            logger.info(f"Indexed documents: {index_documents_time:.4f}s")
-        self.index.storage_context.persist(persist_dir=str(self.persist_dir))
+            logger.info(
+                f"Trained {self.ann_report['nlist']} clusters: recall@{self.ann_report['top_k']} "
+                f"{self.ann_report['recall_at_k']:.4f} at nprobe {self.ann_report['nprobe']}, "
+                f"{self.ann_report['ann_latency_ms']:.2f}ms vs {self.ann_report['exact_latency_ms']:.2f}ms exact"
+            )
 
     def _load_index(self) -> None:
         """
-        Load the persisted index from storage.
+        Load the persisted index and its manifest from storage.
         """
         if self.verbose:
             start_time = time.time()
-        storage_context = StorageContext.from_defaults(persist_dir=str(self.persist_dir))
-        self.index = load_index_from_storage(storage_context)
+        self.store = VectorStore(self.persist_dir / "vectors", self.dtype)
+        self.manifest = json.loads(self.manifest_path.read_text())
         if self.verbose:
             load_index_time = time.time() - start_time
             logger.info(f"Loaded index: {load_index_time:.4f}s")
 
-    def retrieve(self, query: str) -> Union[str, List[Any]]:
+    def retrieve_batch(self, queries: List[str], top_k: Optional[int] = None) -> List[List[NodeWithScore]]:
+        """
+        Retrieve documents for several queries with a single pass over the stored embeddings.
+
+        Args:
+            queries (List[str]): The query strings.
+            top_k (Optional[int]): Number of documents per query. Defaults to the one of the retrieval mode.
+
+        Returns:
+            List[List[NodeWithScore]]: The retrieved documents of every query, most similar first.
+        """
+        top_k = top_k or self.similarity_index
+        queries = [normalize_query(query) for query in queries]
+        version = self.index_version
+        retrieved = [self.result_cache.get((query, top_k, version)) for query in queries]
+        missing = [index for index, result in enumerate(retrieved) if result is None]
+        if missing:
+            from llama_index.core.schema import NodeWithScore
+            results = self._search([queries[index] for index in missing], top_k)
+            for index, result in zip(missing, results):
+                retrieved[index] = [
+                    NodeWithScore(node=record_node(self.store.record(row)), score=score) for row, score in result
+                ]
+                self.result_cache.put((queries[index], top_k, version), retrieved[index])
+        # The cached lists are shared, hand out copies
+        return [list(result) for result in retrieved]
+
+    def _search(self, queries: List[str], top_k: int) -> List[List[Tuple[int, float]]]:
+        """
+        Return the (row, score) pairs of the documents retrieved for every query.
+        """
+        # Fusion and reranking choose among more candidates than they return
+        limit = top_k if self.retrieval != "hybrid" and self.reranker is None else self.candidates * top_k
+        embeddings = None
+        if self.retrieval != "keyword" or self.reranker == "mmr":
+            embeddings = [self._embed_query(query) for query in queries]
+        if self.retrieval != "keyword":
+            if self.ann_index is not None:
+                vector_results = self.ann_index.search(self.store, embeddings, limit)
+            else:
+                vector_results = self.store.search(embeddings, limit)
+        if self.retrieval == "vector":
+            results = vector_results
+        else:
+            results = [self.keyword_index.search(self.store, query, limit) for query in queries]
+            if self.retrieval == "hybrid":
+                results = [reciprocal_rank_fusion(rankings) for rankings in zip(vector_results, results)]
+        if self.reranker == "mmr":
+            reranked = []
+            for embedding, result in zip(embeddings, results):
+                embedding = np.asarray(embedding, dtype=np.float32)
+                embedding /= np.linalg.norm(embedding) or 1
+                vectors = np.asarray(self.store.vectors[[row for row, _ in result]], dtype=np.float32)
+                reranked.append([result[index] for index in maximal_marginal_relevance(embedding, vectors, top_k, self.diversity)])
+            results = reranked
+        elif self.cross_encoder is not None:
+            reranked = []
+            for query, result in zip(queries, results):
+                if not result:
+                    reranked.append(result)
+                    continue
+                scores = self.cross_encoder.predict([(query, self.store.record(row)["text"]) for row, _ in result])
+                reranked.append(sorted(
+                    ((row, float(score)) for (row, _), score in zip(result, scores)), key=lambda item: -item[1]
+                ))
+            results = reranked
+        return [result[:top_k] for result in results]
+
+    def _embed_query(self, query: str) -> List[float]:
+        embedding = self.embedding_cache.get(query)
+        if embedding is None:
+            embedding = self.embed_model.get_query_embedding(query)
+            self.embedding_cache.put(query, embedding)
+        return embedding
+
+    @property
+    def embed_model(self) -> Any:
+        """
+        The embedding model, loaded on first use. Without an `embed_model` name, the default of llama-index.
+        """
+        with self._embed_model_lock:
+            if self._embed_model is None:
+                if self.embed_model_name:
+                    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+                    self._embed_model = HuggingFaceEmbedding(model_name=self.embed_model_name)
+                else:
+                    from llama_index.core import Settings
+                    self._embed_model = Settings.embed_model
+            return self._embed_model
+
+    @property
+    def index_version(self) -> int:
+        """Changes whenever chunks are added to or removed from the index."""
+        return self.store.version
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Identifies the indexed documents and the retrieval settings across runs, so that answers
+        generated from retrieved documents can be cached until either changes.
+        """
+        version, fingerprint = getattr(self, "_fingerprint", (None, None))
+        if version != self.index_version:
+            files = sorted((key, entry["sha256"]) for key, entry in self.manifest["files"].items())
+            settings = (self.persist_dir.name, self.similarity_index, self.retrieval, self.reranker, self.candidates, self.diversity)
+            fingerprint = sha1(json.dumps([files, settings]).encode()).hexdigest()
+            self._fingerprint = (self.index_version, fingerprint)
+        return fingerprint
+
+    @property
+    def cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        """The size, hits, misses and hit rate of the query embedding and retrieval result caches."""
+        return {"embeddings": self.embedding_cache.to_json(), "results": self.result_cache.to_json()}
+
+    def retrieve(self, query: str) -> Union[str, List[NodeWithScore]]:
         """
         Retrieve documents based on the given query.
 
@@ -104,12 +592,11 @@ class DocumentRetriever:
             query (str): The query string.
 
         Returns:
-            Union[str, List[Any]]: The retrieved documents or an error message.
+            Union[str, List[NodeWithScore]]: The retrieved documents or an error message.
         """
         query_start_time = time.time()
         try:
-            retriever = self.index.as_retriever(similarity_top_k=self.similarity_index)
-            response = retriever.retrieve(query)
+            response = self.retrieve_batch([query])[0]
         except Exception as e:
             logger.error(f"Error during query processing: {str(e)}")
             return "An error occurred while processing the query."
@@ -120,37 +607,50 @@ class DocumentRetriever:
             logger.info(f"Total time: {total_time:.4f}s")
         return response
 
-    def retrieve_for_llm(self, query_str: str) -> str:
+    def retrieve_for_llm(self, query_str: str, token_budget: Optional[int] = None,
+                         count_tokens: Optional[Callable[[str], int]] = None, stats: Optional[Dict] = None) -> str:
         """
         Retrieve documents for the given query and format them for LLM input.
 
+        Retrieved chunks are packed with a `ContextPacker`: duplicates are dropped, overlapping or
+        adjacent chunks of the same document are merged, and the lowest-scoring text is cut first
+        so that the whole prompt fits the token budget.
+
         Args:
             query_str (str): The query string.
+            token_budget (Optional[int]): Maximum number of tokens of the prompt. Unlimited if None.
+            count_tokens (Optional[Callable[[str], int]]): Counts the tokens of a text, with the tokenizer
+                of the target model if possible. Defaults to an estimate from the text length.
+            stats (Optional[Dict]): Filled with packing statistics, such as the number of context tokens used.
 
         Returns:
             str: The formatted prompt with retrieved context information.
         """
         retrieval_data = self.retrieve(query_str)
-        context_batches = ''
-
-        for node_with_score in retrieval_data:
-            node = node_with_score.node
-            score = node_with_score.score
-            text = node.text
-            metadata = node.metadata
-            page_label = metadata['page_label']
-            file_name = metadata['file_name']
-            batch = '\n'.join([f'content: \n{text}', f'----\npage_label: {page_label}', f'file name: {file_name}', f'similarity score: {score}'])
-            context_batches += (batch + '\n---')
-
-        prompt = (f'Context information is below.\n'
-                  + '---------------------\n'
-                  + f'{context_batches}\n'
-                  + '---------------------\n'
-                  + 'Given the context information and not prior knowledge, answer the query.\n'
-                  + f'Query: {query_str}\n'
-                  + 'Answer: ')
-
-        return prompt
+        if isinstance(retrieval_data, str):
+            # Retrieval failed, answer without context
+            retrieval_data = []
+
+        template = (f'Context information is below.\n'
+                    + '---------------------\n'
+                    + '{context}\n'
+                    + '---------------------\n'
+                    + 'Given the context information and not prior knowledge, answer the query.\n'
+                    + 'Query: {query}\n'
+                    + 'Answer: ')
+        packer = ContextPacker(count_tokens or approximate_tokens)
+        if token_budget is not None:
+            token_budget = max(0, token_budget - packer.count_tokens(template.format(context='', query=query_str)))
+        context, packing = packer.pack(retrieval_data, token_budget)
+
+        if stats is not None:
+            stats.update(packing)
+        if self.verbose:
+            logger.info(
+                f"Packed {packing['chunks']} chunks into {packing['blocks']} blocks, {packing['context_tokens']} tokens "
+                f"({packing['duplicates']} duplicates, {packing['merged']} merged, {packing['dropped']} dropped)"
+            )
+
+        return template.format(context=context, query=query_str)
 
 __all__ = ['DocumentRetriever']
\ No newline at end of file
@@ -1,7 +1,135 @@
+from __future__ import annotations
+
 import os
-from typing import Iterator, List, Dict, Any
-from llama_cpp import Llama
-from ._docs import DocumentRetriever
+import time
+from hashlib import md5
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Dict, Any, TYPE_CHECKING
+from ._pool  import ModelPool, PooledModel, default_pool, prefetch_file
+from ._grammar import get_grammar
+from ._metrics import TokenCounter
+
+# llama-cpp, numpy and the modules built on them are imported when first used
+if TYPE_CHECKING:
+    from llama_cpp import Llama
+    from ._docs import DocumentRetriever
+    from ._speculative import SpeculationCounter
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../models/')
+
+def get_model_path(model: str) -> str:
+    """
+    Resolves a model name to the path of its '.gguf' file in the models directory.
+
+    Args:
+        model (str): The name of the model file (without the '.gguf' extension).
+
+    Returns:
+        str: The full path to the model file.
+
+    Raises:
+        FileNotFoundError: If the specified model file is not found.
+    """
+    full_model_path = os.path.join(MODEL_DIR, model + '.gguf')
+    if not os.path.isfile(full_model_path):
+        raise FileNotFoundError(f"Model file '{full_model_path}' not found.")
+    return full_model_path
+
+def get_load_params(**kwargs: Any) -> Dict[str, Any]:
+    """
+    Extracts the parameters that determine how a model is loaded from the completion keyword arguments.
+    """
+    return {
+        'n_gpu_layers': kwargs.get('n_gpu_layers', 0),
+        'n_threads': kwargs.get('threads', None),
+        'use_mmap': kwargs.get('use_mmap', True),
+        'use_mlock': kwargs.get('use_mlock', False),
+        'offload_kqv': kwargs.get('offload_kqv', True),
+        'n_ctx': kwargs.get('n_ctx', 4900),
+        # Verifying drafts needs the logits of every position, so speculative decoding uses
+        # its own resident instance of the model created with them
+        'logits_all': bool(kwargs.get('speculative') or kwargs.get('draft_model')),
+    }
+
+def format_prompt(llm: Llama, messages: List[Dict[str, str]]) -> List[int]:
+    """
+    Applies the chat template used by the engine to the messages and tokenizes the result.
+    """
+    from llama_cpp.llama_chat_format import format_mistral_instruct
+    result = format_mistral_instruct(messages=messages)
+    return llm.tokenize(result.prompt.encode('utf-8'), add_bos=not result.added_special, special=True)
+
+def get_token_counter(llm: Llama) -> Callable[[str], int]:
+    """
+    Returns a function counting the tokens of a text with the tokenizer of a model.
+    """
+    return lambda text: len(llm.tokenize(text.encode('utf-8'), add_bos=False, special=False))
+
+def get_context_budget(context_window: int, conversation_tokens: int, **kwargs: Any) -> int:
+    """
+    Returns how many tokens the retrieval-augmented last message may use: what is left of the
+    context window once the rest of the conversation is in and room is kept for the answer,
+    capped by `context_budget` if set. Takes the request options as keyword arguments, which
+    may include the `n_ctx` the model was loaded with.
+    """
+    reserve = min(kwargs.get('max_tokens') or context_window, context_window // 4)
+    available = max(0, context_window - conversation_tokens - reserve)
+    budget = kwargs.get('context_budget')
+    return available if budget is None else min(budget, available)
+
+def attach_prefix_cache(entry: PooledModel, **kwargs: Any) -> None:
+    """
+    Enables (or disables) prefix caching on a checked out model for the current request.
+
+    The cache belongs to the pooled model, so it is shared by every request to that model
+    and survives between requests for as long as the model stays resident.
+    """
+    if not kwargs.get('prefix_cache'):
+        entry.llm.set_cache(None)
+        return
+    if entry.cache is None:
+        from ._cache import PrefixCache
+        cache_dir = kwargs.get('prefix_cache_dir')
+        if cache_dir is not None:
+            cache_dir = os.path.join(cache_dir, md5(repr(entry.key).encode()).hexdigest())
+        entry.cache = PrefixCache(kwargs.get('prefix_cache_size', 2 << 30), cache_dir)
+        entry.cache.llm = entry.llm
+    entry.cache.last_lookup = None
+    entry.llm.set_cache(entry.cache)
+
+def attach_draft_model(entry: PooledModel, **kwargs: Any) -> SpeculationCounter:
+    """
+    Sets up speculative decoding on a checked out model for the current request.
+
+    With `speculative='prompt-lookup'` tokens are drafted by matching the last n-gram of the
+    sequence against the prompt, which pays off when the answer copies from the context.
+    With `speculative='draft'` (or just a `draft_model`) a small model from the models
+    directory drafts the tokens. Drafts are verified by the target model, so the output is
+    the same as without speculation.
+
+    Returns:
+        SpeculationCounter: The draft model in use, or None if speculation is disabled.
+    """
+    from ._speculative import ModelDraft, SpeculationCounter, LlamaPromptLookupDecoding, enable_speculation
+    mode = kwargs.get('speculative')
+    if mode is None and kwargs.get('draft_model'):
+        mode = 'draft'
+    if not mode:
+        enable_speculation(entry.llm, None)
+        return None
+    num_pred_tokens = kwargs.get('draft_tokens', 8)
+    if mode == 'prompt-lookup':
+        draft_model = LlamaPromptLookupDecoding(kwargs.get('draft_ngram_size', 3), num_pred_tokens)
+    elif mode == 'draft':
+        if not kwargs.get('draft_model'):
+            raise ValueError("speculative='draft' requires a draft_model")
+        draft_path = get_model_path(kwargs['draft_model'])
+        draft_model = ModelDraft(entry.get_draft_model(draft_path, **get_load_params(**kwargs)), num_pred_tokens)
+    else:
+        raise ValueError(f"Unknown speculative decoding mode '{mode}', expected 'prompt-lookup' or 'draft'")
+    counter = SpeculationCounter(draft_model, mode)
+    enable_speculation(entry.llm, counter)
+    return counter
 
 class LocalProvider:
     """
@@ -9,7 +137,47 @@ class LocalProvider:
     """
 
     @staticmethod
-    def create_completion(model: str, messages: List[Dict[str, str]], document_retriever: DocumentRetriever = None, **kwargs: Any) -> Iterator[str]:
+    def load_model(model: str, model_pool: ModelPool = None, **kwargs: Any) -> None:
+        """
+        Loads a model into the pool ahead of the first request.
+
+        Args:
+            model (str): The name of the model file (without the '.gguf' extension).
+            model_pool (ModelPool, optional): The pool to load the model into. Defaults to the process-wide pool.
+            **kwargs: The load parameters, as accepted by `create_completion`. With `warm=True`, a
+                memory-mapped model file is read into the page cache first, so that the first
+                request does not page the weights in from disk.
+        """
+        model_pool = default_pool if model_pool is None else model_pool
+        full_model_path = get_model_path(model)
+        load_params = get_load_params(**kwargs)
+        if kwargs.get('warm') and load_params['use_mmap']:
+            prefetch_file(full_model_path)
+        model_pool.load(full_model_path, **load_params)
+
+    @staticmethod
+    @contextmanager
+    def token_counter(model: str, model_pool: ModelPool = None, stats: Dict[str, Any] = None,
+                      **kwargs: Any) -> Iterator[Callable[[str], int]]:
+        """
+        Lends a function counting the tokens of a text with the tokenizer of a model, which stays
+        loaded while it is in use.
+
+        Args:
+            model (str): The name of the model file (without the '.gguf' extension).
+            model_pool (ModelPool, optional): The pool that keeps loaded models resident. Defaults to the process-wide pool.
+            stats (Dict[str, Any], optional): Receives the `load_time` if the model had to be loaded.
+            **kwargs: The load parameters, as accepted by `create_completion`.
+        """
+        model_pool = default_pool if model_pool is None else model_pool
+        stats = {} if stats is None else stats
+        with model_pool.pin(get_model_path(model), **get_load_params(**kwargs)) as entry:
+            stats.setdefault('load_time', entry.load_time if entry.uses == 1 else 0.0)
+            yield get_token_counter(entry.llm)
+
+    @staticmethod
+    def create_completion(model: str, messages: List[Dict[str, str]], document_retriever: DocumentRetriever = None,
+                          model_pool: ModelPool = None, stats: Dict[str, Any] = None, **kwargs: Any) -> Iterator[str]:
         """
         Creates a completion using the specified model and messages.
 
@@ -17,7 +185,10 @@ class LocalProvider:
             model (str): The name of the model file (without the '.gguf' extension).
             messages (List[Dict[str, str]]): A list of message dictionaries, where each dictionary contains a 'role' and 'content' key.
             document_retriever (DocumentRetriever, optional): An instance of the DocumentRetriever class for retrieving relevant documents. Defaults to None.
-            **kwargs: Additional keyword arguments to pass to the Llama constructor and create_chat_completion method.
+            model_pool (ModelPool, optional): The pool that keeps loaded models resident. Defaults to the process-wide pool.
+            stats (Dict[str, Any], optional): A dictionary that is filled with statistics about the request, such as
+                token counts, timings in seconds and prefix cache reuse.
+            **kwargs: Additional keyword arguments to pass to the Llama constructor and create_completion method.
 
         Returns:
             Iterator[str]: An iterator yielding the generated completion tokens.
@@ -25,43 +196,80 @@ class LocalProvider:
         Raises:
             FileNotFoundError: If the specified model file is not found.
         """
-        model_path = model + '.gguf'
-        model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../models/')
-        full_model_path = os.path.join(model_dir, model_path)
-
-        if not os.path.isfile(full_model_path):
-            raise FileNotFoundError(f"Model file '{full_model_path}' not found.")
-
-        # Initialize the Llama engine with the specified model and parameters
-        engine = Llama(
-            model_path=full_model_path,
-            chat_format="mistral-instruct",
-            verbose=False,
-            n_gpu_layers=kwargs.get('n_gpu_layers', 0),
-            n_threads=kwargs.get('threads', None),
-            use_mmap=kwargs.get('use_mmap', True),
-            use_mlock=kwargs.get('use_mlock', False),
-            offload_kqv=kwargs.get('offload_kqv', True),
-            n_ctx=kwargs.get('context_window', 4900),
-        )
+        full_model_path = get_model_path(model)
+        model_pool = default_pool if model_pool is None else model_pool
+        stats = {} if stats is None else stats
 
+        load_params = get_load_params(**kwargs)
         if document_retriever:
-            # Retrieve relevant documents and update the last message content
-            prompt = document_retriever.retrieve_for_llm(messages[-1]['content'])
-            messages[-1]['content'] = prompt
-
-        # Generate the completion using the Llama engine
-        completion = engine.create_chat_completion(
-            messages=messages,
-            stream=True,
-            temperature=kwargs.get('temperature', 0.8),
-            max_tokens=kwargs.get('max_tokens', 4900),
-        )
-
-        # Yield the generated completion tokens
-        for token in completion:
-            val = token['choices'][0]['delta'].get('content')
-            if val:
-                yield val
-
-__all__ = ['LocalProvider']
\ No newline at end of file
+            # Retrieve relevant documents into a new last message,
+            # packing them into the context window as counted by the model's tokenizer
+            with model_pool.pin(full_model_path, **load_params) as entry:
+                stats.setdefault('load_time', entry.load_time if entry.uses == 1 else 0.0)
+                start = time.perf_counter()
+                history = [*messages[:-1], {**messages[-1], 'content': ''}]
+                budget = get_context_budget(entry.llm.n_ctx(), len(format_prompt(entry.llm, history)), **kwargs)
+                stats['context'] = {}
+                prompt = document_retriever.retrieve_for_llm(
+                    messages[-1]['content'], budget, get_token_counter(entry.llm), stats['context']
+                )
+                messages = [*messages[:-1], {**messages[-1], 'content': prompt}]
+                stats['retrieval_time'] = time.perf_counter() - start
+
+        grammar = get_grammar(kwargs.get('response_format'))
+        if kwargs.get('batching'):
+            # Decode together with the other concurrent requests to this model
+            with model_pool.pin(full_model_path, **load_params) as entry:
+                stats.setdefault('load_time', entry.load_time if entry.uses == 1 else 0.0)
+                batcher = entry.get_batcher(kwargs.get('batch_size', 4))
+                yield from batcher.create(
+                    format_prompt(entry.llm, messages),
+                    max_tokens=kwargs.get('max_tokens', 4900),
+                    temperature=kwargs.get('temperature', 0.8),
+                    grammar=grammar,
+                    stats=stats,
+                )
+            return
+
+        from llama_cpp import StoppingCriteriaList
+        # Borrow a resident Llama engine, loading it only if it is not in the pool yet
+        with model_pool.checkout(full_model_path, **load_params) as entry:
+            stats.setdefault('load_time', entry.load_time if entry.uses == 1 else 0.0)
+            attach_prefix_cache(entry, **kwargs)
+            speculation = attach_draft_model(entry, **kwargs)
+            counter = TokenCounter()
+
+            # Generate the completion using the Llama engine
+            start = time.perf_counter()
+            completion = entry.llm.create_completion(
+                prompt=format_prompt(entry.llm, messages),
+                stream=True,
+                temperature=kwargs.get('temperature', 0.8),
+                max_tokens=kwargs.get('max_tokens', 4900),
+                stop=kwargs.get('stop'),
+                # Enforce JSON mode while decoding instead of extracting it afterwards
+                grammar=grammar,
+                stopping_criteria=StoppingCriteriaList([counter]),
+            )
+
+            # Yield the generated completion tokens
+            try:
+                for token in completion:
+                    if 'cache' not in stats and entry.llm.cache is not None:
+                        # The prefix lookup happens before the first chunk is produced
+                        stats['cache'] = entry.cache.last_lookup or {"hit": False, "reused_tokens": 0}
+                    choice = token['choices'][0]
+                    if choice.get('finish_reason') is not None:
+                        stats['finish_reason'] = choice['finish_reason']
+                    if choice['text']:
+                        yield choice['text']
+            finally:
+                stats['prompt_tokens'] = counter.prompt_tokens
+                stats['completion_tokens'] = counter.completion_tokens
+                if counter.first_token_time is not None:
+                    stats['prompt_eval_time'] = counter.first_token_time - start
+                    stats['decode_time'] = counter.last_token_time - counter.first_token_time
+                if speculation is not None:
+                    stats['speculative'] = speculation.to_json()
+
+__all__ = ['LocalProvider', 'get_model_path', 'format_prompt', 'get_context_budget', 'get_token_counter']
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import json
+from functools import lru_cache
+from typing import Any, Dict, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from llama_cpp.llama_grammar import LlamaGrammar
+
+def get_json_schema(response_format: Optional[Dict[str, Any]]) -> Optional[str]:
+    """
+    Extracts the JSON mode of a `response_format`.
+
+    Accepts `{"type": "json_object"}` with an optional `"schema"` and the OpenAI form
+    `{"type": "json_schema", "json_schema": {"schema": {...}}}`.
+
+    Returns:
+        Optional[str]: The schema serialized with sorted keys, an empty string for JSON
+            without a schema, or None if the response format does not ask for JSON.
+    """
+    if not response_format:
+        return None
+    if response_format.get("type") == "json_object":
+        schema = response_format.get("schema")
+    elif response_format.get("type") == "json_schema":
+        schema = (response_format.get("json_schema") or {}).get("schema")
+    else:
+        return None
+    return json.dumps(schema, sort_keys=True) if schema else ""
+
+@lru_cache(maxsize=64)
+def compile_grammar(schema: str) -> LlamaGrammar:
+    """
+    Compiles (and caches) the grammar for a serialized JSON schema, or for any JSON object if empty.
+    """
+    from llama_cpp.llama_grammar import LlamaGrammar, JSON_GBNF
+    if not schema:
+        return LlamaGrammar.from_string(JSON_GBNF, verbose=False)
+    return LlamaGrammar.from_json_schema(schema, verbose=False)
+
+def get_grammar(response_format: Optional[Dict[str, Any]]) -> Optional[LlamaGrammar]:
+    """
+    Returns the grammar that enforces a `response_format` during decoding, if it asks for JSON.
+    """
+    schema = get_json_schema(response_format)
+    return None if schema is None else compile_grammar(schema)
+
+__all__ = ['get_json_schema', 'get_grammar']
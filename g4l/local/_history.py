@@ -0,0 +1,193 @@
+import logging
+import threading
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from ..typing import Any, Dict, List, Optional, Messages
+
+from ._lru import LRUCache
+from ._context import approximate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Tokens added by the chat template around every message
+MESSAGE_OVERHEAD = 4
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below in at most {words} words. Keep names, facts, numbers, "
+    "decisions and open questions, and leave out greetings and filler.\n\n"
+    "{previous}"
+    "{transcript}"
+)
+
+class HistoryManager:
+    """
+    Keeps long conversations within a token budget.
+
+    The system prompt and the most recent turns are always sent. When they no longer fit the
+    budget, the window of recent turns moves forward to `keep_ratio` of the budget and the turns
+    that fall out of it are summarized by the local model on a background thread. The summary is
+    sent with the first kept user message, and is itself summarized together with the next turns
+    that fall out, so it stays short however long the conversation gets.
+
+    Requests are stateless: conversations are told apart by the content of their messages, so
+    any client that sends the full history benefits. The window only moves when the budget is
+    exceeded, which keeps the start of the prompt stable for the prefix cache in between.
+    Until the summary of the turns that just fell out is ready, they are left out of the prompt;
+    if it cannot be written, the next request sends them again and retries.
+
+    Args:
+        max_tokens (Optional[int]): Token budget of the conversation. Defaults to half of what the
+            context window leaves once room is kept for the answer.
+        keep_ratio (float): Share of the budget kept for recent turns when the window moves.
+        summarize (bool): Whether to summarize the turns that fall out of the window, or just drop them.
+        summary_words (int): Target length of the summary.
+        cache_size (int): Number of message token counts and summaries kept.
+
+    Attributes:
+        summarizer (Optional[Callable[[str, Messages], str]]): Generates a completion with the
+            given model, set by the `LocalEngine` the manager is attached to.
+    """
+
+    def __init__(self, max_tokens: Optional[int] = None, keep_ratio: float = 0.5, summarize: bool = True,
+                 summary_words: int = 150, cache_size: int = 4096) -> None:
+        if not 0 < keep_ratio <= 1:
+            raise ValueError(f"keep_ratio must be in (0, 1], got {keep_ratio}")
+        self.max_tokens = max_tokens
+        self.keep_ratio = keep_ratio
+        self.summarize = summarize
+        self.summary_words = summary_words
+        self.summarizer: Optional[Callable[[str, Messages], str]] = None
+        self.token_counts = LRUCache(cache_size)
+        # Prefix hash of the turns moved out of the window -> their summary
+        self.summaries = LRUCache(cache_size)
+        self._pending: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="g4l-history")
+
+    def count(self, model: str, message: Dict[str, str], count_tokens: Callable[[str], int]) -> int:
+        """
+        Return the number of tokens of a message, counting each distinct message only once per
+        model and kind of counter (the model's tokenizer or an estimate).
+        """
+        counter = getattr(count_tokens, '__qualname__', type(count_tokens).__qualname__)
+        key = sha1(f"{model}\0{counter}\0{message['role']}\0{message['content']}".encode("utf-8")).hexdigest()
+        tokens = self.token_counts.get(key)
+        if tokens is None:
+            tokens = count_tokens(message['content']) + MESSAGE_OVERHEAD
+            self.token_counts.put(key, tokens)
+        return tokens
+
+    def apply(self, model: str, messages: Messages, budget: int,
+              count_tokens: Callable[[str], int] = approximate_tokens,
+              stats: Optional[Dict[str, Any]] = None) -> Messages:
+        """
+        Fit a conversation into a token budget.
+
+        Args:
+            model (str): The model answering, also used to write the summaries.
+            messages (Messages): The full conversation.
+            budget (int): Token budget used if `max_tokens` is not set.
+            count_tokens (Callable[[str], int]): Counts the tokens of a text.
+            stats (Optional[Dict[str, Any]]): Filled with the number of messages kept and summarized.
+
+        Returns:
+            Messages: The messages to send, which are the input messages if they fit.
+        """
+        budget = self.max_tokens or budget
+        system = 0
+        while system < len(messages) - 1 and messages[system]['role'] == 'system':
+            system += 1
+        turns = messages[system:]
+        counts = [self.count(model, message, count_tokens) for message in messages]
+        total = sum(counts)
+        prefixes = self._prefix_hashes(turns)
+
+        # Resume from the furthest cut made earlier in this conversation
+        cut, summary = 0, ""
+        for index in range(len(turns) - 1, 0, -1):
+            known = self.summaries.get(prefixes[index])
+            if known is not None:
+                cut, summary = index, known
+                break
+        summary_tokens = count_tokens(summary) if summary else 0
+        if sum(counts[:system]) + summary_tokens + sum(counts[system + cut:]) > budget:
+            # Move the window: keep the recent turns that fit in a share of the budget
+            reserve = min(self.summary_words * 2, budget // 4) if self.summarize else 0
+            room = self.keep_ratio * (budget - sum(counts[:system]) - reserve)
+            start, used = len(turns) - 1, counts[-1]
+            while start - 1 > cut and used + counts[system + start - 1] <= room:
+                start -= 1
+                used += counts[system + start]
+            # Start the window with a user message
+            while start < len(turns) - 1 and turns[start]['role'] != 'user':
+                start += 1
+            if start > cut:
+                self._schedule(model, prefixes[start], summary, turns[cut:start])
+                cut = start
+
+        if stats is not None:
+            stats.update({
+                "messages": len(messages),
+                "kept": system + len(turns) - cut,
+                "summarized": cut,
+                "summary": bool(summary),
+                "tokens": total,
+            })
+        if cut == 0:
+            return messages
+        kept = [dict(message) for message in turns[cut:]]
+        if summary:
+            for message in kept:
+                if message['role'] == 'user':
+                    # Sent with a user message, which every chat template renders
+                    message['content'] = f"Summary of the conversation so far:\n{summary}\n\n{message['content']}"
+                    break
+        return [*messages[:system], *kept]
+
+    def close(self) -> None:
+        """Stop the summarization thread."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _prefix_hashes(self, turns: Messages) -> List[str]:
+        """
+        Return the hash of every prefix of the conversation, the n-th covering its first n turns.
+        """
+        digest, prefixes = sha1(), [sha1().hexdigest()]
+        for message in turns:
+            digest.update(f"{message['role']}\0{message['content']}\0".encode("utf-8"))
+            prefixes.append(digest.copy().hexdigest())
+        return prefixes
+
+    def _schedule(self, model: str, key: str, previous: str, turns: Messages) -> None:
+        """
+        Summarize the turns moving out of the window, with the previous summary, in the background.
+        """
+        # Until the new summary is ready, the cut is served with the previous one
+        self.summaries.put(key, previous)
+        if not self.summarize or self.summarizer is None:
+            return
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending[key] = self._executor.submit(self._summarize, model, key, previous, turns)
+
+    def _summarize(self, model: str, key: str, previous: str, turns: Messages) -> None:
+        try:
+            transcript = "\n".join(f"{message['role']}: {message['content']}" for message in turns)
+            prompt = SUMMARY_PROMPT.format(
+                words=self.summary_words,
+                previous=f"Summary of the earlier conversation:\n{previous}\n\n" if previous else "",
+                transcript=f"Conversation:\n{transcript}",
+            )
+            self.summaries.put(key, self.summarizer(model, [{"role": "user", "content": prompt}]).strip())
+        except Exception as e:
+            # Drops the placeholder, so that the next request cuts at the previous summary
+            # again and retries instead of losing these turns
+            self.summaries.discard(key)
+            logger.warning(f"Could not summarize the conversation history, retrying with the next request: {e}")
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+__all__ = ['HistoryManager']
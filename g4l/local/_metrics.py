@@ -0,0 +1,224 @@
+import time
+import threading
+from typing import Any, Dict, Optional, Sequence, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
+
+class TokenCounter:
+    """
+    A stopping criterion that never stops generation, but counts and times the sampled tokens.
+
+    The model calls its stopping criteria once per sampled token with the sequence up to that
+    token (the prompt alone for the first one), and once more at the end with the evaluated
+    tokens only, which never adds a new position.
+
+    Attributes:
+        prompt_tokens (int): Number of tokens in the prompt.
+        completion_tokens (int): Number of sampled tokens, including the end-of-generation token.
+        first_token_time (Optional[float]): `time.perf_counter()` when the first token was sampled.
+        last_token_time (Optional[float]): `time.perf_counter()` when the last token was sampled.
+    """
+
+    def __init__(self) -> None:
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.first_token_time: Optional[float] = None
+        self.last_token_time: Optional[float] = None
+        self._length = 0
+
+    def __call__(self, input_ids: "npt.NDArray[np.intc]", logits: "npt.NDArray[np.single]") -> bool:
+        length = len(input_ids)
+        if length > self._length:
+            now = time.perf_counter()
+            if self.first_token_time is None:
+                self.prompt_tokens = length
+                self.first_token_time = now
+            self.completion_tokens += 1
+            self.last_token_time = now
+            self._length = length
+        return False
+
+def get_usage(stats: Dict[str, Any]) -> Dict[str, int]:
+    """
+    Builds the `usage` block of a completion from the statistics reported by the engine.
+    """
+    prompt_tokens = stats.get("prompt_tokens", 0)
+    completion_tokens = stats.get("completion_tokens", 0)
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+    if "context" in stats:
+        # Part of the prompt tokens taken by the retrieved documents
+        usage["context_tokens"] = stats["context"].get("context_tokens", 0)
+    return usage
+
+def get_timings(stats: Dict[str, Any], time_to_first_token: Optional[float], total_time: float) -> Dict[str, Any]:
+    """
+    Builds the `timings` block of a completion (in seconds) from the statistics reported by the engine.
+
+    Args:
+        stats (Dict[str, Any]): The statistics filled in by the engine.
+        time_to_first_token (Optional[float]): Time until the first text arrived, as seen by the caller.
+        total_time (float): Time until the generation finished, as seen by the caller.
+    """
+    rounded = lambda value: None if value is None else round(value, 6)
+    decode_time = stats.get("decode_time")
+    completion_tokens = stats.get("completion_tokens", 0)
+    decode_speed = None
+    if decode_time and completion_tokens > 1:
+        # The first token is produced by the prompt evaluation
+        decode_speed = (completion_tokens - 1) / decode_time
+    return {
+        "queue_time": rounded(stats.get("queue_time")),
+        "load_time": rounded(stats.get("load_time")),
+        "retrieval_time": rounded(stats.get("retrieval_time")),
+        "prompt_eval_time": rounded(stats.get("prompt_eval_time")),
+        "time_to_first_token": rounded(time_to_first_token),
+        "decode_time": rounded(decode_time),
+        "decode_tokens_per_second": None if decode_speed is None else round(decode_speed, 2),
+        "total_time": rounded(total_time),
+        "reused_tokens": (stats.get("cache") or {}).get("reused_tokens", 0),
+    }
+
+class Histogram:
+    """
+    A cumulative histogram in the Prometheus sense.
+    """
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SPEED_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0)
+
+class MetricsRegistry:
+    """
+    Aggregates the usage and timings of completions per model, for scraping by Prometheus.
+
+    Pass an instance as `metrics` to `LocalEngine`; every finished completion is recorded
+    through `observe`. Any other callable taking `(model, completion)` works as a hook too.
+
+    Args:
+        prefix (str): Prefix of the exported metric names.
+    """
+
+    COUNTERS = {
+        "requests_total": "Completed requests.",
+        "prompt_tokens_total": "Prompt tokens processed.",
+        "completion_tokens_total": "Completion tokens generated.",
+        "reused_prompt_tokens_total": "Prompt tokens reused from the prefix cache.",
+        "model_load_seconds_total": "Time spent loading models.",
+    }
+
+    HISTOGRAMS = {
+        "queue_wait_seconds": ("Time spent waiting for a generation slot.", LATENCY_BUCKETS),
+        "time_to_first_token_seconds": ("Time until the first token was produced.", LATENCY_BUCKETS),
+        "prompt_eval_seconds": ("Time spent evaluating the prompt.", LATENCY_BUCKETS),
+        "retrieval_seconds": ("Time spent retrieving documents.", LATENCY_BUCKETS),
+        "decode_tokens_per_second": ("Generation speed after the first token.", SPEED_BUCKETS),
+    }
+
+    def __init__(self, prefix: str = "g4l") -> None:
+        self.prefix = prefix
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, model: str, completion: Any) -> None:
+        self.observe(model, completion)
+
+    def _inc(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def _observe(self, name: str, model: str, value: Optional[float]) -> None:
+        if value is None:
+            return
+        histogram = self._histograms.get((name, model))
+        if histogram is None:
+            histogram = self._histograms[(name, model)] = Histogram(self.HISTOGRAMS[name][1])
+        histogram.observe(value)
+
+    def observe(self, model: str, completion: Any) -> None:
+        """
+        Records a finished completion (or the final chunk of a stream).
+
+        Args:
+            model (str): The model that produced the completion.
+            completion (ChatCompletion | ChatCompletionChunk): The completion carrying `usage` and `timings`.
+        """
+        usage = completion.usage or {}
+        timings = completion.timings or {}
+        with self._lock:
+            self._inc("requests_total", 1, model=model, finish_reason=completion.choices[0].finish_reason or "")
+            self._inc("prompt_tokens_total", usage.get("prompt_tokens", 0), model=model)
+            self._inc("completion_tokens_total", usage.get("completion_tokens", 0), model=model)
+            self._inc("reused_prompt_tokens_total", timings.get("reused_tokens") or 0, model=model)
+            self._inc("model_load_seconds_total", timings.get("load_time") or 0, model=model)
+            self._observe("queue_wait_seconds", model, timings.get("queue_time"))
+            self._observe("time_to_first_token_seconds", model, timings.get("time_to_first_token"))
+            self._observe("prompt_eval_seconds", model, timings.get("prompt_eval_time"))
+            self._observe("retrieval_seconds", model, timings.get("retrieval_time"))
+            self._observe("decode_tokens_per_second", model, timings.get("decode_tokens_per_second"))
+
+    def to_json(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self._counters.items()
+                ],
+                "histograms": [
+                    {"name": name, "labels": {"model": model}, "count": histogram.count, "sum": histogram.sum}
+                    for (name, model), histogram in self._histograms.items()
+                ],
+            }
+
+    def to_prometheus(self) -> str:
+        """
+        Renders the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for name, help in self.COUNTERS.items():
+                lines.append(f"# HELP {self.prefix}_{name} {help}")
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                for (counter, labels), value in sorted(self._counters.items()):
+                    if counter == name:
+                        lines.append(f"{self.prefix}_{name}{format_labels(labels)} {value:g}")
+            for name, (help, _) in self.HISTOGRAMS.items():
+                lines.append(f"# HELP {self.prefix}_{name} {help}")
+                lines.append(f"# TYPE {self.prefix}_{name} histogram")
+                for (histogram_name, model), histogram in sorted(self._histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        labels = format_labels((("model", model), ("le", f"{bound:g}")))
+                        lines.append(f"{self.prefix}_{name}_bucket{labels} {count}")
+                    labels = format_labels((("model", model), ("le", "+Inf")))
+                    lines.append(f"{self.prefix}_{name}_bucket{labels} {histogram.count}")
+                    lines.append(f"{self.prefix}_{name}_sum{format_labels((('model', model),))} {histogram.sum:g}")
+                    lines.append(f"{self.prefix}_{name}_count{format_labels((('model', model),))} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels: Sequence[Tuple[str, Any]]) -> str:
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+__all__ = ['TokenCounter', 'MetricsRegistry', 'get_usage', 'get_timings', 'format_labels']
@@ -0,0 +1,304 @@
+from __future__ import annotations
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib  import contextmanager
+from typing import Iterator, Dict, Tuple, Any, Optional, TYPE_CHECKING
+
+# llama-cpp is imported when the first model is loaded
+if TYPE_CHECKING:
+    from llama_cpp import Llama
+    from ._cache import PrefixCache
+    from ._batch import BatchedGenerator
+
+PoolKey = Tuple[str, Tuple[Tuple[str, Any], ...]]
+
+LOAD_PARAMS = ('n_gpu_layers', 'n_threads', 'n_ctx', 'use_mmap', 'use_mlock', 'offload_kqv', 'logits_all')
+
+def prefetch_file(path: str, block_size: int = 16 << 20) -> int:
+    """
+    Read a file into the page cache, so that a memory-mapped model is not paged in from disk
+    by page faults during the first requests.
+
+    Args:
+        path (str): The file to read.
+        block_size (int): Number of bytes read at once.
+
+    Returns:
+        int: The number of bytes read.
+    """
+    total = 0
+    buffer = bytearray(block_size)
+    with open(path, "rb", buffering=0) as file:
+        if hasattr(os, "posix_fadvise"):
+            # Let the kernel read ahead while the blocks are consumed
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while True:
+            read = file.readinto(buffer)
+            if not read:
+                break
+            total += read
+    return total
+
+class PooledModel:
+    """
+    A resident `Llama` instance together with its bookkeeping inside a `ModelPool`.
+
+    Attributes:
+        llm (Llama): The loaded model.
+        size (int): Estimated memory footprint of the model in bytes.
+        lock (threading.Lock): Serializes generation, as a `Llama` context is not thread-safe.
+        refs (int): Number of active checkouts; models with references are never evicted.
+        load_time (float): Seconds it took to load the model.
+        uses (int): Number of times the model was acquired; the first use is the one that loaded it.
+        key (PoolKey): The pool key the model was loaded under.
+        cache (Optional[PrefixCache]): The prefix cache attached to the model, if any.
+        batchers (Dict[int, BatchedGenerator]): The continuous batching engines sharing the model's weights,
+            keyed by their number of parallel sequences.
+        drafts (Dict[str, Llama]): Draft models for speculative decoding, keyed by model path.
+    """
+
+    def __init__(self, llm: Llama, size: int, load_time: float, key: PoolKey = None) -> None:
+        self.key = key
+        self.llm = llm
+        self.size = size
+        self.lock = threading.Lock()
+        self.refs = 0
+        self.load_time = load_time
+        self.uses = 0
+        self.cache: Optional[PrefixCache] = None
+        self.batchers: Dict[int, BatchedGenerator] = {}
+        self._batcher_lock = threading.Lock()
+        self.drafts: Dict[str, Llama] = {}
+
+    def get_batcher(self, n_parallel: int = 4) -> BatchedGenerator:
+        """
+        Return the batching engine of this model decoding up to `n_parallel` sequences, creating
+        it on first use. Every batching engine has its own context with room for `n_parallel`
+        full sequences, i.e. `n_ctx * n_parallel` tokens of KV cache on top of the model's own.
+        """
+        with self._batcher_lock:
+            batcher = self.batchers.get(n_parallel)
+            if batcher is None:
+                from ._batch import BatchedGenerator
+                batcher = self.batchers[n_parallel] = BatchedGenerator(self.llm, n_parallel)
+            return batcher
+
+    def get_draft_model(self, model_path: str, **params: Any) -> Llama:
+        """
+        Return a draft model for speculative decoding, loading it next to this model on first use.
+        The draft model lives and is evicted together with this model. Must be called with `self.lock` held.
+        """
+        draft = self.drafts.get(model_path)
+        if draft is None:
+            from llama_cpp import Llama
+            draft = Llama(
+                model_path=model_path,
+                verbose=False,
+                # A draft model only samples, it never verifies tokens
+                **{name: params[name] for name in LOAD_PARAMS if params.get(name) is not None and name != 'logits_all'}
+            )
+            if draft.n_vocab() != self.llm.n_vocab():
+                raise ValueError(f"Draft model '{model_path}' does not share the vocabulary of the target model")
+            self.drafts[model_path] = draft
+            self.size += os.path.getsize(model_path)
+        return draft
+
+    def close(self) -> None:
+        with self._batcher_lock:
+            for batcher in self.batchers.values():
+                batcher.close()
+            self.batchers.clear()
+        self.drafts.clear()
+
+class ModelPool:
+    """
+    A process-wide registry of loaded models, keyed by model path and load parameters.
+
+    Models stay resident between requests and are evicted in least-recently-used order
+    once the configured memory budget or model count is exceeded.
+
+    Args:
+        max_memory (Optional[int]): Memory budget in bytes. Defaults to no limit.
+        max_models (Optional[int]): Maximum number of resident models. Defaults to no limit.
+    """
+
+    def __init__(self, max_memory: Optional[int] = None, max_models: Optional[int] = None) -> None:
+        self.max_memory = max_memory
+        self.max_models = max_models
+        self._models: "OrderedDict[PoolKey, PooledModel]" = OrderedDict()
+        self._loading: Dict[PoolKey, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_path: str, **params: Any) -> PoolKey:
+        return (os.path.realpath(model_path), tuple((name, params.get(name)) for name in LOAD_PARAMS))
+
+    @property
+    def memory_usage(self) -> int:
+        with self._lock:
+            return sum(entry.size for entry in self._models.values())
+
+    def __contains__(self, key: PoolKey) -> bool:
+        with self._lock:
+            return key in self._models
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._models)
+
+    def _acquire(self, model_path: str, **params: Any) -> PooledModel:
+        """
+        Return the pooled entry for the given key with its reference count incremented,
+        loading the model if it is not resident yet.
+        """
+        key = self.make_key(model_path, **params)
+        while True:
+            with self._lock:
+                entry = self._models.get(key)
+                if entry is not None:
+                    self._models.move_to_end(key)
+                    entry.refs += 1
+                    entry.uses += 1
+                    return entry
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    break
+            # Another thread is loading the same model, wait for it instead of loading twice
+            loading.wait()
+
+        try:
+            size = os.path.getsize(model_path)
+            with self._lock:
+                self._evict(size)
+            from llama_cpp import Llama
+            start = time.time()
+            llm = Llama(
+                model_path=model_path,
+                chat_format="mistral-instruct",
+                verbose=False,
+                **{name: params[name] for name in LOAD_PARAMS if params.get(name) is not None}
+            )
+            entry = PooledModel(llm, size, time.time() - start, key)
+            entry.refs += 1
+            entry.uses += 1
+            with self._lock:
+                self._models[key] = entry
+            return entry
+        finally:
+            with self._lock:
+                self._loading.pop(key).set()
+
+    def _release(self, entry: PooledModel) -> None:
+        with self._lock:
+            entry.refs -= 1
+            self._evict(0)
+
+    def _evict(self, incoming: int) -> None:
+        """
+        Evict idle models in LRU order until `incoming` more bytes (and one more model) fit.
+        Must be called with `self._lock` held.
+        """
+        def over_budget(extra_models: int) -> bool:
+            if self.max_models is not None and len(self._models) + extra_models > self.max_models:
+                return True
+            if self.max_memory is not None:
+                return sum(entry.size for entry in self._models.values()) + incoming > self.max_memory
+            return False
+
+        extra_models = 1 if incoming else 0
+        for key in list(self._models.keys()):
+            if not over_budget(extra_models):
+                break
+            if self._models[key].refs == 0:
+                self._models.pop(key).close()
+
+    def load(self, model_path: str, **params: Any) -> Llama:
+        """
+        Load a model into the pool ahead of time, or mark it as recently used if already resident.
+
+        Args:
+            model_path (str): Path to the '.gguf' model file.
+            **params: Load parameters (n_gpu_layers, n_threads, n_ctx, use_mmap, use_mlock, offload_kqv, logits_all).
+
+        Returns:
+            Llama: The resident model.
+        """
+        entry = self._acquire(model_path, **params)
+        self._release(entry)
+        return entry.llm
+
+    def unload(self, model_path: Optional[str] = None, **params: Any) -> int:
+        """
+        Remove idle models from the pool.
+
+        Args:
+            model_path (Optional[str]): Only unload models loaded from this path. Unloads every idle model if None.
+            **params: If given, only unload the model loaded with exactly these parameters.
+
+        Returns:
+            int: The number of models that were unloaded.
+        """
+        with self._lock:
+            if model_path is None:
+                keys = list(self._models.keys())
+            elif params:
+                keys = [self.make_key(model_path, **params)]
+            else:
+                path = os.path.realpath(model_path)
+                keys = [key for key in self._models if key[0] == path]
+            unloaded = 0
+            for key in keys:
+                entry = self._models.get(key)
+                if entry is not None and entry.refs == 0:
+                    self._models.pop(key).close()
+                    unloaded += 1
+            return unloaded
+
+    @contextmanager
+    def checkout(self, model_path: str, **params: Any) -> Iterator[PooledModel]:
+        """
+        Exclusively borrow a model for the duration of a generation.
+
+        The model is loaded on first use and cannot be evicted while checked out.
+        Concurrent checkouts of the same model wait for each other.
+
+        Args:
+            model_path (str): Path to the '.gguf' model file.
+            **params: Load parameters (n_gpu_layers, n_threads, n_ctx, use_mmap, use_mlock, offload_kqv, logits_all).
+
+        Yields:
+            PooledModel: The pooled entry, whose `llm` attribute is the model.
+        """
+        entry = self._acquire(model_path, **params)
+        try:
+            with entry.lock:
+                yield entry
+        finally:
+            self._release(entry)
+
+    @contextmanager
+    def pin(self, model_path: str, **params: Any) -> Iterator[PooledModel]:
+        """
+        Keep a model resident without taking its generation lock, for users that bring their
+        own context (such as the batching engine).
+
+        Args:
+            model_path (str): Path to the '.gguf' model file.
+            **params: Load parameters (n_gpu_layers, n_threads, n_ctx, use_mmap, use_mlock, offload_kqv, logits_all).
+
+        Yields:
+            PooledModel: The pooled entry.
+        """
+        entry = self._acquire(model_path, **params)
+        try:
+            yield entry
+        finally:
+            self._release(entry)
+
+default_pool = ModelPool()
+
+__all__ = ['ModelPool', 'PooledModel', 'default_pool', 'prefetch_file']
@@ -0,0 +1,233 @@
+import re
+import json
+import time
+import pathlib
+import sqlite3
+import threading
+from hashlib import sha256
+from typing import Callable
+from ..typing import Any, Dict, Iterator, List, Optional, Messages
+
+import numpy as np
+
+from ._docs import BASE_ADDR, DocumentRetriever, normalize_query
+from ._scheduler import STOP_REASONS
+
+# Completion options that change the generated text
+SAMPLING_PARAMS = (
+    'temperature', 'max_tokens', 'stop', 'response_format', 'top_k', 'top_p', 'min_p', 'seed', 'context_budget'
+)
+
+class CacheLookup:
+    """
+    The outcome of a `ResponseCache` lookup, kept to store the answer after a miss.
+
+    Attributes:
+        key (str): Hash of the whole request.
+        scope (str): Hash of the request without its last message; near-duplicates only match within a scope.
+        query (str): The normalized last message.
+        embedding (Optional[np.ndarray]): Embedding of the last message, if semantic matching is enabled.
+        content (Optional[str]): The cached answer, None on a miss.
+        finish_reason (Optional[str]): The finish reason of the cached answer.
+        match (Optional[str]): "exact" or "semantic" on a hit.
+        similarity (Optional[float]): Cosine similarity of a semantic hit.
+    """
+
+    def __init__(self, key: str, scope: str, query: str) -> None:
+        self.key = key
+        self.scope = scope
+        self.query = query
+        self.embedding: Optional[np.ndarray] = None
+        self.content: Optional[str] = None
+        self.finish_reason: Optional[str] = None
+        self.match: Optional[str] = None
+        self.similarity: Optional[float] = None
+
+    def to_json(self) -> Dict[str, Any]:
+        if self.match is None:
+            return {"hit": False}
+        return {"hit": True, "match": self.match, "similarity": self.similarity}
+
+class ResponseCache:
+    """
+    A persistent cache of answers in front of `Completions.create`.
+
+    Requests are keyed by their normalized messages, the model, the sampling parameters and a
+    fingerprint of the indexed documents and retrieval settings, so a cached answer is never
+    served after the documents change. With a `similarity` threshold, a request that differs
+    from a cached one only by the wording of its last message (e.g. a rephrased FAQ question)
+    is served the cached answer if their embeddings are similar enough.
+
+    Answers are kept in SQLite and the least recently used ones are evicted once they take
+    more than `max_size` bytes. Only deterministic requests (temperature 0) are cached,
+    unless `sampled` is set.
+
+    Args:
+        path (Optional[str | pathlib.Path]): The SQLite database. Defaults to 'files/storage/responses.sqlite'.
+        max_size (int): Maximum total size of the cached answers and embeddings in bytes.
+        similarity (Optional[float]): Minimum cosine similarity of a near-duplicate. Exact matches only if None.
+        embed (Optional[Callable[[str], List[float]]]): Embeds the last message for near-duplicate matching.
+            Defaults to the embedding model of the engine's `DocumentRetriever`.
+        sampled (bool): Whether to cache requests sampled with a temperature above 0 too.
+    """
+
+    def __init__(self, path: Any = None, max_size: int = 256 << 20, similarity: Optional[float] = None,
+                 embed: Optional[Callable[[str], List[float]]] = None, sampled: bool = False) -> None:
+        self.path = BASE_ADDR / "files/storage/responses.sqlite" if path is None else pathlib.Path(path)
+        self.max_size = max_size
+        self.similarity = similarity
+        self.embed = embed
+        self.sampled = sampled
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, scope TEXT NOT NULL, embedding BLOB, content TEXT NOT NULL, "
+            "finish_reason TEXT, size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_scope ON responses (scope)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._db.commit()
+        self.size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def accepts(self, options: Dict[str, Any]) -> bool:
+        """Whether a request with these options may be answered from the cache."""
+        return self.sampled or options.get('temperature', 0.8) == 0
+
+    def lookup(self, model: str, messages: Messages, options: Dict[str, Any],
+               document_retriever: Optional[DocumentRetriever] = None) -> CacheLookup:
+        """
+        Look a request up, exactly and then by the similarity of its last message.
+        """
+        normalized = [[message['role'], normalize_query(message['content'] or '')] for message in messages]
+        params = {name: options.get(name) for name in SAMPLING_PARAMS}
+        context = document_retriever.fingerprint if document_retriever is not None else None
+        digest = lambda value: sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+        lookup = CacheLookup(
+            digest([model, params, context, normalized]),
+            digest([model, params, context, normalized[:-1], normalized[-1][0]]),
+            normalized[-1][1],
+        )
+        with self._lock:
+            row = self._db.execute("SELECT content, finish_reason FROM responses WHERE key = ?", (lookup.key,)).fetchone()
+        if row is not None:
+            lookup.content, lookup.finish_reason = row
+            lookup.match, lookup.similarity = "exact", 1.0
+        elif self.similarity is not None and self.embed is not None:
+            lookup.embedding = self._embed(lookup.query)
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT key, embedding FROM responses WHERE scope = ? AND embedding IS NOT NULL", (lookup.scope,)
+                ).fetchall()
+            if rows:
+                similarities = np.stack([np.frombuffer(embedding, dtype=np.float32) for _, embedding in rows]) @ lookup.embedding
+                best = int(similarities.argmax())
+                if similarities[best] >= self.similarity:
+                    with self._lock:
+                        row = self._db.execute(
+                            "SELECT content, finish_reason FROM responses WHERE key = ?", (rows[best][0],)
+                        ).fetchone()
+                    if row is not None:
+                        lookup.key = rows[best][0]
+                        lookup.content, lookup.finish_reason = row
+                        lookup.match, lookup.similarity = "semantic", round(float(similarities[best]), 4)
+        if lookup.match is None:
+            with self._lock:
+                self.misses += 1
+            return lookup
+        with self._lock:
+            self.hits += 1
+            self.semantic_hits += lookup.match == "semantic"
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), lookup.key))
+            self._db.commit()
+        return lookup
+
+    def put(self, lookup: CacheLookup, content: str, finish_reason: Optional[str]) -> None:
+        """
+        Store the answer to a request that missed, evicting the least recently used answers if needed.
+        """
+        embedding = None
+        if self.similarity is not None and self.embed is not None:
+            if lookup.embedding is None:
+                lookup.embedding = self._embed(lookup.query)
+            embedding = lookup.embedding.tobytes()
+        size = len(content.encode("utf-8")) + (len(embedding) if embedding else 0)
+        now = time.time()
+        with self._lock:
+            previous = self._db.execute("SELECT size FROM responses WHERE key = ?", (lookup.key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (lookup.key, lookup.scope, embedding, content, finish_reason, size, now, now)
+            )
+            self.size += size - (previous[0] if previous else 0)
+            while self.size > self.max_size:
+                evicted = self._db.execute(
+                    "SELECT key, size FROM responses ORDER BY accessed LIMIT 64"
+                ).fetchall()
+                if not evicted:
+                    break
+                for key, evicted_size in evicted:
+                    if self.size <= self.max_size:
+                        break
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.size -= evicted_size
+            self._db.commit()
+
+    def record(self, lookup: CacheLookup, response: Iterator[Any]) -> Iterator[Any]:
+        """
+        Pass the completions of a request through, storing the answer once it is complete.
+        """
+        content = []
+        for completion in response:
+            choice = completion.choices[0]
+            if hasattr(choice, "delta"):
+                content.append(choice.delta.content or "")
+            else:
+                content = [choice.message.content or ""]
+            # Answers cut short by a cancellation, a deadline or preemption are not kept
+            if choice.finish_reason is not None and choice.finish_reason not in STOP_REASONS:
+                self.put(lookup, "".join(content), choice.finish_reason)
+            yield completion
+
+    def replay(self, lookup: CacheLookup) -> Iterator[str]:
+        """
+        Yield a cached answer in word-sized pieces, as the engine would stream it.
+        """
+        yield from re.findall(r"\s*\S+|\s+$", lookup.content)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+            self.size = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def to_json(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "size": self.size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def _embed(self, text: str) -> np.ndarray:
+        embedding = np.asarray(self.embed(text), dtype=np.float32)
+        return embedding / (np.linalg.norm(embedding) or 1.0)
+
+__all__ = ['ResponseCache']
@@ -0,0 +1,198 @@
+import time
+import heapq
+import itertools
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Any
+
+# Why a request stopped before the model finished it, reported as its finish reason
+STOP_REASONS = ("cancelled", "deadline", "preempted")
+
+class Ticket:
+    """
+    A request waiting for, or holding, a generation slot of a `Scheduler`.
+
+    Attributes:
+        model (str): The model the request generates with.
+        priority (int): Higher runs first.
+        deadline (Optional[float]): `time.monotonic()` after which the request stops.
+        cancel (Optional[threading.Event]): Stops the request once set.
+        enqueued (float): `time.monotonic()` when the request was queued.
+        started (Optional[float]): `time.monotonic()` when the request was admitted.
+        reason (Optional[str]): Why the request must stop, one of `STOP_REASONS`.
+    """
+
+    def __init__(self, model: str, priority: int = 0, deadline: Optional[float] = None,
+                 cancel: Optional[threading.Event] = None) -> None:
+        self.model = model
+        self.priority = priority
+        self.deadline = deadline
+        self.cancel = cancel
+        self.enqueued = time.monotonic()
+        self.started: Optional[float] = None
+        self.reason: Optional[str] = None
+
+    @property
+    def wait_time(self) -> float:
+        return (self.started if self.started is not None else time.monotonic()) - self.enqueued
+
+    def check(self) -> Optional[str]:
+        """Return why the request must stop, or None if it may go on."""
+        if self.reason is None:
+            if self.cancel is not None and self.cancel.is_set():
+                self.reason = "cancelled"
+            elif self.deadline is not None and time.monotonic() >= self.deadline:
+                self.reason = "deadline"
+        return self.reason
+
+class Scheduler:
+    """
+    Orders the generations of a `LocalEngine` by priority and bounds how many run per model.
+
+    Requests wait in a priority queue per model (first come, first served within a priority)
+    until one of the `max_in_flight` generation slots of the model is free, so an interactive
+    request overtakes a queued batch job. With `preempt`, a request that waits at the head of
+    the queue also stops the lowest-priority running generation below its own priority.
+
+    A request may carry a deadline and a cancellation event. It is checked between tokens, so
+    a generation that is cancelled, runs past its deadline or is preempted stops at the next
+    token, frees its slot and finishes with that reason ("cancelled", "deadline" or
+    "preempted") instead of "stop" or "length"; one that expires while queued never starts.
+
+    Args:
+        max_in_flight (Optional[int]): Maximum number of running generations per model. Unbounded if None.
+        preempt (bool): Whether waiting requests stop running ones of lower priority.
+        poll_interval (float): Seconds between two checks of the cancellation of a queued request.
+    """
+
+    def __init__(self, max_in_flight: Optional[int] = None, preempt: bool = False, poll_interval: float = 0.05) -> None:
+        if max_in_flight is not None and max_in_flight < 1:
+            raise ValueError(f"Invalid max_in_flight {max_in_flight}, expected at least 1")
+        self.max_in_flight = max_in_flight
+        self.preempt = preempt
+        self.poll_interval = poll_interval
+        self._condition = threading.Condition()
+        self._queues: Dict[str, List[Tuple[int, int, Ticket]]] = {}
+        self._running: Dict[str, List[Ticket]] = {}
+        self._order = itertools.count()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def run(self, model: str, factory: Callable[[], Iterator[str]], priority: int = 0,
+            deadline: Optional[float] = None, cancel: Optional[threading.Event] = None,
+            stats: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+        """
+        Generate once a slot of the model is free, stopping at a token boundary if needed.
+
+        Args:
+            model (str): The model the request generates with.
+            factory (Callable[[], Iterator[str]]): Starts the generation, called once admitted.
+            priority (int): Higher runs first.
+            deadline (Optional[float]): `time.monotonic()` after which the request stops.
+            cancel (Optional[threading.Event]): Stops the request once set.
+            stats (Optional[Dict[str, Any]]): Receives `queue_time`, and `finish_reason` if stopped early.
+
+        Yields:
+            str: The generated tokens.
+        """
+        stats = {} if stats is None else stats
+        ticket = Ticket(model, priority, deadline, cancel)
+        admitted = self._acquire(ticket)
+        stats['queue_time'] = ticket.wait_time
+        if not admitted:
+            stats['finish_reason'] = ticket.reason
+            return
+        response = None
+        try:
+            response = factory()
+            for token in response:
+                if ticket.check() is not None:
+                    break
+                yield token
+        finally:
+            # Ends the generation right away, which releases the model
+            if response is not None and hasattr(response, "close"):
+                response.close()
+            self._release(ticket)
+        if ticket.reason is not None:
+            stats['finish_reason'] = ticket.reason
+
+    def _acquire(self, ticket: Ticket) -> bool:
+        """
+        Wait until the ticket is at the head of its queue and a slot is free. Returns False if
+        it was cancelled or expired while waiting.
+        """
+        with self._condition:
+            queue = self._queues.setdefault(ticket.model, [])
+            running = self._running.setdefault(ticket.model, [])
+            stats = self._model_stats(ticket.model)
+            heapq.heappush(queue, (-ticket.priority, next(self._order), ticket))
+            admitted = False
+            try:
+                while ticket.check() is None:
+                    if queue[0][2] is ticket:
+                        if self.max_in_flight is None or len(running) < self.max_in_flight:
+                            heapq.heappop(queue)
+                            ticket.started = time.monotonic()
+                            running.append(ticket)
+                            admitted = True
+                            stats['admitted'] += 1
+                            stats['queue_wait_seconds_total'] += ticket.wait_time
+                            return True
+                        if self.preempt:
+                            self._preempt(running, ticket)
+                    timeout = self.poll_interval
+                    if ticket.deadline is not None:
+                        timeout = min(timeout, max(0.0, ticket.deadline - time.monotonic()))
+                    self._condition.wait(timeout)
+                stats[ticket.reason] += 1
+                return False
+            finally:
+                if not admitted:
+                    queue[:] = [entry for entry in queue if entry[2] is not ticket]
+                    heapq.heapify(queue)
+                # The next request in line may be admitted too
+                self._condition.notify_all()
+
+    def _preempt(self, running: List[Ticket], ticket: Ticket) -> None:
+        """
+        Stop the running generation of lowest priority (the latest started among equals) if it
+        is below the priority of the waiting ticket. Must be called with the condition held.
+        """
+        if any(other.reason == "preempted" for other in running):
+            # A slot is already being freed
+            return
+        victims = [other for other in running if other.priority < ticket.priority and other.reason is None]
+        if victims:
+            min(victims, key=lambda other: (other.priority, -other.started)).reason = "preempted"
+
+    def _release(self, ticket: Ticket) -> None:
+        with self._condition:
+            self._running[ticket.model].remove(ticket)
+            if ticket.reason is not None:
+                self._stats[ticket.model][ticket.reason] += 1
+            self._condition.notify_all()
+
+    def _model_stats(self, model: str) -> Dict[str, float]:
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = self._stats[model] = {
+                "admitted": 0, **{reason: 0 for reason in STOP_REASONS}, "queue_wait_seconds_total": 0.0
+            }
+        return stats
+
+    def to_json(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Per model: queued and running requests, admitted requests, requests stopped early by
+        reason, and the total time admitted requests waited in the queue.
+        """
+        with self._condition:
+            return {
+                model: {
+                    "queue_depth": len(self._queues.get(model, [])),
+                    "running": len(self._running.get(model, [])),
+                    **stats,
+                    "queue_wait_seconds_total": round(stats["queue_wait_seconds_total"], 6),
+                }
+                for model, stats in self._stats.items()
+            }
+
+__all__ = ['Scheduler', 'Ticket', 'STOP_REASONS']
@@ -0,0 +1,101 @@
+from typing import Any, Dict, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+class ModelDraft(LlamaDraftModel):
+    """
+    Drafts tokens with a small model that shares the tokenizer of the target model.
+
+    The draft model decodes greedily and keeps its own KV cache between calls, so each call
+    only evaluates the tokens the target model accepted since the previous one.
+
+    Args:
+        llm (Llama): The draft model.
+        num_pred_tokens (int): Number of tokens drafted per call.
+    """
+
+    def __init__(self, llm: Llama, num_pred_tokens: int = 8) -> None:
+        self.llm = llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any) -> npt.NDArray[np.intc]:
+        tokens = input_ids.tolist()
+        max_tokens = min(self.num_pred_tokens, self.llm.n_ctx() - len(tokens) - 1)
+        draft = []
+        if max_tokens <= 0:
+            return np.array(draft, dtype=np.intc)
+        generator = self.llm.generate(tokens, temp=0.0)
+        try:
+            for token in generator:
+                if llama_cpp.llama_vocab_is_eog(self.llm._model.vocab, token):
+                    break
+                draft.append(token)
+                if len(draft) >= max_tokens:
+                    break
+        finally:
+            generator.close()
+        return np.array(draft, dtype=np.intc)
+
+class SpeculationCounter(LlamaDraftModel):
+    """
+    Wraps a draft model and counts how many drafted tokens the target model accepts.
+
+    The target model calls its draft model again right after verifying the previous draft,
+    with every accepted token plus one token of its own appended to the input, which tells
+    how much of the previous draft was kept. A draft still pending when the generation ends
+    is not counted.
+
+    Args:
+        draft_model (LlamaDraftModel): The wrapped draft model.
+        mode (str): Name of the drafting mode, reported in the statistics.
+
+    Attributes:
+        drafted (int): Number of drafted tokens the target model verified.
+        accepted (int): Number of drafted tokens the target model kept.
+    """
+
+    def __init__(self, draft_model: LlamaDraftModel, mode: str) -> None:
+        self.draft_model = draft_model
+        self.mode = mode
+        self.drafted = 0
+        self.accepted = 0
+        self._last_length: Optional[int] = None
+        self._last_draft = 0
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs: Any) -> npt.NDArray[np.intc]:
+        length = len(input_ids)
+        if self._last_length is not None and self._last_draft:
+            self.drafted += self._last_draft
+            self.accepted += min(max(length - self._last_length - 1, 0), self._last_draft)
+        draft = self.draft_model(input_ids, **kwargs)
+        self._last_length, self._last_draft = length, len(draft)
+        return draft
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "drafted_tokens": self.drafted,
+            "accepted_tokens": self.accepted,
+            "acceptance_rate": round(self.accepted / self.drafted, 4) if self.drafted else 0.0,
+        }
+
+def enable_speculation(llm: Llama, draft_model: Optional[LlamaDraftModel]) -> None:
+    """
+    Turns speculative decoding on or off for the next generation of a loaded model.
+
+    Verifying a draft needs the logits of every drafted position, so the model must have been
+    created with `logits_all=True`, which `get_load_params` requests for speculative decoding.
+
+    Raises:
+        ValueError: If a draft model is given for a model created without `logits_all`.
+    """
+    if draft_model is not None and not getattr(llm, '_logits_all', True):
+        raise ValueError("Speculative decoding requires a model loaded with logits_all=True")
+    llm.draft_model = draft_model
+
+__all__ = ['ModelDraft', 'SpeculationCounter', 'LlamaPromptLookupDecoding', 'enable_speculation']
@@ -0,0 +1,307 @@
+import os
+import json
+import struct
+import pathlib
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+STORE_VERSION = 1
+# Every '.npy' file of the store has a header of this size, so rows are appended by rewriting it in place
+HEADER_SIZE = 128
+ID_DTYPE = np.dtype("S64")
+# Rows scored at once by `search`, bounds the temporary memory of a query
+BLOCK_ROWS = 1 << 16
+
+def write_npy_header(file, dtype: np.dtype, shape: Tuple[int, ...]) -> None:
+    """
+    Write a version 1.0 '.npy' header, padded to `HEADER_SIZE` bytes, at the start of `file`.
+    """
+    header = repr({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": shape})
+    header = header.ljust(HEADER_SIZE - 11) + "\n"
+    file.seek(0)
+    file.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+
+class VectorStore:
+    """
+    A compact on-disk vector store built for fast startup.
+
+    Embeddings are L2-normalized and stored as one contiguous float32 or float16 matrix in a
+    memory-mapped `.npy` file, so the dot product of a normalized query with a row is their
+    cosine similarity. The text and metadata of every row are stored as JSON records in an
+    append-only file, located through an array of end offsets. Opening a store only reads a
+    small JSON header; pages are loaded on demand and shared between processes through the
+    page cache.
+
+    Rows are appended in place and deleted rows are only marked, until `compact` rewrites the
+    store. Appended rows and deletions become durable with `flush`; after an interrupted run
+    the store reopens as it was at the last flush.
+
+    Args:
+        path (str | pathlib.Path): Directory of the store. Created if it does not exist.
+        dtype (str): Type of the stored embeddings, "float32" or "float16". Only used when the store is created.
+
+    Attributes:
+        dim (Optional[int]): Dimension of the embeddings, known once the first rows were added.
+        count (int): Number of rows, including deleted ones.
+        deleted (int): Number of deleted rows.
+        version (int): Incremented whenever rows are added or deleted.
+    """
+
+    def __init__(self, path: Any, dtype: str = "float32") -> None:
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._open(dtype)
+
+    def _open(self, dtype: str = "float32") -> None:
+        self._ids: Optional[Dict[str, int]] = None
+        self._views: Dict[str, np.ndarray] = {}
+        self._records: Optional[np.memmap] = None
+        meta_path = self.path / "store.json"
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text())
+            if meta.get("version") != STORE_VERSION:
+                raise ValueError(f"Unsupported vector store version {meta.get('version')} in '{self.path}'")
+        else:
+            meta = {"version": STORE_VERSION, "dim": None, "dtype": np.dtype(dtype).name, "count": 0, "deleted": 0}
+        self.dim: Optional[int] = meta["dim"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.count: int = meta["count"]
+        self.deleted: int = meta["deleted"]
+        self.version = getattr(self, "version", -1) + 1
+        self._deleted_mask: np.ndarray = (
+            np.array(self._view("deleted.npy"), dtype=bool) if self.count else np.zeros(0, dtype=bool)
+        )
+        self._records_end = int(self._view("offsets.npy")[-1]) if self.count else 0
+
+    def __len__(self) -> int:
+        return self.count - self.deleted
+
+    def _view(self, name: str) -> np.ndarray:
+        """
+        Return a read-only memory map of the committed rows of one of the arrays.
+        """
+        view = self._views.get(name)
+        if view is None:
+            view = self._views[name] = np.load(self.path / name, mmap_mode="r")[:self.count]
+        return view
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """The (count, dim) embedding matrix, memory-mapped."""
+        if not self.count:
+            return np.zeros((0, self.dim or 0), dtype=self.dtype)
+        return self._view("vectors.npy")
+
+    @property
+    def deleted_mask(self) -> np.ndarray:
+        """Whether each of the `count` rows is deleted."""
+        return self._deleted_mask
+
+    def _append(self, name: str, array: np.ndarray) -> None:
+        path = self.path / name
+        row_size = array.dtype.itemsize * int(np.prod(array.shape[1:], dtype=np.int64))
+        with open(path, "r+b" if path.exists() else "w+b") as file:
+            # Drop rows beyond the last flush, left over from an interrupted run
+            file.truncate(HEADER_SIZE + self.count * row_size)
+            file.seek(0, os.SEEK_END)
+            file.write(np.ascontiguousarray(array).tobytes())
+            write_npy_header(file, array.dtype, (self.count + len(array), *array.shape[1:]))
+
+    def _id_map(self) -> Dict[str, int]:
+        """
+        Map the id of every live row to its row, built on first use since queries never need it.
+        """
+        if self._ids is None:
+            ids = self._view("ids.npy") if self.count else []
+            self._ids = {
+                id.decode("utf-8"): row for row, id in enumerate(ids) if not self._deleted_mask[row]
+            }
+        return self._ids
+
+    def add(self, ids: Sequence[str], embeddings: npt.ArrayLike, records: Sequence[Dict[str, Any]]) -> None:
+        """
+        Append rows to the store; rows with an id that is already stored replace the old ones.
+
+        Args:
+            ids (Sequence[str]): Unique id of every row, at most 64 bytes long.
+            embeddings (npt.ArrayLike): The (len(ids), dim) embeddings, normalized before they are stored.
+            records (Sequence[Dict[str, Any]]): JSON-serializable text and metadata of every row.
+        """
+        if not len(ids):
+            return
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or len(embeddings) != len(ids) or len(records) != len(ids):
+            raise ValueError("Expected one embedding and one record per id")
+        if self.dim is not None and embeddings.shape[1] != self.dim:
+            raise ValueError(f"Embeddings have dimension {embeddings.shape[1]}, the store has {self.dim}")
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        vectors = (embeddings / norms).astype(self.dtype)
+        encoded_ids = [id.encode("utf-8") for id in ids]
+        if any(len(id) > ID_DTYPE.itemsize for id in encoded_ids):
+            raise ValueError(f"Ids must be at most {ID_DTYPE.itemsize} bytes long")
+        encoded = [json.dumps(record, ensure_ascii=False).encode("utf-8") for record in records]
+
+        with self._lock:
+            ends = self._records_end + np.cumsum([len(record) for record in encoded], dtype=np.int64)
+            self.delete([id for id in ids if id in self._id_map()])
+            self.dim = embeddings.shape[1]
+            self._append("vectors.npy", vectors)
+            self._append("ids.npy", np.array(encoded_ids, dtype=ID_DTYPE))
+            self._append("offsets.npy", ends)
+            with open(self.path / "records.bin", "ab") as file:
+                file.truncate(self._records_end)
+                file.write(b"".join(encoded))
+            for row, id in enumerate(ids, self.count):
+                self._ids[id] = row
+            self._deleted_mask = np.concatenate([self._deleted_mask, np.zeros(len(ids), dtype=bool)])
+            self._records_end = int(ends[-1])
+            self.count += len(ids)
+            self._views.clear()
+            self._records = None
+            self.version += 1
+
+    def delete(self, ids: Sequence[str]) -> int:
+        """
+        Mark the rows with the given ids as deleted, ignoring unknown ids.
+
+        Returns:
+            int: The number of deleted rows.
+        """
+        with self._lock:
+            id_map = self._id_map()
+            rows = [id_map.pop(id) for id in ids if id in id_map]
+            if rows:
+                self._deleted_mask[rows] = True
+                self.deleted += len(rows)
+                self.version += 1
+            return len(rows)
+
+    def get(self, id: str) -> List[float]:
+        """
+        Return the (normalized) embedding of a row.
+
+        Raises:
+            KeyError: If no live row has this id.
+        """
+        with self._lock:
+            row = self._id_map()[id]
+            return self.vectors[row].astype(np.float32).tolist()
+
+    def record(self, row: int) -> Dict[str, Any]:
+        """
+        Return the record stored with a row, with its id under "id".
+        """
+        if self._records is None:
+            self._records = np.memmap(self.path / "records.bin", dtype=np.uint8, mode="r")
+        ends = self._view("offsets.npy")
+        start = int(ends[row - 1]) if row else 0
+        record = json.loads(self._records[start:int(ends[row])].tobytes().decode("utf-8"))
+        record["id"] = self._view("ids.npy")[row].decode("utf-8")
+        return record
+
+    def search(self, queries: npt.ArrayLike, top_k: int) -> List[List[Tuple[int, float]]]:
+        """
+        Find the rows most similar to one or more query embeddings by exact cosine similarity.
+
+        The matrix is scored block by block with one matrix product for all queries, and the
+        best rows of each block are selected with `argpartition` instead of a full sort.
+
+        Args:
+            queries (npt.ArrayLike): One query embedding, or a (n_queries, dim) matrix of them.
+            top_k (int): Number of rows returned per query.
+
+        Returns:
+            List[List[Tuple[int, float]]]: For every query, its (row, score) pairs, best first.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        queries = queries / norms
+        with self._lock:
+            vectors, deleted, count = self.vectors, self._deleted_mask, self.count
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, count, BLOCK_ROWS):
+            block = np.asarray(vectors[start:start + BLOCK_ROWS], dtype=np.float32)
+            scores = queries @ block.T
+            block_deleted = deleted[start:start + len(block)]
+            if block_deleted.any():
+                scores[:, block_deleted] = -np.inf
+            rows, scores = select_top_k(scores, top_k)
+            best_rows = np.concatenate([best_rows, rows + start], axis=1)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            if best_rows.shape[1] > top_k:
+                best_rows, best_scores = select_top_k(best_scores, top_k, best_rows)
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return [
+            [(int(rows[i]), float(scores[i])) for i in query_order if np.isfinite(scores[i])]
+            for rows, scores, query_order in zip(best_rows, best_scores, order)
+        ]
+
+    def iter_rows(self, batch_size: int = BLOCK_ROWS) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Iterate over the live rows in batches of (rows, vectors).
+        """
+        with self._lock:
+            vectors, deleted, count = self.vectors, self._deleted_mask, self.count
+        for start in range(0, count, batch_size):
+            rows = np.arange(start, min(start + batch_size, count))
+            rows = rows[~deleted[start:start + batch_size]]
+            if len(rows):
+                yield rows, np.asarray(vectors[rows], dtype=np.float32)
+
+    def flush(self) -> None:
+        """
+        Make the added and deleted rows durable.
+        """
+        with self._lock:
+            if self.count:
+                with open(self.path / "deleted.npy", "wb") as file:
+                    np.save(file, self._deleted_mask)
+            meta = {
+                "version": STORE_VERSION, "dim": self.dim, "dtype": self.dtype.name,
+                "count": self.count, "deleted": self.deleted,
+            }
+            # The header is written last, it decides which rows belong to the store
+            temporary = self.path / "store.json.tmp"
+            temporary.write_text(json.dumps(meta))
+            temporary.replace(self.path / "store.json")
+
+    def compact(self) -> None:
+        """
+        Rewrite the store without its deleted rows. Processes that still map the old files keep
+        reading them until they reopen the store.
+        """
+        with self._lock:
+            compacted = VectorStore(self.path / "compact", self.dtype.name)
+            for rows, vectors in self.iter_rows():
+                records = [self.record(row) for row in rows]
+                compacted.add([record.pop("id") for record in records], vectors, records)
+            compacted.flush()
+            for name in ("vectors.npy", "ids.npy", "offsets.npy", "records.bin", "deleted.npy", "store.json"):
+                source = compacted.path / name
+                if source.exists():
+                    os.replace(source, self.path / name)
+            compacted.path.rmdir()
+            self._open()
+
+def select_top_k(scores: np.ndarray, top_k: int, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Select the `top_k` highest scores of every row of a (n_queries, n) matrix, unordered.
+    Returns their column indices (or the matching entries of `rows`) and scores.
+    """
+    k = min(top_k, scores.shape[1])
+    if k == 0:
+        return np.zeros((len(scores), 0), dtype=np.int64), np.zeros((len(scores), 0), dtype=np.float32)
+    columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    selected = np.take_along_axis(scores, columns, axis=1)
+    if rows is not None:
+        columns = np.take_along_axis(rows, columns, axis=1)
+    return columns, selected
+
+__all__ = ['VectorStore']
@@ -0,0 +1,274 @@
+import os
+import queue
+import pickle
+import logging
+import itertools
+import threading
+import multiprocessing
+from collections import deque
+from typing import Iterator, List, Dict, Any, Optional, Tuple
+
+from ._engine import LocalProvider
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two checks that the worker processes are still alive
+LIVENESS_INTERVAL = 0.5
+
+def portable_error(error: Exception) -> Exception:
+    """
+    Return an exception that can cross the process boundary. The queue pickles messages on a
+    feeder thread, where an unpicklable exception would be dropped silently.
+    """
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+
+def _worker_main(worker_id: int, cores: List[int], requests, responses) -> None:
+    """
+    Entry point of a worker process: serves completions one at a time from its request queue.
+    """
+    if cores and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cores)
+        except OSError as e:
+            logger.warning(f"Worker {worker_id} could not be pinned to cores {cores}: {e}")
+            cores = []
+    backlog = deque()
+    cancelled = set()
+    current = None
+
+    def poll(block: bool) -> bool:
+        """Moves new messages into the backlog; returns False once the worker should exit."""
+        try:
+            message = requests.get() if block else requests.get_nowait()
+        except queue.Empty:
+            return True
+        while True:
+            if message is None:
+                return False
+            if message[0] == "cancel":
+                # Cancellations of requests that already finished are ignored
+                if message[1] == current or any(queued[1] == message[1] for queued in backlog):
+                    cancelled.add(message[1])
+            else:
+                backlog.append(message)
+            try:
+                message = requests.get_nowait()
+            except queue.Empty:
+                return True
+
+    running = True
+    while running or backlog:
+        if not backlog:
+            running = poll(True)
+            continue
+        kind, request_id, *args = backlog.popleft()
+        current = request_id
+        try:
+            if kind == "load":
+                model, kwargs = args
+                LocalProvider.load_model(model, **{**kwargs, "threads": len(cores) or kwargs.get("threads")})
+                responses.put(("done", worker_id, request_id, {}))
+                continue
+            model, messages, kwargs = args
+            kwargs = {**kwargs, "threads": len(cores) or kwargs.get("threads")}
+            if request_id in cancelled:
+                responses.put(("done", worker_id, request_id, {"finish_reason": "cancelled"}))
+                continue
+            stats = {}
+            response = LocalProvider.create_completion(model, messages, None, None, stats, **kwargs)
+            for token in response:
+                responses.put(("token", worker_id, request_id, token))
+                # Check for cancellations between tokens without blocking
+                running = poll(False) and running
+                if request_id in cancelled:
+                    response.close()
+                    stats["finish_reason"] = "cancelled"
+                    break
+            responses.put(("done", worker_id, request_id, stats))
+        except Exception as e:
+            responses.put(("error", worker_id, request_id, portable_error(e)))
+        finally:
+            cancelled.discard(request_id)
+            current = None
+
+class WorkerPool:
+    """
+    A pool of worker processes, each pinned to its own set of cores and holding its own
+    memory-mapped copy of the models, which the operating system shares through the page cache.
+
+    Requests are routed to the worker with the fewest requests in flight and tokens are
+    streamed back over a shared queue. A worker process that dies fails its requests in
+    flight and is replaced.
+
+    Args:
+        workers (int): Number of worker processes.
+        cores_per_worker (Optional[int]): Number of cores pinned to each worker, among the cores
+            this process may run on. Defaults to an even split of them; workers are not pinned
+            if there are more workers than cores.
+
+    Raises:
+        ValueError: If `workers * cores_per_worker` exceeds the available cores.
+    """
+
+    def __init__(self, workers: int, cores_per_worker: Optional[int] = None) -> None:
+        if hasattr(os, "sched_getaffinity"):
+            available = sorted(os.sched_getaffinity(0))
+        else:
+            available = list(range(os.cpu_count() or 1))
+        if cores_per_worker is None:
+            cores_per_worker = len(available) // workers
+        elif workers * cores_per_worker > len(available):
+            raise ValueError(
+                f"Cannot pin {workers} workers with {cores_per_worker} cores each to {len(available)} available cores"
+            )
+        self._context = multiprocessing.get_context("spawn")
+        self._responses = self._context.Queue()
+        self._cores = [available[worker_id * cores_per_worker:(worker_id + 1) * cores_per_worker] for worker_id in range(workers)]
+        self._requests = [None] * workers
+        self._processes = [None] * workers
+        self._in_flight = [0] * workers
+        self._streams: Dict[int, queue.Queue] = {}
+        self._owners: Dict[int, int] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closing = False
+        for worker_id in range(workers):
+            self._start_worker(worker_id)
+        self._dispatcher = threading.Thread(target=self._dispatch, name="g4l-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def _start_worker(self, worker_id: int) -> None:
+        requests = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main, args=(worker_id, self._cores[worker_id], requests, self._responses),
+            name=f"g4l-worker-{worker_id}", daemon=True
+        )
+        process.start()
+        self._requests[worker_id] = requests
+        self._processes[worker_id] = process
+
+    def _check_workers(self) -> None:
+        """
+        Fail the requests in flight on worker processes that died, and start replacements.
+        """
+        with self._lock:
+            if self._closing:
+                return
+            for worker_id, process in enumerate(self._processes):
+                if process.is_alive():
+                    continue
+                error = RuntimeError(f"Worker {worker_id} exited unexpectedly with code {process.exitcode}")
+                for request_id in [request_id for request_id, owner in self._owners.items() if owner == worker_id]:
+                    del self._owners[request_id]
+                    self._streams.pop(request_id).put(("error", error))
+                self._in_flight[worker_id] = 0
+                logger.warning(f"{error}, starting a new one")
+                self._start_worker(worker_id)
+
+    @property
+    def in_flight(self) -> List[int]:
+        return list(self._in_flight)
+
+    def _dispatch(self) -> None:
+        while True:
+            try:
+                message = self._responses.get(timeout=LIVENESS_INTERVAL)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if message is None:
+                break
+            kind, worker_id, request_id, payload = message
+            with self._lock:
+                stream = self._streams.get(request_id)
+                # Requests of a dead worker were already failed and removed
+                if kind != "token" and self._owners.pop(request_id, None) is not None:
+                    self._in_flight[worker_id] -= 1
+                    self._streams.pop(request_id, None)
+            if stream is not None:
+                stream.put((kind, payload))
+
+    def _submit(self, kind: str, *args: Any, worker_id: Optional[int] = None) -> Tuple[int, queue.Queue]:
+        stream = queue.Queue()
+        with self._lock:
+            if worker_id is None:
+                worker_id = min(range(len(self._in_flight)), key=self._in_flight.__getitem__)
+            request_id = next(self._ids)
+            self._in_flight[worker_id] += 1
+            self._streams[request_id] = stream
+            self._owners[request_id] = worker_id
+            requests = self._requests[worker_id]
+        requests.put((kind, request_id, *args))
+        return request_id, stream
+
+    def _receive(self, stream: queue.Queue) -> Tuple[str, Any]:
+        """Wait for the next message of a request, checking that the workers are alive meanwhile."""
+        while True:
+            try:
+                return stream.get(timeout=LIVENESS_INTERVAL)
+            except queue.Empty:
+                self._check_workers()
+
+    def load(self, model: str, **kwargs: Any) -> None:
+        """
+        Loads a model in every worker and waits until all of them are done.
+        """
+        streams = [self._submit("load", model, kwargs, worker_id=worker_id) for worker_id in range(len(self._requests))]
+        for _, stream in streams:
+            kind, payload = self._receive(stream)
+            if kind == "error":
+                raise payload
+
+    def create_completion(self, model: str, messages: List[Dict[str, str]],
+                          stats: Dict[str, Any] = None, **kwargs: Any) -> Iterator[str]:
+        """
+        Runs a completion on the least loaded worker.
+
+        Args:
+            model (str): The name of the model file (without the '.gguf' extension).
+            messages (List[Dict[str, str]]): The conversation.
+            stats (Dict[str, Any], optional): Filled with the statistics reported by the worker.
+            **kwargs: Keyword arguments for `LocalProvider.create_completion`.
+
+        Returns:
+            Iterator[str]: An iterator yielding the generated completion tokens.
+        """
+        request_id, stream = self._submit("create", model, messages, kwargs)
+        finished = False
+        try:
+            while True:
+                kind, payload = self._receive(stream)
+                if kind == "token":
+                    yield payload
+                    continue
+                finished = True
+                if kind == "error":
+                    raise payload
+                if stats is not None:
+                    stats.update(payload)
+                break
+        finally:
+            if not finished:
+                self.cancel(request_id)
+
+    def cancel(self, request_id: int) -> None:
+        with self._lock:
+            worker_id = self._owners.get(request_id)
+        if worker_id is not None:
+            self._requests[worker_id].put(("cancel", request_id))
+
+    def close(self) -> None:
+        with self._lock:
+            self._closing = True
+        for requests in self._requests:
+            requests.put(None)
+        for process in self._processes:
+            process.join()
+        self._responses.put(None)
+        self._dispatcher.join()
+
+__all__ = ['WorkerPool']
@@ -0,0 +1,293 @@
+import json
+import time
+import asyncio
+from typing import List, Dict, Any, Optional, AsyncIterator
+
+try:
+    from aiohttp import web
+except ImportError as e:
+    raise ImportError('g4l.server requires aiohttp, install it with "pip install aiohttp"') from e
+
+from ..local import AsyncLocalEngine, MetricsRegistry
+from ..local._metrics import format_labels
+
+class QueueFull(Exception):
+    ...
+
+class RequestQueue:
+    """
+    Admission control for one model: at most `concurrency` requests run at a time and at
+    most `max_queue` requests wait for a slot. Further requests are rejected immediately.
+
+    Args:
+        concurrency (int): Number of requests that may generate at the same time.
+        max_queue (int): Number of requests that may wait for a slot.
+
+    Attributes:
+        waiting (int): Requests currently waiting for a slot.
+        active (int): Requests currently generating.
+        completed (int): Requests that finished successfully.
+        rejected (int): Requests rejected because the queue was full.
+        timeouts (int): Requests that exceeded their timeout.
+        cancelled (int): Requests whose client disconnected.
+    """
+
+    def __init__(self, concurrency: int = 1, max_queue: int = 64) -> None:
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.waiting = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.wait_time = 0.0
+
+    async def acquire(self) -> None:
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull()
+        self.waiting += 1
+        start = time.monotonic()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.wait_time += time.monotonic() - start
+        self.active += 1
+
+    def release(self) -> None:
+        self.active -= 1
+        self._semaphore.release()
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "queue_depth": self.waiting,
+            "active": self.active,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+            "queue_wait_seconds_total": round(self.wait_time, 6),
+        }
+
+# Prometheus metric name, type and `RequestQueue` attribute of the exported queue statistics
+QUEUE_METRICS = (
+    ("queue_depth", "gauge", "waiting"),
+    ("active_requests", "gauge", "active"),
+    ("completed_requests_total", "counter", "completed"),
+    ("rejected_requests_total", "counter", "rejected"),
+    ("timed_out_requests_total", "counter", "timeouts"),
+    ("cancelled_requests_total", "counter", "cancelled"),
+    ("queue_wait_seconds_total", "counter", "wait_time"),
+)
+
+ROLES = ("system", "user", "assistant")
+
+def validate_messages(messages: Any) -> Optional[str]:
+    """
+    Return why `messages` is not a valid conversation, or None if it is.
+    """
+    if not isinstance(messages, list) or not messages:
+        return "'messages' must be a non-empty list"
+    for index, message in enumerate(messages):
+        if not isinstance(message, dict):
+            return f"messages[{index}] must be an object"
+        if message.get("role") not in ROLES:
+            return f"messages[{index}].role must be one of {', '.join(ROLES)}"
+        if not isinstance(message.get("content"), str):
+            return f"messages[{index}].content must be a string"
+    return None
+
+def is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def validate_options(body: Dict[str, Any]) -> Optional[str]:
+    """
+    Return why the sampling options of a request are invalid, or None if they are valid.
+    Options that are absent or null take their default.
+    """
+    temperature, max_tokens, stop = body.get("temperature"), body.get("max_tokens"), body.get("stop")
+    response_format, priority = body.get("response_format"), body.get("priority")
+    if temperature is not None and (not is_number(temperature) or temperature < 0):
+        return "'temperature' must be a non-negative number"
+    if max_tokens is not None and (not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens < 1):
+        return "'max_tokens' must be a positive integer"
+    if stop is not None and not isinstance(stop, str) and not (
+        isinstance(stop, list) and all(isinstance(sequence, str) for sequence in stop)
+    ):
+        return "'stop' must be a string or a list of strings"
+    if response_format is not None and not (isinstance(response_format, dict) and isinstance(response_format.get("type"), str)):
+        return "'response_format' must be an object with a 'type'"
+    if priority is not None and (not isinstance(priority, int) or isinstance(priority, bool)):
+        return "'priority' must be an integer"
+    return None
+
+def error_response(status: int, message: str, type: str) -> web.Response:
+    return web.json_response({"error": {"message": message, "type": type}}, status=status)
+
+class Server:
+    """
+    An OpenAI-compatible HTTP server that shares resident models between clients. It runs on
+    aiohttp, which the engine itself does not need: `pip install aiohttp`.
+
+    Args:
+        engine (AsyncLocalEngine): The engine that runs the completions.
+        models (List[str]): The models served, by file name without the '.gguf' extension.
+        concurrency (int): Number of concurrent generations per model.
+        max_queue (int): Number of requests that may wait per model before new ones are rejected.
+        timeout (Optional[float]): Per-request timeout in seconds. Disabled if None.
+        chunk_size (Optional[int]): Streamed tokens are coalesced into events of at least this many characters.
+        chunk_interval (Optional[float]): Streamed tokens are coalesced into at most one event per interval in seconds.
+    """
+
+    def __init__(self, engine: AsyncLocalEngine, models: List[str], concurrency: int = 1,
+                 max_queue: int = 64, timeout: Optional[float] = None,
+                 chunk_size: Optional[int] = None, chunk_interval: Optional[float] = None) -> None:
+        self.engine = engine
+        self.models = models
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.chunk_interval = chunk_interval
+        self.queues: Dict[str, RequestQueue] = {model: RequestQueue(concurrency, max_queue) for model in models}
+        self.app = web.Application()
+        self.app.add_routes([
+            web.post('/v1/chat/completions', self.chat_completions),
+            web.get('/v1/models', self.list_models),
+            web.get('/metrics', self.metrics),
+        ])
+        self.app.on_startup.append(self.warm_up)
+
+    async def warm_up(self, app: web.Application) -> None:
+        loop = asyncio.get_running_loop()
+        for model in self.models:
+            await loop.run_in_executor(self.engine.executor, self.engine.load, model)
+
+    async def list_models(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "object": "list",
+            "data": [{"id": model, "object": "model", "owned_by": "g4l"} for model in self.models]
+        })
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        """
+        Serves the queue statistics, and the engine metrics if the engine has a `MetricsRegistry`,
+        in the Prometheus text format, or as JSON with `?format=json`.
+        """
+        registry = self.engine.metrics if isinstance(self.engine.metrics, MetricsRegistry) else None
+        if request.query.get("format") == "json":
+            return web.json_response({
+                **{model: queue.to_json() for model, queue in self.queues.items()},
+                **({"engine": registry.to_json()} if registry is not None else {})
+            })
+        lines = []
+        for name, kind, attribute in QUEUE_METRICS:
+            lines.append(f"# TYPE g4l_{name} {kind}")
+            for model, queue in self.queues.items():
+                lines.append(f"g4l_{name}{format_labels((('model', model),))} {getattr(queue, attribute):g}")
+        text = "\n".join(lines) + "\n"
+        if registry is not None:
+            text += registry.to_prometheus()
+        return web.Response(text=text, content_type="text/plain", headers={"X-Content-Type-Options": "nosniff"})
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        try:
+            body = await request.json()
+        except json.JSONDecodeError:
+            return error_response(400, "Request body is not valid JSON", "invalid_request_error")
+        if not isinstance(body, dict):
+            return error_response(400, "Request body must be a JSON object", "invalid_request_error")
+        model = body.get("model") or self.models[0]
+        if not isinstance(model, str) or model not in self.queues:
+            return error_response(404, f"Model '{model}' is not served", "invalid_request_error")
+        error = validate_messages(body.get("messages")) or validate_options(body)
+        if error is not None:
+            return error_response(400, error, "invalid_request_error")
+
+        queue = self.queues[model]
+        deadline = None if self.timeout is None else asyncio.get_running_loop().time() + self.timeout
+        try:
+            await asyncio.wait_for(queue.acquire(), self.remaining(deadline))
+        except QueueFull:
+            return error_response(503, "Too many requests queued for this model", "server_busy")
+        except asyncio.TimeoutError:
+            queue.timeouts += 1
+            return error_response(504, "Request timed out while queued", "timeout")
+        try:
+            if body.get("stream"):
+                return await self.stream_completion(request, queue, model, body, deadline)
+            return await self.complete(request, queue, model, body, deadline)
+        finally:
+            queue.release()
+
+    @staticmethod
+    def remaining(deadline: Optional[float]) -> Optional[float]:
+        if deadline is None:
+            return None
+        return max(0.0, deadline - asyncio.get_running_loop().time())
+
+    def create(self, model: str, body: Dict[str, Any], stream: bool):
+        kwargs = {key: body[key] for key in ("temperature", "max_tokens", "stop", "response_format", "priority") if body.get(key) is not None}
+        if stream:
+            # Server-sent events encoded by the engine, ending with the final chunk and [DONE]
+            kwargs.update(raw="sse", chunk_size=self.chunk_size, chunk_interval=self.chunk_interval)
+        return self.engine.chat.completions.create(messages=body["messages"], model=model, stream=stream, **kwargs)
+
+    async def complete(self, request: web.Request, queue: RequestQueue, model: str,
+                       body: Dict[str, Any], deadline: Optional[float]) -> web.Response:
+        task = asyncio.ensure_future(self.create(model, body, False))
+        # Poll for a disconnected client, since aiohttp does not cancel the handler for us
+        while not task.done():
+            remaining = self.remaining(deadline)
+            await asyncio.wait([task], timeout=0.5 if remaining is None else min(0.5, remaining))
+            if request.transport is None or request.transport.is_closing():
+                task.cancel()
+                queue.cancelled += 1
+                return error_response(499, "Client closed the connection", "cancelled")
+            if deadline is not None and self.remaining(deadline) == 0 and not task.done():
+                task.cancel()
+                queue.timeouts += 1
+                return error_response(504, "Request timed out", "timeout")
+        completion = task.result()
+        queue.completed += 1
+        return web.json_response({**completion.to_json(), "model": model})
+
+    async def stream_completion(self, request: web.Request, queue: RequestQueue, model: str,
+                                body: Dict[str, Any], deadline: Optional[float]) -> web.StreamResponse:
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+        })
+        await response.prepare(request)
+        chunks: AsyncIterator = await self.create(model, body, True)
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), self.remaining(deadline))
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    queue.timeouts += 1
+                    error = {"error": {"message": "Request timed out", "type": "timeout"}}
+                    # Terminated like a complete stream, so that clients stop waiting for more
+                    await response.write(f"data: {json.dumps(error)}\n\ndata: [DONE]\n\n".encode())
+                    await response.write_eof()
+                    return response
+                await response.write(chunk)
+            await response.write_eof()
+            queue.completed += 1
+        except (ConnectionResetError, asyncio.CancelledError):
+            queue.cancelled += 1
+            raise
+        finally:
+            # Stops the generation if the stream ended early
+            await chunks.aclose()
+        return response
+
+def create_app(engine: AsyncLocalEngine, models: List[str], **kwargs: Any) -> web.Application:
+    return Server(engine, models, **kwargs).app
+
+__all__ = ['Server', 'RequestQueue', 'create_app']
@@ -0,0 +1,42 @@
+import argparse
+
+# Fails with the install hint first if aiohttp is missing
+from . import create_app, web
+from ..local import AsyncLocalEngine, MetricsRegistry
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve local models through an OpenAI-compatible API. Requires aiohttp (pip install aiohttp).")
+    parser.add_argument("--model", action="append", required=True, help="Model to serve (file name without '.gguf'). Can be repeated.")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to bind to.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("--gpu-layers", type=int, default=0, help="Number of layers to offload to the GPU, -1 for all.")
+    parser.add_argument("--cores", type=int, default=None, help="Number of CPU cores to use.")
+    parser.add_argument("--context-window", type=int, default=4900, help="Context window size.")
+    parser.add_argument("--prefix-cache", action="store_true", help="Reuse evaluated prompt prefixes between requests.")
+    parser.add_argument("--batching", action="store_true", help="Decode concurrent requests to a model in one shared batch.")
+    parser.add_argument("--batch-size", type=int, default=4, help="Maximum number of sequences per batch.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Concurrent generations per model.")
+    parser.add_argument("--max-queue", type=int, default=64, help="Requests that may wait per model before new ones are rejected.")
+    parser.add_argument("--timeout", type=float, default=None, help="Per-request timeout in seconds.")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Coalesce streamed tokens into events of at least this many characters.")
+    parser.add_argument("--chunk-interval", type=float, default=None, help="Coalesce streamed tokens into at most one event per interval in seconds.")
+    args = parser.parse_args()
+
+    engine = AsyncLocalEngine(
+        gpu_layers=args.gpu_layers,
+        cores=args.cores,
+        context_window=args.context_window,
+        prefix_cache=args.prefix_cache,
+        batching=args.batching,
+        batch_size=args.batch_size,
+        max_workers=args.concurrency * len(args.model),
+        metrics=MetricsRegistry(),
+    )
+    app = create_app(
+        engine, args.model, concurrency=args.concurrency, max_queue=args.max_queue, timeout=args.timeout,
+        chunk_size=args.chunk_size, chunk_interval=args.chunk_interval
+    )
+    web.run_app(app, host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
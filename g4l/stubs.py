@@ -1,18 +1,29 @@
 
 from __future__ import annotations
 
+import json
 from typing import Union
 
 class Model():
-    ...
+    __slots__ = ()
 
 class ChatCompletion(Model):
+    __slots__ = (
+        "id", "object", "created", "model", "provider", "choices",
+        "cache", "speculative", "usage", "timings", "response_cache"
+    )
+
     def __init__(
         self,
         content: str,
         finish_reason: str,
         completion_id: str = None,
-        created: int = None
+        created: int = None,
+        cache: dict = None,
+        speculative: dict = None,
+        usage: dict = None,
+        timings: dict = None,
+        response_cache: dict = None
     ):
         self.id: str = f"chatcmpl-{completion_id}" if completion_id else None
         self.object: str = "chat.completion"
@@ -20,25 +31,48 @@ class ChatCompletion(Model):
         self.model: str = None
         self.provider: str = None
         self.choices = [ChatCompletionChoice(ChatCompletionMessage(content), finish_reason)]
-        self.usage: dict[str, int] = {
-            "prompt_tokens": 0, #prompt_tokens,
-            "completion_tokens": 0, #completion_tokens,
-            "total_tokens": 0, #prompt_tokens + completion_tokens,
+        self.cache: dict = cache
+        self.speculative: dict = speculative
+        self.usage: dict[str, int] = usage or {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
         }
+        self.timings: dict[str, float] = timings
+        self.response_cache: dict = response_cache
 
     def to_json(self):
         return {
-            **self.__dict__,
-            "choices": [choice.to_json() for choice in self.choices]
+            "id": self.id,
+            "object": self.object,
+            "created": self.created,
+            "model": self.model,
+            "provider": self.provider,
+            "choices": [choice.to_json() for choice in self.choices],
+            "cache": self.cache,
+            "speculative": self.speculative,
+            "usage": self.usage,
+            "timings": self.timings,
+            "response_cache": self.response_cache,
         }
 
 class ChatCompletionChunk(Model):
+    __slots__ = (
+        "id", "object", "created", "model", "provider", "choices",
+        "cache", "speculative", "usage", "timings", "response_cache"
+    )
+
     def __init__(
         self,
         content: str,
         finish_reason: str,
         completion_id: str = None,
-        created: int = None
+        created: int = None,
+        cache: dict = None,
+        speculative: dict = None,
+        usage: dict = None,
+        timings: dict = None,
+        response_cache: dict = None
     ):
         self.id: str = f"chatcmpl-{completion_id}" if completion_id else None
         self.object: str = "chat.completion.chunk"
@@ -46,22 +80,66 @@ class ChatCompletionChunk(Model):
         self.model: str = None
         self.provider: str = None
         self.choices = [ChatCompletionDeltaChoice(ChatCompletionDelta(content), finish_reason)]
+        self.cache: dict = cache
+        self.speculative: dict = speculative
+        self.usage: dict[str, int] = usage
+        self.timings: dict[str, float] = timings
+        self.response_cache: dict = response_cache
 
     def to_json(self):
         return {
-            **self.__dict__,
-            "choices": [choice.to_json() for choice in self.choices]
+            "id": self.id,
+            "object": self.object,
+            "created": self.created,
+            "model": self.model,
+            "provider": self.provider,
+            "choices": [choice.to_json() for choice in self.choices],
+            "cache": self.cache,
+            "speculative": self.speculative,
+            "usage": self.usage,
+            "timings": self.timings,
+            "response_cache": self.response_cache,
         }
 
+class ChunkTemplate():
+    """
+    The serialized form of the content chunks of one completion, with a slot for the content.
+
+    Every content chunk of a stream only differs by its text, so the rest of the JSON is
+    encoded once and a token only costs encoding its text. The template is derived from
+    `ChatCompletionChunk.to_json`, so both always serialize the same.
+    """
+    __slots__ = ("prefix", "suffix", "sse_prefix", "sse_suffix")
+
+    def __init__(self, completion_id: str, created: int, model: str = None):
+        placeholder = "\0"
+        chunk = ChatCompletionChunk(placeholder, None, completion_id, created)
+        chunk.model = model
+        self.prefix, self.suffix = json.dumps(chunk.to_json()).split(json.dumps(placeholder))
+        self.sse_prefix = f"data: {self.prefix}"
+        self.sse_suffix = f"{self.suffix}\n\n"
+
+    def dumps(self, content: str) -> str:
+        """Return the JSON of a content chunk."""
+        return self.prefix + json.dumps(content) + self.suffix
+
+    def sse(self, content: str) -> bytes:
+        """Return a content chunk as a server-sent event."""
+        return (self.sse_prefix + json.dumps(content) + self.sse_suffix).encode()
+
 class ChatCompletionMessage(Model):
+    __slots__ = ("role", "content")
+
     def __init__(self, content: Union[str, None]):
         self.role = "assistant"
         self.content = content
 
     def to_json(self):
-        return self.__dict__
+        return {"role": self.role, "content": self.content}
 
 class ChatCompletionChoice(Model):
+    __slots__ = ("index", "message", "finish_reason")
+
     def __init__(self, message: ChatCompletionMessage, finish_reason: str):
         self.index = 0
         self.message = message
@@ -69,39 +147,44 @@ class ChatCompletionChoice(Model):
 
     def to_json(self):
         return {
-            **self.__dict__,
-            "message": self.message.to_json()
+            "index": self.index,
+            "message": self.message.to_json(),
+            "finish_reason": self.finish_reason,
         }
 
 class ChatCompletionDelta(Model):
-    content: Union[str, None] = None
+    __slots__ = ("content",)
 
     def __init__(self, content: Union[str, None]):
-        if content is not None:
-            self.content = content
+        self.content = content
 
     def to_json(self):
-        return self.__dict__
+        # The final chunk has an empty delta
+        return {} if self.content is None else {"content": self.content}
 
 class ChatCompletionDeltaChoice(Model):
+    __slots__ = ("delta", "finish_reason")
+
     def __init__(self, delta: ChatCompletionDelta, finish_reason: Union[str, None]):
         self.delta = delta
         self.finish_reason = finish_reason
 
     def to_json(self):
         return {
-            **self.__dict__,
-            "delta": self.delta.to_json()
+            "delta": self.delta.to_json(),
+            "finish_reason": self.finish_reason,
         }
 
 class Image(Model):
+    __slots__ = ("url",)
     url: str
 
     def __init__(self, url: str) -> None:
         self.url = url
 
 class ImagesResponse(Model):
+    __slots__ = ("data",)
     data: list[Image]
 
     def __init__(self, data: list) -> None:
-        self.data = data
\ No newline at end of file
+        self.data = data